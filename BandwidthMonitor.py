@@ -0,0 +1,79 @@
+import logging
+import threading
+
+from stem.control import EventType
+
+from ControllerPool import controller_pool
+from Metrics import READ_BYTES, WRITTEN_BYTES, metrics
+
+
+class BandwidthMonitor:
+    """
+    Counts the bytes every running tor process reads and writes from its per second BW events into metrics, one
+    subscription per tor process. Counters are labelled with the socks port, or with the control port for a shared
+    tor process, whose BW events cover all of its socks ports.
+
+    Attributes:
+        tmanager:TManager:
+            fleet whose tor processes are monitored
+    """
+
+    def __init__(self, tmanager, registry=metrics):
+        self.tmanager = tmanager
+        self.registry = registry
+
+        self._lock_ = threading.Lock()
+        self._listeners_ = dict()  # control port -> (pid, controller, listener)
+        self._logger_ = logging.getLogger(__name__)
+
+    def sync(self):
+        """
+        Subscribes to the tor processes that are not monitored yet and drops the ones that stopped or restarted.
+        """
+        wanted = dict()  # control port -> (pid, labels, client)
+        for client in self.tmanager.clients:
+            if client.pid in (None, -1) or client.control_port is None:
+                continue
+            if client.shared_group is not None:
+                wanted[client.shared_control_port] = (client.pid, {'control_port': client.shared_control_port}, client)
+            else:
+                wanted[client.control_port] = (client.pid, {'port': client.socks_port}, client)
+
+        with self._lock_:
+            for control_port in list(self._listeners_):
+                pid = self._listeners_[control_port][0]
+                if control_port not in wanted or wanted[control_port][0] != pid:
+                    self._remove_(control_port)
+
+        for control_port, (pid, labels, client) in wanted.items():
+            with self._lock_:
+                if control_port in self._listeners_:
+                    continue
+            try:
+                self._add_(control_port, pid, labels, client.password)
+            except Exception as e:
+                self._logger_.error(f"monitoring bandwidth of control port {control_port} failed: {e}")
+
+    def _add_(self, control_port, pid, labels, password=None):
+        controller = controller_pool.get(control_port, password, interactive=False)
+
+        def on_bw(event):
+            self.registry.inc(READ_BYTES, event.read, **labels)
+            self.registry.inc(WRITTEN_BYTES, event.written, **labels)
+
+        controller.add_event_listener(on_bw, EventType.BW)
+        with self._lock_:
+            self._listeners_[control_port] = (pid, controller, on_bw)
+
+    def _remove_(self, control_port):
+        _, controller, listener = self._listeners_.pop(control_port)
+        if controller.is_alive():
+            try:
+                controller.remove_event_listener(listener)
+            except Exception as e:
+                self._logger_.debug(f"unsubscribing BW events of control port {control_port} failed: {e}")
+
+    def stop(self):
+        with self._lock_:
+            for control_port in list(self._listeners_):
+                self._remove_(control_port)
@@ -0,0 +1,199 @@
+import os
+import threading
+
+from tor_countries import COUNTRIES, country_code
+
+
+class ClientRegistry:
+    """
+    Ordered collection of TorConfig clients which keeps lookup indexes in sync with its contents.
+
+    Attributes:
+        _clients_:list:
+            clients in insertion order
+
+        _by_socks_port_:dict:
+            socks port -> client
+
+        _by_control_port_:dict:
+            control port -> client
+
+        _by_pid_:dict:
+            pid -> client
+
+        _by_file_name_:dict:
+            basename of config_file_path -> client
+
+        _by_country_:dict:
+            lower-cased exit node country -> list of clients
+
+        _keys_:dict:
+            id(client) -> keys the client is currently indexed under, so it can be unindexed after it changed
+    """
+
+    def __init__(self, clients=None):
+        self._lock_ = threading.RLock()
+
+        self._clients_ = list()
+        self._by_socks_port_ = dict()
+        self._by_control_port_ = dict()
+        self._by_pid_ = dict()
+        self._by_file_name_ = dict()
+        self._by_country_ = dict()
+        self._keys_ = dict()
+
+        if clients:
+            self.extend(clients)
+
+    def __iter__(self):
+        with self._lock_:
+            return iter(list(self._clients_))
+
+    def __len__(self):
+        return len(self._clients_)
+
+    def __bool__(self):
+        return len(self._clients_) != 0
+
+    def __getitem__(self, index):
+        return self._clients_[index]
+
+    def __contains__(self, client):
+        return id(client) in self._keys_
+
+    @staticmethod
+    def _port_(port):
+        try:
+            return int(port)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _countries_(client):
+        if not client.exit_nodes:
+            return list()
+
+        return list(dict.fromkeys(node.lower() for node in client.exit_nodes if node.lower() in COUNTRIES))
+
+    def _index_(self, client):
+        keys = {
+            'socks_port': self._port_(client.socks_port),
+            'control_port': self._port_(client.control_port),
+            'pid': client.pid if client.pid not in (None, -1) else None,
+            'file_name': os.path.basename(client.config_file_path) if client.config_file_path else None,
+            'countries': self._countries_(client),
+        }
+
+        if keys['socks_port'] is not None:
+            self._by_socks_port_[keys['socks_port']] = client
+        if keys['control_port'] is not None:
+            self._by_control_port_[keys['control_port']] = client
+        if keys['pid'] is not None:
+            self._by_pid_[keys['pid']] = client
+        if keys['file_name'] is not None:
+            self._by_file_name_[keys['file_name']] = client
+        for country in keys['countries']:
+            self._by_country_.setdefault(country, list()).append(client)
+
+        self._keys_[id(client)] = keys
+
+    def _unindex_(self, client):
+        keys = self._keys_.pop(id(client), None)
+        if keys is None:
+            return
+
+        for index, key in ((self._by_socks_port_, keys['socks_port']),
+                           (self._by_control_port_, keys['control_port']),
+                           (self._by_pid_, keys['pid']),
+                           (self._by_file_name_, keys['file_name'])):
+            if key is not None and index.get(key) is client:
+                del index[key]
+
+        for country in keys['countries']:
+            clients = self._by_country_.get(country, list())
+            if client in clients:
+                clients.remove(client)
+            if not clients:
+                self._by_country_.pop(country, None)
+
+    def append(self, client):
+        """
+        Adds client to the registry, a client that is already registered is only reindexed.
+        """
+        with self._lock_:
+            if id(client) in self._keys_:
+                self.reindex(client)
+                return
+
+            self._clients_.append(client)
+            self._index_(client)
+
+    def extend(self, clients):
+        for client in clients:
+            self.append(client)
+
+    def remove(self, client):
+        """
+        Removes client from the registry and all of its indexes.
+        """
+        with self._lock_:
+            if id(client) not in self._keys_:
+                return
+
+            self._unindex_(client)
+            self._clients_.remove(client)
+
+    def reindex(self, client):
+        """
+        Refreshes the indexes of client after its ports, pid, config file or exit nodes changed.
+        """
+        with self._lock_:
+            if id(client) not in self._keys_:
+                return
+
+            self._unindex_(client)
+            self._index_(client)
+
+    def by_port(self, port):
+        """
+        Returns:
+            client whose socks or control port is port, None if there is none
+        """
+        port = self._port_(port)
+        return self._by_socks_port_.get(port) or self._by_control_port_.get(port)
+
+    def by_pid(self, pid):
+        return self._by_pid_.get(self._port_(pid))
+
+    def by_file_name(self, file_name):
+        return self._by_file_name_.get(os.path.basename(file_name))
+
+    def by_country(self, country):
+        """
+        Args:
+            country: str: country code or name
+
+        Returns:
+            list of clients which have country in their exit nodes
+        """
+        return list(self._by_country_.get(country_code(country), list()))
+
+    def find(self, **kwargs):
+        """
+        Keyword Args:
+            port: int
+            country: str
+            pid: int
+
+        Returns:
+            list of clients matching any of the given keys
+        """
+        found = list()
+        if 'port' in kwargs:
+            found.append(self.by_port(kwargs['port']))
+        if 'pid' in kwargs:
+            found.append(self.by_pid(kwargs['pid']))
+        if 'country' in kwargs:
+            found.extend(self.by_country(kwargs['country']))
+
+        return list(dict.fromkeys(client for client in found if client is not None))
@@ -0,0 +1,120 @@
+import getpass
+import logging
+import os
+import threading
+
+from stem import SocketClosed
+from stem.connection import MissingPassword, PasswordAuthFailed
+from stem.control import Controller
+
+
+class ControllerPool:
+    """
+    Keeps one authenticated stem Controller per control port alive and reconnects it when it dies.
+
+    Authentication tries, in order: the password given for the port, the password shared by the pool, the
+    TOR_CONTROL_PASSWORD environment variable and cookie/no authentication. Only if all of them fail and the pool
+    is interactive, the password is prompted for once and then reused for every port.
+
+    Attributes:
+        password:str:
+            control password shared by all clients (custom torrc files inherit HashedControlPassword from the
+            main torrc)
+
+        interactive:bool:
+            whether a missing password may be prompted for
+    """
+
+    PASSWORD_ENV = 'TOR_CONTROL_PASSWORD'
+
+    def __init__(self, password=None, interactive=True):
+        self.password = password or os.environ.get(self.PASSWORD_ENV)
+        self.interactive = interactive
+
+        self._lock_ = threading.Lock()
+        self._prompt_lock_ = threading.Lock()
+        self._controllers_ = dict()  # control port -> Controller
+        self._port_locks_ = dict()  # control port -> Lock
+
+    def __contains__(self, port):
+        controller = self._controllers_.get(int(port))
+        return controller is not None and controller.is_alive()
+
+    def _port_lock_(self, port):
+        with self._lock_:
+            return self._port_locks_.setdefault(port, threading.Lock())
+
+    def _prompt_password_(self, port):
+        with self._prompt_lock_:
+            if not self.password:
+                self.password = getpass.unix_getpass(prompt=f"tor control port {port}\npassword:")
+            return self.password
+
+    def _authenticate_(self, controller, port, password=None, interactive=None):
+        if password or self.password:
+            controller.authenticate(password=password or self.password)
+            return
+
+        try:
+            # cookie or null authentication, raises MissingPassword if the port requires one
+            controller.authenticate()
+        except (MissingPassword, PasswordAuthFailed):
+            if not (self.interactive if interactive is None else interactive):
+                raise
+            controller.authenticate(password=self._prompt_password_(port))
+
+    def get(self, port, password=None, interactive=None):
+        """
+        Returns the authenticated controller of port, connecting or reconnecting it if needed.
+
+        Args:
+            port: int: control port
+            password: str: password of this port, if it differs from the shared one
+            interactive: bool: overrides interactive for this call, e.g. for lookups that have a fallback
+        """
+        port = int(port)
+        with self._port_lock_(port):
+            controller = self._controllers_.get(port)
+            if controller is not None and controller.is_alive():
+                return controller
+
+            if controller is not None:
+                controller.close()
+
+            controller = Controller.from_port(port=port)
+            try:
+                self._authenticate_(controller, port, password, interactive)
+            except Exception:
+                controller.close()
+                raise
+
+            self._controllers_[port] = controller
+            logging.getLogger(__name__).debug(f"connected controller of control port {port}")
+            return controller
+
+    def signal(self, port, signal, password=None):
+        """
+        Sends signal through the pooled controller of port, reconnecting once if the connection was lost.
+        """
+        try:
+            self.get(port, password).signal(signal)
+        except SocketClosed:
+            self.close(port)
+            self.get(port, password).signal(signal)
+
+    def close(self, port):
+        """
+        Closes and forgets the controller of port, e.g. after its tor process was killed.
+        """
+        port = int(port)
+        with self._port_lock_(port):
+            controller = self._controllers_.pop(port, None)
+        if controller is not None:
+            controller.close()
+
+    def close_all(self):
+        for port in list(self._controllers_):
+            self.close(port)
+
+
+controller_pool = ControllerPool()
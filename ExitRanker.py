@@ -0,0 +1,183 @@
+import logging
+import threading
+
+from ControllerPool import controller_pool
+from tor_countries import COUNTRIES
+
+
+class ExitRanker:
+    """
+    Narrows the ExitNodes of per-country clients from whole countries to the fastest exits of those countries.
+
+    The consensus is read through the control port of a running client: relays flagged Exit, Fast, Stable, Running
+    and Valid (and not BadExit) are located with GETINFO ip-to-country and ranked by their consensus bandwidth. Each
+    client whose ExitNodes are only countries gets the best limit fingerprints of its countries through SETCONF, so
+    no restart is needed and the torrc keeps its countries. Rankings are refreshed every interval seconds, since
+    the consensus changes hourly.
+
+    Clients whose countries have no ranked exit keep their country ExitNodes.
+
+    Attributes:
+        tmanager:TManager:
+            fleet whose clients are ranked
+
+        limit:int:
+            fingerprints kept per country
+
+        interval:int:
+            seconds between refreshes
+    """
+
+    REQUIRED_FLAGS = frozenset(('Exit', 'Fast', 'Stable', 'Running', 'Valid'))
+
+    def __init__(self, tmanager, limit=10, interval=3600):
+        self.tmanager = tmanager
+        self.limit = limit
+        self.interval = interval
+        self.rankings = dict()  # country code -> fingerprints, fastest first
+
+        self._lock_ = threading.Lock()
+        self._applied_ = dict()  # control port -> (pid, ExitNodes value) last set on it
+        self._timer_ = None
+        self._stopped_ = threading.Event()
+        self._logger_ = logging.getLogger(__name__)
+
+    @staticmethod
+    def _countries_(client):
+        """
+        Returns:
+            tuple of the country codes of client's ExitNodes, empty if they are not only countries
+        """
+        exit_nodes = client.exit_nodes or ()
+        if not exit_nodes or any(node not in COUNTRIES for node in exit_nodes):
+            return tuple()
+        return tuple(exit_nodes)
+
+    def _running_(self):
+        return [client for client in self.tmanager.clients
+                if client.pid not in (None, -1) and client.control_port is not None]
+
+    def rank(self, countries=None):
+        """
+        Ranks the exits of countries from the consensus of a running client.
+
+        Args:
+            countries: iterable of country codes, the countries of the running clients by default
+
+        Returns:
+            dict: country code -> fingerprints, fastest first
+
+        Raises:
+            LookupError: if no running client can be asked
+        """
+        running = self._running_()
+        if countries is None:
+            countries = {country for client in running for country in self._countries_(client)}
+        countries = set(countries)
+        if not countries:
+            return dict()
+
+        for client in running:
+            try:
+                controller = controller_pool.get(client.control_port, client.password, interactive=False)
+                statuses = list(controller.get_network_statuses())
+                break
+            except Exception as e:
+                self._logger_.debug(f"reading the consensus through client {client.socks_port} failed: {e}")
+        else:
+            raise LookupError("no running client to read the consensus from")
+
+        candidates = {country: list() for country in countries}
+        for router in statuses:
+            flags = set(router.flags)
+            if not self.REQUIRED_FLAGS <= flags or 'BadExit' in flags:
+                continue
+
+            country = controller.get_info(f'ip-to-country/{router.address}', None)
+            if country in candidates:
+                candidates[country].append((router.bandwidth or 0, router.fingerprint))
+
+        rankings = {country: [fingerprint for _, fingerprint in sorted(exits, reverse=True)[:self.limit]]
+                    for country, exits in candidates.items()}
+        self._logger_.info(f"ranked exits of {len(rankings)} countries from {len(statuses)} relays")
+        return rankings
+
+    def exit_nodes(self, client):
+        """
+        Returns:
+            str: the ExitNodes value for client from the current rankings, None if it has none
+        """
+        fingerprints = [fingerprint for country in self._countries_(client)
+                        for fingerprint in self.rankings.get(country, ())]
+        if not fingerprints:
+            return None
+        return ','.join(f'${fingerprint}' for fingerprint in fingerprints)
+
+    def apply(self, force=False):
+        """
+        Sets the ranked ExitNodes on every running client that doesn't have them yet, one SETCONF per tor process.
+
+        Args:
+            force: bool: set them again even where they were already set
+
+        Returns:
+            int: number of tor processes changed
+        """
+        changed = 0
+        seen = set()
+        for client in self._running_():
+            control_port = client.shared_control_port or client.control_port
+            exit_nodes = self.exit_nodes(client)
+            if exit_nodes is None or control_port in seen:
+                continue
+            seen.add(control_port)
+
+            with self._lock_:
+                if not force and self._applied_.get(control_port) == (client.pid, exit_nodes):
+                    continue
+                self._applied_[control_port] = (client.pid, exit_nodes)
+
+            try:
+                controller_pool.get(control_port, client.password, interactive=False) \
+                    .set_options({'ExitNodes': exit_nodes})
+                changed += 1
+            except Exception as e:
+                with self._lock_:
+                    self._applied_.pop(control_port, None)
+                self._logger_.error(f"setting ranked exits of client {client.socks_port} failed: {e}")
+
+        return changed
+
+    def refresh(self):
+        """
+        Re-ranks the exits and applies the new rankings.
+        """
+        rankings = self.rank()
+        if rankings != self.rankings:
+            self.rankings = rankings
+            self.apply(force=True)
+        else:
+            self.apply()
+
+    def _run_(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            self._logger_.error(f"refreshing exit rankings failed: {e}")
+
+        if not self._stopped_.is_set():
+            self._timer_ = threading.Timer(self.interval, self._run_)
+            self._timer_.daemon = True
+            self._timer_.start()
+
+    def start(self):
+        """
+        Ranks right away, then every interval seconds.
+        """
+        self._stopped_.clear()
+        threading.Thread(target=self._run_, daemon=True).start()
+
+    def stop(self):
+        self._stopped_.set()
+        if self._timer_ is not None:
+            self._timer_.cancel()
@@ -0,0 +1,338 @@
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+from tor_countries import COUNTRIES, country_code
+
+REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clients_cache_dir", "fleet.mmap")
+
+MAGIC = b'TMFR'
+VERSION = 1
+
+# client health, as published
+STOPPED = 0
+STARTING = 1
+DEAD = 2  # has a pid, but its tor process is gone
+RUNNING = 3  # exit not known yet
+READY = 4  # running with a known exit ip
+HEALTH_NAMES = ('stopped', 'starting', 'dead', 'running', 'ready')
+
+# magic, version, superseded, record size, sequence, count, capacity, published time
+HEADER = struct.Struct('<4sHHIQIId')
+SUPERSEDED = struct.Struct('<H'), 6
+SEQUENCE = struct.Struct('<Q'), 12
+COUNT = struct.Struct('<I'), 20
+PUBLISHED_TIME = struct.Struct('<d'), 28
+
+# socks port, control port, pid, health, up to 4 exit node countries, exit country, exit ip, socks auth
+RECORD = struct.Struct('<HHiB8s2s46s32s')
+MAX_COUNTRIES = 4
+
+
+def _put(field, buffer, value):
+    field[0].pack_into(buffer, field[1], value)
+
+
+def _get(field, buffer):
+    return field[0].unpack_from(buffer, field[1])[0]
+
+
+def _text(raw):
+    return raw.rstrip(b'\0').decode('ascii', 'replace')
+
+
+def client_health(client):
+    """
+    Returns:
+        int: one of STOPPED, STARTING, DEAD, RUNNING, READY
+    """
+    if client.launching():
+        return STARTING
+    if client.pid is None:
+        return STOPPED
+    if client.pid != -1 and not client.process_alive():
+        return DEAD
+    if not client.ip_info or not client.ip_info.get('ip'):
+        return RUNNING
+    return READY
+
+
+def pack_client(client):
+    """
+    Returns:
+        bytes: client as a RECORD
+    """
+    countries = [node.lower() for node in client.exit_nodes or () if node.lower() in COUNTRIES][:MAX_COUNTRIES]
+    ip_info = client.ip_info or dict()
+    socks_auth = ''.join(client.socks_auth) if client.socks_auth else ''
+    pid = client.pid if client.pid is not None else 0
+
+    return RECORD.pack(
+        client.socks_port or 0,
+        client.control_port or 0,
+        pid,
+        client_health(client),
+        ''.join(countries).encode('ascii'),
+        (ip_info.get('country') or '').lower().encode('ascii', 'replace')[:2],
+        (ip_info.get('ip') or '').encode('ascii', 'replace')[:46],
+        socks_auth.encode('ascii', 'replace')[:32],
+    )
+
+
+def unpack_record(data, offset=0):
+    """
+    Returns:
+        dict: keys: 'socks_port', 'control_port', 'pid', 'health', 'countries', 'country', 'ip', 'socks_auth';
+        pid is None for stopped clients and -1 for the system tor service, socks_auth a
+        (username, password) tuple for clients of a shared tor process
+    """
+    socks_port, control_port, pid, health, countries, country, ip, socks_auth = RECORD.unpack_from(data, offset)
+    countries = _text(countries)
+    socks_auth = _text(socks_auth)
+
+    return {
+        'socks_port': socks_port or None,
+        'control_port': control_port or None,
+        'pid': pid if health != STOPPED else None,
+        'health': HEALTH_NAMES[health],
+        'countries': [countries[index:index + 2] for index in range(0, len(countries), 2)],
+        'country': _text(country) or None,
+        'ip': _text(ip) or None,
+        'socks_auth': (socks_auth[:len(socks_auth) // 2], socks_auth[len(socks_auth) // 2:]) if socks_auth else None,
+    }
+
+
+class FleetRegistry:
+    """
+    Publishes the fleet of a TManager in a memory mapped file, so any number of processes on the host can pick
+    proxies without building a TManager of their own, parsing torrc files or asking the daemon.
+
+    The file is a header followed by one fixed size record per client, guarded by a sequence lock: the owner makes
+    the sequence odd, rewrites the records in place and makes it even again. Readers (FleetReader) never lock, they
+    copy the records and retry when the sequence was odd or changed meanwhile. Only one process, the daemon, may
+    publish to a path.
+
+    When the fleet outgrows capacity, a file twice as large replaces it and the old one is marked superseded, which
+    makes readers map the new one.
+
+    Attributes:
+        path:str:
+            path of the registry file
+
+        capacity:int:
+            clients the current file has room for
+    """
+
+    def __init__(self, path=REGISTRY_PATH, capacity=1024):
+        self.path = path
+        self.capacity = capacity
+
+        self._lock_ = threading.Lock()
+        self._fd_ = None
+        self._map_ = None
+        self._sequence_ = 0
+        self._create_(capacity)
+
+    def _create_(self, capacity):
+        if self._map_ is None:
+            self._supersede_stale_()
+
+        size = HEADER.size + capacity * RECORD.size
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+
+        fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            new_map = mmap.mmap(fd, size)
+        except BaseException:
+            os.close(fd)
+            os.remove(temp_path)
+            raise
+
+        HEADER.pack_into(new_map, 0, MAGIC, VERSION, 0, RECORD.size, self._sequence_, 0, capacity, time.time())
+        os.replace(temp_path, self.path)
+
+        self._release_(superseded=True)
+        self._fd_, self._map_, self.capacity = fd, new_map, capacity
+
+    def _supersede_stale_(self):
+        """
+        Marks a registry left at path by a previous owner superseded, so its readers map the new one.
+        """
+        try:
+            with open(self.path, 'r+b') as fp:
+                stale = mmap.mmap(fp.fileno(), 0)
+        except (OSError, ValueError):
+            return
+
+        if stale[:len(MAGIC)] == MAGIC:
+            _put(SUPERSEDED, stale, 1)
+        stale.close()
+
+    def _release_(self, superseded=False):
+        if self._map_ is None:
+            return
+
+        if superseded:
+            # readers still mapping the old file switch to the new one
+            _put(SUPERSEDED, self._map_, 1)
+        self._map_.close()
+        os.close(self._fd_)
+        self._fd_ = self._map_ = None
+
+    def publish(self, clients):
+        """
+        Replaces the published records with clients.
+
+        Args:
+            clients: iterable of TorConfig
+
+        Returns:
+            int: number of clients published
+        """
+        records = [pack_client(client) for client in clients]
+
+        with self._lock_:
+            if self._map_ is None:
+                raise ValueError("fleet registry is closed")
+
+            self._sequence_ += 1
+            _put(SEQUENCE, self._map_, self._sequence_)
+
+            if len(records) > self.capacity:
+                # the new file starts with the odd sequence, readers switching to it wait for the records
+                capacity = self.capacity
+                while capacity < len(records):
+                    capacity *= 2
+                self._create_(capacity)
+
+            self._map_[HEADER.size:HEADER.size + len(records) * RECORD.size] = b''.join(records)
+            _put(COUNT, self._map_, len(records))
+            _put(PUBLISHED_TIME, self._map_, time.time())
+
+            self._sequence_ += 1
+            _put(SEQUENCE, self._map_, self._sequence_)
+
+        return len(records)
+
+    def close(self, remove=True):
+        """
+        Args:
+            remove: bool: delete the file, its readers then raise FileNotFoundError
+        """
+        with self._lock_:
+            self._release_(superseded=remove)
+            if remove and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class FleetReader:
+    """
+    Lock free reader of a FleetRegistry published by another process. Reading does no disk or network I/O, the
+    file is only mapped once (and again after it was superseded).
+
+    Attributes:
+        path:str:
+            path of the registry file
+    """
+
+    RETRIES = 1000  # attempts at a consistent copy before giving up on a publisher that keeps writing
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self._map_ = None
+        self._open_()
+
+    def _open_(self):
+        """
+        Raises:
+            FileNotFoundError: if nothing was published at path
+            ValueError: if path is not a fleet registry of this version
+        """
+        with open(self.path, 'rb') as fp:
+            new_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from('<4sH', new_map, 0)
+        if magic != MAGIC or version != VERSION:
+            new_map.close()
+            raise ValueError(f"{self.path} is not a version {VERSION} fleet registry")
+
+        if self._map_ is not None:
+            self._map_.close()
+        self._map_ = new_map
+
+    def _copy_(self):
+        """
+        Returns:
+            tuple: (header fields, bytes of the records) from a moment no publish was in progress
+        """
+        for attempt in range(self.RETRIES):
+            header = HEADER.unpack_from(self._map_, 0)
+            _, _, superseded, record_size, sequence, count, _, _ = header
+            if superseded:
+                self._open_()
+                continue
+            if sequence % 2:
+                if attempt:
+                    time.sleep(0)
+                continue
+
+            data = self._map_[HEADER.size:HEADER.size + count * record_size]
+            if _get(SEQUENCE, self._map_) == sequence:
+                return header, data
+
+        raise TimeoutError(f"no consistent copy of {self.path} after {self.RETRIES} attempts")
+
+    def published_time(self):
+        """
+        Returns:
+            float: time of the last publish
+        """
+        return self._copy_()[0][7]
+
+    def snapshot(self):
+        """
+        Returns:
+            list of dicts, see unpack_record, in fleet order
+        """
+        header, data = self._copy_()
+        return [unpack_record(data, offset) for offset in range(0, len(data), header[3])]
+
+    def find(self, country=None, health='ready'):
+        """
+        Args:
+            country: str: country code or name the clients exit in, any if None
+            health: str: health the clients have, any if None
+
+        Returns:
+            list of dicts, see unpack_record
+        """
+        if country is not None:
+            country = country_code(country)
+            if country is None:
+                return list()
+
+        return [record for record in self.snapshot()
+                if (health is None or record['health'] == health) and
+                (country is None or country in record['countries'] or country == record['country'])]
+
+    def pick(self, country=None):
+        """
+        Returns:
+            dict: a random ready client, exiting in country if given, see unpack_record
+
+        Raises:
+            LookupError: if there is none
+        """
+        records = self.find(country=country)
+        if not records:
+            raise LookupError(f"no ready client{f' in {country}' if country else ''}")
+        return random.choice(records)
+
+    def close(self):
+        if self._map_ is not None:
+            self._map_.close()
+            self._map_ = None
@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from stem import CircStatus
+from stem.control import EventType, State
+
+from ControllerPool import controller_pool
+
+
+class _Watch:
+    """
+    Supervision state of a single client.
+    """
+
+    __slots__ = ('client', 'controller', 'listeners', 'failures', 'attempts', 'restarting', 'stuck_timer')
+
+    def __init__(self, client):
+        self.client = client
+        self.controller = None
+        self.listeners = tuple()
+        self.failures = deque()  # times of recent circuit build failures
+        self.attempts = 0  # restarts since the client was last seen healthy
+        self.restarting = False
+        self.stuck_timer = None
+
+
+class HealthSupervisor:
+    """
+    Watches running clients through controller events instead of polling and restarts dead or stuck ones with
+    exponential backoff.
+
+    A client is restarted when
+        - its control connection closes and its tor process is gone,
+        - tor reports CIRCUIT_NOT_ESTABLISHED and no circuit is established within stuck_timeout seconds,
+        - failure_threshold circuits fail to build within failure_window seconds.
+
+    Clients of a shared tor process are not supervised, restarting one of them would restart the whole process.
+
+    Attributes:
+        tmanager:TManager:
+            fleet whose clients are supervised
+
+        launch_timeout:int:
+            seconds a restarted client is given to bootstrap
+    """
+
+    CLOSED_GRACE = 0.5  # seconds between losing the control connection and checking the process
+
+    def __init__(self, tmanager, failure_threshold=10, failure_window=60, stuck_timeout=120, base_delay=1,
+                 max_delay=300, launch_timeout=120):
+        self.tmanager = tmanager
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.stuck_timeout = stuck_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.launch_timeout = launch_timeout
+
+        self._lock_ = threading.Lock()
+        self._watches_ = dict()  # id(client) -> _Watch
+        self._logger_ = logging.getLogger(__name__)
+
+    @staticmethod
+    def _supervisable_(client):
+        return client.pid not in (None, -1) and client.control_port is not None and \
+            client.config_file_path is not None and client.shared_group is None
+
+    def sync(self):
+        """
+        Watches every running client that is not watched yet and forgets the ones that were stopped.
+        """
+        for client in self.tmanager.clients:
+            if self._supervisable_(client):
+                self.watch(client)
+
+        with self._lock_:
+            watches = list(self._watches_.values())
+        for watch in watches:
+            if watch.client.pid is None and not watch.restarting:
+                self.unwatch(watch.client)
+
+    def watch(self, client):
+        """
+        Subscribes to the events of client through its pooled controller.
+        """
+        with self._lock_:
+            watch = self._watches_.setdefault(id(client), _Watch(client))
+
+        controller = controller_pool.get(client.control_port, client.password)
+        if watch.controller is controller and controller.is_alive():
+            return
+
+        def on_status(event):
+            self._on_status_(watch, event)
+
+        def on_circ(event):
+            self._on_circ_(watch, event)
+
+        def on_state(controller, state, timestamp):
+            if state == State.CLOSED:
+                # a grace period lets kill_connection mark an intentional stop before the process is checked
+                timer = threading.Timer(self.CLOSED_GRACE, self._on_closed_, (watch,))
+                timer.daemon = True
+                timer.start()
+
+        controller.add_event_listener(on_status, EventType.STATUS_CLIENT)
+        controller.add_event_listener(on_circ, EventType.CIRC)
+        controller.add_status_listener(on_state)
+
+        watch.controller = controller
+        watch.listeners = (on_status, on_circ, on_state)
+
+    def unwatch(self, client):
+        with self._lock_:
+            watch = self._watches_.pop(id(client), None)
+        if watch is None:
+            return
+
+        self._detach_(watch)
+
+    @staticmethod
+    def _detach_(watch):
+        if watch.stuck_timer is not None:
+            watch.stuck_timer.cancel()
+            watch.stuck_timer = None
+
+        if watch.controller is not None and watch.listeners:
+            on_status, on_circ, on_state = watch.listeners
+            watch.controller.remove_status_listener(on_state)
+            if watch.controller.is_alive():
+                watch.controller.remove_event_listener(on_status)
+                watch.controller.remove_event_listener(on_circ)
+        watch.controller = None
+        watch.listeners = tuple()
+
+    def stop(self):
+        with self._lock_:
+            watches = list(self._watches_.values())
+            self._watches_.clear()
+        for watch in watches:
+            self._detach_(watch)
+
+    def _on_status_(self, watch, event):
+        if event.action == 'CIRCUIT_ESTABLISHED':
+            watch.attempts = 0
+            if watch.stuck_timer is not None:
+                watch.stuck_timer.cancel()
+                watch.stuck_timer = None
+
+        elif event.action == 'CIRCUIT_NOT_ESTABLISHED' and watch.stuck_timer is None:
+            watch.stuck_timer = threading.Timer(self.stuck_timeout, self._schedule_restart_,
+                                                (watch, f"no circuit established for {self.stuck_timeout} seconds"))
+            watch.stuck_timer.daemon = True
+            watch.stuck_timer.start()
+
+    def _on_circ_(self, watch, event):
+        if event.status == CircStatus.BUILT:
+            watch.attempts = 0
+            watch.failures.clear()
+
+        elif event.status == CircStatus.FAILED:
+            now = time.time()
+            watch.failures.append(now)
+            while watch.failures and now - watch.failures[0] > self.failure_window:
+                watch.failures.popleft()
+
+            if len(watch.failures) >= self.failure_threshold:
+                watch.failures.clear()
+                self._schedule_restart_(watch, f"{self.failure_threshold} circuits failed within "
+                                               f"{self.failure_window} seconds")
+
+    def _on_closed_(self, watch):
+        client = watch.client
+        if client.pid is None or watch.restarting:
+            # stopped on purpose, or closed by our own restart
+            return
+
+        if client.process_alive():
+            # only the control connection dropped
+            watch.controller = None
+            try:
+                self.watch(client)
+            except Exception as e:
+                self._schedule_restart_(watch, f"control port unreachable: {e}")
+        else:
+            self._schedule_restart_(watch, "tor process died")
+
+    def _schedule_restart_(self, watch, reason):
+        with self._lock_:
+            if watch.restarting:
+                return
+            watch.restarting = True
+            delay = min(self.base_delay * 2 ** watch.attempts, self.max_delay)
+            watch.attempts += 1
+
+        self._logger_.warning(f"client {watch.client.socks_port}: {reason}, restarting in {delay} seconds")
+        timer = threading.Timer(delay, self._restart_, (watch, reason))
+        timer.daemon = True
+        timer.start()
+
+    def _restart_(self, watch, reason):
+        client = watch.client
+        try:
+            self._detach_(watch)
+            client.kill_connection()
+            client.create_connection_from_config(timeout=self.launch_timeout)
+            self._logger_.info(f"client {client.socks_port} restarted ({reason})")
+        except Exception as e:
+            self._logger_.error(f"restarting client {client.socks_port} failed: {e}")
+        finally:
+            self.tmanager.clients.reindex(client)
+            self.tmanager.write_running_client_config(client)
+            watch.restarting = False
+
+        if client.pid is None:
+            self._schedule_restart_(watch, "previous restart failed")
+            return
+
+        try:
+            self.watch(client)
+        except Exception as e:
+            self._schedule_restart_(watch, f"control port unreachable: {e}")
+
@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait
+
+from get_port_ip import get_port_session
+
+
+class Lease:
+    """
+    Exclusive use of one client from acquiring until release. As a context manager, or async context manager, it is
+    released on exit.
+
+    Attributes:
+        client:TorConfig:
+            leased client
+
+        socks_port:int:
+            socks port of client
+
+        proxy:str:
+            socks5h proxy url of client, with its socks auth for a client of a shared tor process
+
+        session:requests.Session:
+            pooled session proxied through client, kept alive until client's next NEWNYM
+
+        acquired_time:float:
+            time the lease was handed out
+
+        released:bool:
+            release was called
+    """
+
+    def __init__(self, pool, client):
+        self.client = client
+        self.socks_port = client.socks_port
+        self.proxy = client.proxy_url()
+        self.session = get_port_session(client.socks_port, client.socks_auth)
+        self.acquired_time = time.time()
+        self.released = False
+        self._pool_ = pool
+
+    def __repr__(self):
+        return f"Lease(socks_port={self.socks_port}, released={self.released})"
+
+    def release(self, renew=True):
+        """
+        Args:
+            renew: bool: NEWNYM the client before it is leased again
+        """
+        self._pool_.release(self, renew=renew)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # release never blocks, the renew runs on the workers of renew_scheduler
+        self.release()
+
+
+class LeasePool:
+    """
+    Leases the running clients of a TManager, each to one holder at a time. The system tor service is never leased.
+
+    Waiters are served first come, first served: a released client goes straight to the oldest waiter it matches,
+    so a newcomer never takes it from one waiting longer. Released clients are renewed through the TManager's
+    renew_scheduler before they are leased again, so every lease starts on a fresh identity; the client is
+    unavailable until tor applied that NEWNYM, at most ten seconds after its previous one. Clients started while
+    others wait are picked up within POLL_INTERVAL.
+
+    acquire blocks the calling thread, acquire_async only the awaiting task. Releasing never blocks.
+
+    Attributes:
+        tmanager:TManager:
+            fleet whose clients are leased
+    """
+
+    POLL_INTERVAL = 1  # seconds between waiters looking for clients started meanwhile
+
+    def __init__(self, tmanager):
+        self.tmanager = tmanager
+
+        self._lock_ = threading.Lock()
+        self._busy_ = set()  # id(client) of clients leased or being renewed after their lease
+        self._waiters_ = deque()  # (Future, filters), oldest first
+        self._logger_ = logging.getLogger(__name__)
+
+    def leased(self):
+        """
+        Returns:
+            int: clients leased or being renewed after their lease
+        """
+        return len(self._busy_)
+
+    def waiting(self):
+        return len(self._waiters_)
+
+    @staticmethod
+    def _filters_(country, port):
+        filters = dict()
+        if country is not None:
+            filters['country'] = country
+        if port is not None:
+            filters['port'] = port
+        return filters
+
+    @staticmethod
+    def _available_(client):
+        # the system tor service (pid -1) shares its circuits with the whole host, it can't be leased exclusively
+        return client.pid not in (None, -1) and client.socks_port is not None and not client.launching()
+
+    def _matches_(self, client, filters):
+        if not self._available_(client):
+            return False
+        if not filters:
+            return client in self.tmanager.clients
+        return client in self.tmanager.clients.find(**filters)
+
+    def _take_(self, filters):
+        """
+        Marks the first free client matching filters as busy, has to be called holding _lock_.
+
+        Returns:
+            TorConfig, None if no matching client is free
+        """
+        clients = self.tmanager.clients.find(**filters) if filters else self.tmanager.clients
+        for client in clients:
+            if id(client) not in self._busy_ and self._available_(client):
+                self._busy_.add(id(client))
+                return client
+        return None
+
+    @staticmethod
+    def _hand_(future, client):
+        # a waiter whose future was cancelled gave up
+        if future.set_running_or_notify_cancel():
+            future.set_result(client)
+            return True
+        return False
+
+    def _enqueue_(self, filters):
+        """
+        Returns:
+            concurrent.futures.Future: resolves to the client leased, right away if a matching one is free
+        """
+        future = Future()
+        with self._lock_:
+            client = self._take_(filters) if not self._waiters_ else None
+            if client is not None:
+                self._hand_(future, client)
+            else:
+                self._waiters_.append((future, filters))
+
+        if client is None:
+            # queued behind older waiters, a matching client may still be free if none of them wants it
+            self.dispatch()
+        return future
+
+    def _withdraw_(self, future):
+        """
+        Stops waiting for future, it may have been handed a client meanwhile.
+        """
+        with self._lock_:
+            for waiter in self._waiters_:
+                if waiter[0] is future:
+                    self._waiters_.remove(waiter)
+                    break
+
+    def _abandon_(self, future):
+        self._withdraw_(future)
+        if future.done() and not future.cancelled():
+            self._return_(future.result())
+
+    def dispatch(self):
+        """
+        Hands free clients to the waiters, oldest first, e.g. after clients were started.
+        """
+        with self._lock_:
+            for waiter in list(self._waiters_):
+                future, filters = waiter
+                if future.cancelled():
+                    self._waiters_.remove(waiter)
+                    continue
+
+                client = self._take_(filters)
+                if client is None:
+                    continue
+
+                self._waiters_.remove(waiter)
+                if not self._hand_(future, client):
+                    self._busy_.discard(id(client))
+
+    def _return_(self, client):
+        """
+        Hands client to the oldest waiter it matches, or marks it free.
+        """
+        with self._lock_:
+            for waiter in list(self._waiters_):
+                future, filters = waiter
+                if future.cancelled():
+                    self._waiters_.remove(waiter)
+                elif self._matches_(client, filters):
+                    self._waiters_.remove(waiter)
+                    if self._hand_(future, client):
+                        return
+
+            self._busy_.discard(id(client))
+
+    def _deadline_(self, timeout):
+        return None if timeout is None else time.monotonic() + timeout
+
+    def _step_(self, deadline):
+        """
+        Returns:
+            float: seconds to wait before looking for started clients, 0 once deadline passed
+        """
+        if deadline is None:
+            return self.POLL_INTERVAL
+        return max(0.0, min(deadline - time.monotonic(), self.POLL_INTERVAL))
+
+    def acquire(self, country=None, port=None, timeout=None):
+        """
+        Leases a running client, waiting in line until one matching is free.
+
+        Args:
+            country: str: country code or name the client exits in
+            port: int: socks or control port of the client
+            timeout: float: seconds to wait, forever if None
+
+        Returns:
+            Lease
+
+        Raises:
+            TimeoutError: if no matching client was free within timeout
+        """
+        future = self._enqueue_(self._filters_(country, port))
+        deadline = self._deadline_(timeout)
+
+        try:
+            while not future.done():
+                step = self._step_(deadline)
+                if step <= 0:
+                    break
+                wait((future,), timeout=step)
+                if not future.done():
+                    self.dispatch()
+        except BaseException:
+            self._abandon_(future)
+            raise
+
+        self._withdraw_(future)
+        if not future.done():
+            raise TimeoutError(f"no client matching country={country} port={port} was free within {timeout} seconds")
+        return Lease(self, future.result())
+
+    async def acquire_async(self, country=None, port=None, timeout=None):
+        """
+        Like acquire, but waits without blocking the event loop. The lease's session blocks, asyncio clients
+        should connect through its proxy instead.
+
+        Returns:
+            Lease, also an async context manager
+
+        Raises:
+            TimeoutError: if no matching client was free within timeout
+        """
+        future = self._enqueue_(self._filters_(country, port))
+        deadline = self._deadline_(timeout)
+        waiting = asyncio.wrap_future(future)
+
+        try:
+            while not future.done():
+                step = self._step_(deadline)
+                if step <= 0:
+                    break
+                await asyncio.wait((waiting,), timeout=step)
+                if not future.done():
+                    self.dispatch()
+        except BaseException:
+            self._abandon_(future)
+            raise
+
+        self._withdraw_(future)
+        if not future.done():
+            raise TimeoutError(f"no client matching country={country} port={port} was free within {timeout} seconds")
+        return Lease(self, future.result())
+
+    def release(self, lease, renew=True):
+        """
+        Ends lease, releasing it again does nothing. Returns right away, also from the event loop: the renew runs
+        on the workers of renew_scheduler and the client is handed on once it finished.
+
+        Args:
+            lease: Lease
+            renew: bool:
+                send NEWNYM through renew_scheduler and lease the client again once tor applied it, a failed renew
+                is logged and the client leased again as it is
+        """
+        with self._lock_:
+            if lease.released:
+                return
+            lease.released = True
+
+        client = lease.client
+        if not renew or client.pid is None:
+            self._return_(client)
+            return
+
+        self.tmanager.renew_scheduler.request(client).add_done_callback(lambda _: self._return_(client))
@@ -0,0 +1,175 @@
+import bisect
+import http.server
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+BOOTSTRAP_SECONDS = 'tor_bootstrap_seconds'
+NEWNYM_IP_SECONDS = 'tor_newnym_to_new_ip_seconds'
+PROBE_SECONDS = 'tor_exit_probe_seconds'
+CONFIG_LOAD_SECONDS = 'tor_config_load_seconds'
+READ_BYTES = 'tor_read_bytes_total'
+WRITTEN_BYTES = 'tor_written_bytes_total'
+
+HELP = {
+    BOOTSTRAP_SECONDS: "Seconds from launching tor until it bootstrapped.",
+    NEWNYM_IP_SECONDS: "Seconds from sending NEWNYM until the new exit ip was known.",
+    PROBE_SECONDS: "Seconds taken to learn the exit ip of a client.",
+    CONFIG_LOAD_SECONDS: "Seconds taken to load and parse torrc files.",
+    READ_BYTES: "Bytes read by a tor process, from its BW events.",
+    WRITTEN_BYTES: "Bytes written by a tor process, from its BW events.",
+}
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values with fixed bucket upper bounds.
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels_key(labels):
+    return tuple(sorted((key, str(label)) for key, label in labels.items()))
+
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+class Metrics:
+    """
+    Thread safe registry of timing histograms and counters, rendered in the prometheus text format.
+
+    Metrics are created on first use, labels are keyword arguments, e.g.
+    metrics.observe(BOOTSTRAP_SECONDS, 12.3, port=9060).
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self._lock_ = threading.Lock()
+        self._histograms_ = dict()  # name -> {labels: Histogram}
+        self._counters_ = dict()  # name -> {labels: value}
+
+    def observe(self, name, value, **labels):
+        key = _labels_key(labels)
+        with self._lock_:
+            series = self._histograms_.setdefault(name, dict())
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.BUCKETS)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes the seconds the with block took, also when it raised.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def inc(self, name, value=1, **labels):
+        key = _labels_key(labels)
+        with self._lock_:
+            series = self._counters_.setdefault(name, dict())
+            series[key] = series.get(key, 0) + value
+
+    def render(self):
+        """
+        Returns:
+            str: every metric in the prometheus text exposition format
+        """
+        lines = list()
+        with self._lock_:
+            for name, series in sorted(self._histograms_.items()):
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels_text(labels, (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_labels_text(labels, (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{_labels_text(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_labels_text(labels)} {histogram.count}")
+
+            for name, series in sorted(self._counters_.items()):
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_labels_text(labels)} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock_:
+            self._histograms_.clear()
+            self._counters_.clear()
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format % args)
+
+
+class MetricsServer:
+    """
+    Serves metrics for prometheus on http://host:port/metrics.
+    """
+
+    def __init__(self, host='127.0.0.1', port=9101, registry=metrics):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server_ = None
+
+    def serve_forever(self):
+        self._server_ = http.server.ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+        self._server_.daemon_threads = True
+        self._server_.metrics = self.registry
+        logging.getLogger(__name__).info(f"serving metrics on http://{self.host}:{self.port}/metrics")
+
+        try:
+            self._server_.serve_forever()
+        finally:
+            self._server_.server_close()
+
+    def shutdown(self):
+        if self._server_ is not None:
+            self._server_.shutdown()
@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from Metrics import NEWNYM_IP_SECONDS, metrics
+
+
+class RenewScheduler:
+    """
+    Schedules NEWNYM per client so that it is only sent once tor will actually apply it.
+
+    Tor ignores a NEWNYM sent within ten seconds of the previous one, so renewing right away often leaves a client
+    on its old circuits. Each request waits for the client's get_newnym_wait and requests that arrive while one is
+    pending are merged into it.
+
+    The returned futures resolve to the client once its NEWNYM was applied (and, with probe, its new ip_info was
+    fetched), or to the exception that prevented it. request never blocks: asking tor for the wait, sending NEWNYM
+    and probing run on worker threads, up to max_workers clients at a time.
+    """
+
+    def __init__(self, max_workers=32):
+        self._executor_ = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='renew')
+        self._lock_ = threading.Lock()
+        self._pending_ = dict()  # id(client) -> (Future, probe)
+        self._logger_ = logging.getLogger(__name__)
+
+    def pending(self):
+        return len(self._pending_)
+
+    def request(self, client, probe=False):
+        """
+        Args:
+            client: TorConfig: running client
+            probe: bool: fetch the new ip_info before resolving
+
+        Returns:
+            concurrent.futures.Future
+        """
+        with self._lock_:
+            pending = self._pending_.get(id(client))
+            if pending is not None:
+                future, pending_probe = pending
+                if probe and not pending_probe:
+                    self._pending_[id(client)] = (future, True)
+                return future
+
+            future = Future()
+            self._pending_[id(client)] = (future, probe)
+
+        self._executor_.submit(self._arm_, client, future)
+        return future
+
+    def _finish_(self, client, future, exception=None):
+        with self._lock_:
+            if self._pending_.get(id(client), (None,))[0] is future:
+                del self._pending_[id(client)]
+
+        if exception is not None:
+            self._logger_.error(f"renew-ing client {client.socks_port} failed: {exception}")
+            future.set_exception(exception)
+        else:
+            future.set_result(client)
+
+    def _arm_(self, client, future):
+        try:
+            wait = client.newnym_wait()
+        except Exception as e:
+            self._finish_(client, future, e)
+            return
+
+        if wait <= 0:
+            self._send_(client, future)
+        else:
+            timer = threading.Timer(wait, self._send_, (client, future))
+            timer.daemon = True
+            timer.start()
+
+    def _send_(self, client, future):
+        try:
+            # another controller may have sent NEWNYM meanwhile, wait for that one's rate limit too
+            if client.newnym_wait() > 0:
+                self._arm_(client, future)
+                return
+
+            # requests arriving from now on need a NEWNYM of their own
+            with self._lock_:
+                probe = self._pending_.pop(id(client), (None, False))[1]
+
+            start_time = time.time()
+            client.send_newnym()
+            if probe:
+                client.get_tor_ip_dict()
+                metrics.observe(NEWNYM_IP_SECONDS, time.time() - start_time, port=client.socks_port)
+        except Exception as e:
+            self._finish_(client, future, e)
+            return
+
+        self._finish_(client, future)
@@ -0,0 +1,355 @@
+import logging
+import random
+import selectors
+import socket
+import socketserver
+import threading
+import time
+
+from tor_countries import country_code
+
+POLICIES = ('round-robin', 'least-connections', 'latency')
+
+SOCKS_VERSION = 5
+NO_AUTH, USERNAME_PASSWORD, NO_ACCEPTABLE_METHODS = 0x00, 0x02, 0xFF
+CONNECT = 0x01
+ATYP_IPV4, ATYP_DOMAIN, ATYP_IPV6 = 0x01, 0x03, 0x04
+REPLY_SUCCEEDED, REPLY_GENERAL_FAILURE, REPLY_COMMAND_NOT_SUPPORTED = 0x00, 0x01, 0x07
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("socks peer closed the connection")
+        data += chunk
+    return data
+
+
+def _read_address(sock, atyp):
+    """
+    Reads a socks5 address of type atyp and its port.
+
+    Returns:
+        bytes: the raw address and port, as they are forwarded to the backend
+    """
+    if atyp == ATYP_IPV4:
+        address = _recv_exactly(sock, 4)
+    elif atyp == ATYP_IPV6:
+        address = _recv_exactly(sock, 16)
+    elif atyp == ATYP_DOMAIN:
+        length = _recv_exactly(sock, 1)
+        address = length + _recv_exactly(sock, length[0])
+    else:
+        raise ValueError(f"unknown socks address type {atyp}")
+
+    return address + _recv_exactly(sock, 2)
+
+
+class Backend:
+    """
+    Bookkeeping of a single tor SocksPort.
+
+    Attributes:
+        port:int:
+            socks port
+
+        connections:int:
+            currently relayed connections
+
+        latency:float:
+            moving average of the seconds the backend took to answer CONNECT
+
+        unhealthy_until:float:
+            time until which the backend is skipped after it failed
+
+        auth:tuple:
+            socks (username, password) of a client of a shared tor process
+    """
+
+    __slots__ = ('port', 'connections', 'latency', 'unhealthy_until', 'auth')
+
+    def __init__(self, port, auth=None):
+        self.port = port
+        self.auth = auth
+        self.connections = 0
+        self.latency = None
+        self.unhealthy_until = 0.0
+
+    @property
+    def healthy(self):
+        return time.time() >= self.unhealthy_until
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            self.server.balancer.relay(self.request)
+        except OSError as e:
+            # the client went away mid handshake or before its reply
+            logging.getLogger(__name__).debug(f"socks client {self.client_address} dropped: {e}")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SocksBalancer:
+    """
+    Local socks5 listener which spreads connections over the SocksPorts of the running clients of a TManager.
+
+    A country can be chosen per connection through the socks username, either the code or name itself ('us',
+    'germany') or prefixed ('country-us'); the password is ignored. Backends which fail to connect or to complete
+    the socks handshake are skipped for cooldown seconds.
+
+    Attributes:
+        tmanager:TManager:
+            fleet whose running clients are used as backends
+
+        policy:str:
+            one of POLICIES
+
+        cooldown:int:
+            seconds a failed backend is skipped
+
+        retries:int:
+            other backends tried after a backend failed
+    """
+
+    LATENCY_ALPHA = 0.3  # weight of the newest sample in the latency moving average
+
+    def __init__(self, tmanager, host='127.0.0.1', port=9999, policy='round-robin', cooldown=30, retries=2,
+                 connect_timeout=30):
+        if policy not in POLICIES:
+            raise ValueError(f"policy has to be one of {POLICIES}")
+
+        self.tmanager = tmanager
+        self.host = host
+        self.port = port
+        self.policy = policy
+        self.cooldown = cooldown
+        self.retries = retries
+        self.connect_timeout = connect_timeout
+
+        self._lock_ = threading.Lock()
+        self._backends_ = dict()  # socks port -> Backend
+        self._next_ = 0  # round robin position
+        self._server_ = None
+
+    def _candidates_(self, country=None):
+        if country is not None:
+            clients = self.tmanager.clients.by_country(country)
+        else:
+            clients = self.tmanager.clients
+
+        running = [client for client in clients if client.pid is not None and client.socks_port is not None]
+
+        with self._lock_:
+            backends = list()
+            for client in running:
+                backend = self._backends_.setdefault(client.socks_port, Backend(client.socks_port))
+                # renewing a client of a shared process rotates its socks auth
+                backend.auth = client.socks_auth
+                backends.append(backend)
+        return [backend for backend in backends if backend.healthy]
+
+    def choose(self, country=None, exclude=()):
+        """
+        Picks a healthy backend according to policy.
+
+        Args:
+            country: str: only consider clients exiting in country
+            exclude: ports which already failed for this connection
+
+        Returns:
+            Backend, None if no healthy backend is left
+        """
+        candidates = [backend for backend in self._candidates_(country) if backend.port not in exclude]
+        if not candidates:
+            return None
+
+        with self._lock_:
+            if self.policy == 'round-robin':
+                backend = candidates[self._next_ % len(candidates)]
+                self._next_ += 1
+            elif self.policy == 'least-connections':
+                backend = min(candidates, key=lambda each: each.connections)
+            else:
+                # untried backends get the best known latency so they are sampled too
+                known = [each.latency for each in candidates if each.latency is not None]
+                best = min(known) if known else 1.0
+                weights = [1.0 / max(each.latency if each.latency is not None else best, 0.001)
+                           for each in candidates]
+                backend = random.choices(candidates, weights=weights)[0]
+
+            backend.connections += 1
+        return backend
+
+    def _release_(self, backend):
+        with self._lock_:
+            backend.connections -= 1
+
+    def _record_(self, backend, failed=False, latency=None):
+        with self._lock_:
+            if failed:
+                backend.unhealthy_until = time.time() + self.cooldown
+            if latency is not None:
+                backend.latency = latency if backend.latency is None else \
+                    self.LATENCY_ALPHA * latency + (1 - self.LATENCY_ALPHA) * backend.latency
+
+    def _handshake_(self, client):
+        """
+        Runs the server side of the socks5 handshake with client.
+
+        Returns:
+            tuple: (country or None, raw address and port of the CONNECT request)
+        """
+        version, nmethods = _recv_exactly(client, 2)
+        if version != SOCKS_VERSION:
+            raise ValueError(f"unsupported socks version {version}")
+        methods = _recv_exactly(client, nmethods)
+
+        country = None
+        if USERNAME_PASSWORD in methods:
+            client.sendall(bytes((SOCKS_VERSION, USERNAME_PASSWORD)))
+            _, ulen = _recv_exactly(client, 2)
+            username = _recv_exactly(client, ulen).decode(errors='replace')
+            plen = _recv_exactly(client, 1)[0]
+            _recv_exactly(client, plen)
+
+            if username:
+                country = country_code(username.split('-', 1)[1] if username.startswith('country-') else username)
+                if country is None:
+                    client.sendall(b'\x01\x01')
+                    raise ValueError(f"unknown country in socks username '{username}'")
+            client.sendall(b'\x01\x00')
+        elif NO_AUTH in methods:
+            client.sendall(bytes((SOCKS_VERSION, NO_AUTH)))
+        else:
+            client.sendall(bytes((SOCKS_VERSION, NO_ACCEPTABLE_METHODS)))
+            raise ValueError("socks client offered no supported authentication method")
+
+        version, cmd, _, atyp = _recv_exactly(client, 4)
+        address = _read_address(client, atyp)
+        if cmd != CONNECT:
+            client.sendall(bytes((SOCKS_VERSION, REPLY_COMMAND_NOT_SUPPORTED, 0, ATYP_IPV4)) + b'\x00' * 6)
+            raise ValueError(f"unsupported socks command {cmd}")
+
+        return country, bytes((atyp,)) + address
+
+    def _connect_backend_(self, backend, address):
+        """
+        Opens a socks5 CONNECT through backend.
+
+        Returns:
+            tuple: (connected socket, reply header of the backend)
+        """
+        auth = backend.auth
+        upstream = socket.create_connection(('127.0.0.1', backend.port), timeout=self.connect_timeout)
+        try:
+            method = USERNAME_PASSWORD if auth else NO_AUTH
+            upstream.sendall(bytes((SOCKS_VERSION, 1, method)))
+            if _recv_exactly(upstream, 2) != bytes((SOCKS_VERSION, method)):
+                raise ConnectionError(f"backend {backend.port} refused the socks handshake")
+            if auth:
+                username, password = (value.encode() for value in auth)
+                upstream.sendall(bytes((1, len(username))) + username + bytes((len(password),)) + password)
+                if _recv_exactly(upstream, 2)[1] != 0:
+                    raise ConnectionError(f"backend {backend.port} refused the socks credentials")
+
+            upstream.sendall(bytes((SOCKS_VERSION, CONNECT, 0)) + address)
+            header = _recv_exactly(upstream, 4)
+            reply = header + _read_address(upstream, header[3])
+        except Exception:
+            upstream.close()
+            raise
+
+        upstream.settimeout(None)
+        return upstream, reply
+
+    def relay(self, client):
+        """
+        Serves one socks5 connection: handshake, backend selection with failover, then relaying both directions.
+        """
+        try:
+            country, address = self._handshake_(client)
+        except (ValueError, ConnectionError, OSError) as e:
+            logging.getLogger(__name__).debug(f"socks handshake failed: {e}")
+            return
+
+        tried = list()
+        upstream = None
+        while upstream is None and len(tried) <= self.retries:
+            backend = self.choose(country, exclude=tried)
+            if backend is None:
+                break
+            tried.append(backend.port)
+
+            start_time = time.time()
+            try:
+                upstream, reply = self._connect_backend_(backend, address)
+            except (OSError, ConnectionError, ValueError) as e:
+                # ValueError: the backend replied with an unknown address type
+                logging.getLogger(__name__).warning(f"socks backend {backend.port} failed: {e}")
+                self._record_(backend, failed=True)
+                self._release_(backend)
+
+        if upstream is None:
+            client.sendall(bytes((SOCKS_VERSION, REPLY_GENERAL_FAILURE, 0, ATYP_IPV4)) + b'\x00' * 6)
+            return
+
+        try:
+            # a failed CONNECT is the exit's answer about the destination, not a sign of an unhealthy backend
+            client.sendall(reply)
+            if reply[1] == REPLY_SUCCEEDED:
+                self._record_(backend, latency=time.time() - start_time)
+                self._pipe_(client, upstream)
+        finally:
+            upstream.close()
+            self._release_(backend)
+
+    @staticmethod
+    def _pipe_(client, upstream):
+        """
+        Copies data both ways until either side closes or fails. The selector is epoll or kqueue where available,
+        so descriptors past FD_SETSIZE work too.
+        """
+        peers = {client: upstream, upstream: client}
+        with selectors.DefaultSelector() as selector:
+            for sock in peers:
+                selector.register(sock, selectors.EVENT_READ)
+
+            try:
+                while True:
+                    for key, _ in selector.select():
+                        data = key.fileobj.recv(65536)
+                        if not data:
+                            return
+                        peers[key.fileobj].sendall(data)
+            except OSError as e:
+                logging.getLogger(__name__).debug(f"socks relay closed: {e}")
+
+    def stats(self):
+        """
+        Returns:
+            dict: socks port -> (connections, latency, healthy)
+        """
+        with self._lock_:
+            return {port: (backend.connections, backend.latency, backend.healthy)
+                    for port, backend in self._backends_.items()}
+
+    def serve_forever(self):
+        self._server_ = _Server((self.host, self.port), _RequestHandler)
+        self._server_.balancer = self
+        logging.getLogger(__name__).info(f"balancing socks connections on {self.host}:{self.port} ({self.policy})")
+
+        try:
+            self._server_.serve_forever()
+        finally:
+            self._server_.server_close()
+
+    def shutdown(self):
+        if self._server_ is not None:
+            self._server_.shutdown()
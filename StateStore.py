@@ -0,0 +1,128 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StateStore:
+    """
+    Versioned sqlite file holding the runtime state of every client (pid, ip_info and, for clients of a shared tor
+    process, its control port and their socks auth), keyed by config file name.
+
+    Every write runs in a single transaction, so a crash in the middle of a write leaves the previous state intact.
+
+    Attributes:
+        path:str:
+            path of the sqlite state file
+    """
+
+    VERSION = 2
+
+    FIELDS = ('config_file_name', 'socks_port', 'control_port', 'pid', 'ip_info', 'shared_control_port', 'socks_auth')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock_ = threading.Lock()
+
+        self._db_ = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db_.execute("PRAGMA journal_mode=WAL")
+        self._db_.execute("PRAGMA synchronous=NORMAL")
+        self._migrate_()
+
+    def _migrate_(self):
+        version = self._db_.execute("PRAGMA user_version").fetchone()[0]
+        if version == self.VERSION:
+            return
+        if version > self.VERSION:
+            raise RuntimeError(f"state file {self.path} has version {version}, newer than supported {self.VERSION}")
+
+        with self._transaction_():
+            if version < 1:
+                self._db_.execute("DROP TABLE IF EXISTS clients")
+                self._db_.execute(
+                    "CREATE TABLE clients ("
+                    "config_file_name TEXT PRIMARY KEY, socks_port INTEGER, control_port INTEGER, pid INTEGER, "
+                    "ip_info TEXT, updated_at REAL)"
+                )
+            if version < 2:
+                self._db_.execute("ALTER TABLE clients ADD COLUMN shared_control_port INTEGER")
+                self._db_.execute("ALTER TABLE clients ADD COLUMN socks_auth TEXT")
+            self._db_.execute(f"PRAGMA user_version={self.VERSION}")
+
+    @contextmanager
+    def _transaction_(self):
+        with self._lock_:
+            self._db_.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db_.execute("ROLLBACK")
+                raise
+            else:
+                self._db_.execute("COMMIT")
+
+    @staticmethod
+    def _row_(client):
+        return (
+            os.path.basename(client.config_file_path),
+            client.socks_port,
+            client.control_port,
+            client.pid,
+            json.dumps(client.ip_info) if client.ip_info is not None else None,
+            client.shared_control_port,
+            json.dumps(client.socks_auth) if client.socks_auth is not None else None,
+            time.time(),
+        )
+
+    def load(self):
+        """
+        Returns:
+            dict: config file name -> dict with keys FIELDS
+        """
+        with self._lock_:
+            rows = self._db_.execute(f"SELECT {', '.join(self.FIELDS)} FROM clients").fetchall()
+
+        state = dict()
+        for row in rows:
+            record = dict(zip(self.FIELDS, row))
+            if record['ip_info'] is not None:
+                record['ip_info'] = json.loads(record['ip_info'])
+            if record['socks_auth'] is not None:
+                record['socks_auth'] = tuple(json.loads(record['socks_auth']))
+            state[record['config_file_name']] = record
+
+        return state
+
+    def save(self, client):
+        """
+        Writes the state of a single client.
+        """
+        self.save_all((client,), replace=False)
+
+    def save_all(self, clients, replace=False):
+        """
+        Writes the state of clients in one transaction.
+
+        Args:
+            clients: iterable of TorConfig
+            replace: bool:
+                drop the state of clients that are not in clients, which loses the pids other processes wrote
+        """
+        rows = [self._row_(client) for client in clients if client.config_file_path is not None]
+        with self._transaction_():
+            if replace:
+                self._db_.execute("DELETE FROM clients")
+            self._db_.executemany(
+                f"INSERT OR REPLACE INTO clients ({', '.join(self.FIELDS)}, updated_at) "
+                f"VALUES ({', '.join('?' * (len(self.FIELDS) + 1))})", rows
+            )
+
+    def delete(self, config_file_name):
+        with self._transaction_():
+            self._db_.execute("DELETE FROM clients WHERE config_file_name = ?", (os.path.basename(config_file_name),))
+
+    def close(self):
+        with self._lock_:
+            self._db_.close()
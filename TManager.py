@@ -1,26 +1,58 @@
 # !/usr/bin/python3
+import functools
 import logging
 import os
 import pickle
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 from prettytable import PrettyTable
 
+from ClientRegistry import ClientRegistry
+from Metrics import CONFIG_LOAD_SECONDS, metrics
+from dir_cache import update_shared_cache
+from LeasePool import LeasePool
+from RenewScheduler import RenewScheduler
+from StateStore import StateStore
 from TorConfig import TorConfig
+from TorLaunch import BOOTSTRAP_TIMEOUT
+from get_port_ip import PROBE_TIMEOUT, get_ports_ip
+from port_allocator import allocate_port_pairs, listening_ports
+from tor_countries import country_code
+
+logger = logging.getLogger(__name__)
 
 
 class TManager:
-    def __init__(self):
+    RECENT_EXIT_TTL = 600  # seconds an exit ip counts as recently used for unique renews
+
+    def __init__(self, configs_dir="/etc/tor", clients_cache_dir=None):
+        """
+        Args:
+            configs_dir: str:
+                directory of the main torrc and the torrc.<number> files of the clients
+            clients_cache_dir: str:
+                directory of the state store, clients_cache_dir next to this file by default
+        """
         self.tor_manager_path = os.path.dirname(__file__)
 
-        self.CLIENTS_CACHE_DIR = os.path.join(os.path.dirname(__file__), "clients_cache_dir")
-        if not os.path.isdir(self.CLIENTS_CACHE_DIR):
-            os.mkdir(self.CLIENTS_CACHE_DIR)
+        self.CLIENTS_CACHE_DIR = clients_cache_dir or os.path.join(os.path.dirname(__file__), "clients_cache_dir")
+        os.makedirs(self.CLIENTS_CACHE_DIR, exist_ok=True)
 
-        self.CONFIGS_DIR = "/etc/tor"
+        self.CONFIGS_DIR = configs_dir
+        self.DIR_CACHE_DIR = None  # optional shared directory cache new clients are seeded from
 
-        self.clients = list()
-        self.load_clients_cache()
+        self.state_store = StateStore(os.path.join(self.CLIENTS_CACHE_DIR, "state.sqlite3"))
+
+        self._saved_ = dict()  # config file name -> client state last read from or written to the state store
+        self.renew_scheduler = RenewScheduler()
+        self.lease_pool = LeasePool(self)
+        self.recent_exit_ips = dict()  # exit ip -> last time a client was seen using it
+
+        self.clients = ClientRegistry()
         self.read_configs()
+        self.load_clients_cache()
 
     def __str__(self):
         return_str = str()
@@ -33,16 +65,14 @@ class TManager:
     def __getitem__(self, item):
         if isinstance(item, int):
             if item > 1000:
-                for client in self.clients:
-                    if int(client.socks_port) == item or int(client.control_port) == item:
-                        return client
+                return self.clients.by_port(item)
             else:
                 return self.clients[item]
 
         elif isinstance(item, str):  # country
-            for client in self.clients:
-                if item in client.exit_nodes:
-                    return client
+            clients = self.clients.by_country(item)
+            if clients:
+                return clients[0]
 
     def __repr__(self):
         return self.__str__()
@@ -69,17 +99,9 @@ class TManager:
 
     def __contains__(self, item):
         if isinstance(item, int):
-            for client in self.clients:
-                if item == int(client.socks_port) or item == int(client.control_port):
-                    return True
-            else:
-                return False
+            return self.clients.by_port(item) is not None
         elif isinstance(item, str):  # country
-            for client in self.clients:
-                if item in client.exit_nodes:
-                    return True
-            else:
-                return False
+            return len(self.clients.by_country(item)) != 0
 
     def __len__(self):
         return len(self.clients)
@@ -88,89 +110,285 @@ class TManager:
         """
         Reads custom and default torrc configurations from tor path and loads them all in clients using CONFIGS_DIR
         """
-        for client in self.clients:
-            if client.config_file_path is None:
-                del client
+        with metrics.timer(CONFIG_LOAD_SECONDS, stage='read_configs'):
+            for client in self.clients:
+                if client.config_file_path is None:
+                    self.clients.remove(client)
+
+            if 'torrc' not in [each for each in os.listdir(self.CONFIGS_DIR) if each == 'torrc']:
+                logger.critical("no default torrc file found in tor configs path")
+
+            for torrc in os.listdir(self.CONFIGS_DIR):
+                # loaded clients only pick up changes, their files are not parsed again while unchanged on disk
+                client = self.clients.by_file_name(torrc)
+                if client is not None:
+                    client.load_conf_dict()
+                    self.clients.reindex(client)
+                    continue
 
-        if 'torrc' not in [each for each in os.listdir(self.CONFIGS_DIR) if each == 'torrc']:
-            logging.critical("no default torrc file found in tor configs path")
+                # Default torrc file
+                if 'torrc' == torrc:
+                    client = TorConfig(os.path.join(self.CONFIGS_DIR, torrc))
+                    client.connection = -1
+                    client.pid = -1
+                    self.clients.append(client)
 
-        for torrc in os.listdir(self.CONFIGS_DIR):
-            # skip loaded clients
-            if torrc in [os.path.basename(client.config_file_path) for client in self.clients if
-                         client.config_file_path is not None]:
-                continue
+                # exclude non-torrc files, including the temporary files of _write_torrc_
+                if not torrc.startswith('torrc.'):
+                    continue
 
-            # Default torrc file
-            if 'torrc' == torrc:
+                # torrc custom files
                 self.clients.append(TorConfig(os.path.join(self.CONFIGS_DIR, torrc)))
-                self.clients[-1].connection = -1
-                self.clients[-1].pid = -1
-
-            # exclude non-torrc files
-            if 'torrc.' not in torrc:
-                continue
 
-            # torrc custom files
-            self.clients.append(TorConfig(os.path.join(self.CONFIGS_DIR, torrc)))
+    @staticmethod
+    def _pid_alive(pid):
+        if pid is None or pid == -1:
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
 
     def load_clients_cache(self):
         """
-        Unpickles tor clients from CLIENTS_CACHE_DIR and loads them into clients.
+        Loads pids and ip_info of the clients in clients from the state store in CLIENTS_CACHE_DIR.
+        Client pickles left by older versions are migrated into the state store and removed.
         """
+        state = self.state_store.load()
+        self._saved_ = {config_file_name: self._state_of_(record) for config_file_name, record in state.items()}
+
+        legacy_clients = list()
         for client in os.listdir(self.CLIENTS_CACHE_DIR):
-            if 'client.' in client:
+            if client.startswith('client.'):
                 with open(os.path.join(self.CLIENTS_CACHE_DIR, client), 'rb') as fp:
                     client_obj = pickle.load(fp)
+                legacy_clients.append((client, client_obj))
+
+                state[os.path.basename(client_obj.config_file_path)] = {
+                    'pid': client_obj.pid, 'ip_info': client_obj.ip_info, 'shared_control_port': None,
+                    'socks_auth': None
+                }
+
+        shared_groups = dict()  # (pid, shared control port) -> clients of that shared tor process
+        for config_file_name, record in state.items():
+            client = self.clients.by_file_name(config_file_name)
+            if client is None:
+                if record['pid'] not in (None, -1):
+                    logger.warning(f"config {config_file_name} of running tor process[pid={record['pid']}] is gone")
+                continue
 
-                # remove config file after loading it
+            if client.pid == -1:
+                # default torrc, run by the system tor service
+                continue
+
+            if self._pid_alive(record['pid']):
+                client.pid = record['pid']
+                client.ip_info = record['ip_info']
+                if record['shared_control_port'] is not None and record['pid'] is not None:
+                    client.shared_control_port = record['shared_control_port']
+                    client.socks_auth = record['socks_auth']
+                    client.shared_group = shared_groups.setdefault((client.pid, client.shared_control_port), list())
+                    client.shared_group.append(client)
+            else:
+                client.pid = None
+                client.ip_info = None
+            self.clients.reindex(client)
+
+        if legacy_clients:
+            self.write_running_clients_configs()
+            for client, _ in legacy_clients:
                 os.remove(os.path.join(self.CLIENTS_CACHE_DIR, client))
 
-                for cli in self.clients:
-                    if client_obj == cli.socks_port:
-                        cli.custom_init({
-                            attr: getattr(client_obj, attr)
-                            for attr in dir(client_obj) if attr[0] != '_' and attr[-1] != '_'
-                        })
-                else:
-                    self.clients.append(client_obj)
+    @staticmethod
+    def _state_of_(client):
+        """
+        Args:
+            client: TorConfig or a state store record
+
+        Returns:
+            tuple: the runtime state the state store keeps of client
+        """
+        if isinstance(client, dict):
+            return client['pid'], client['ip_info'], client['shared_control_port'], client['socks_auth']
+        return client.pid, client.ip_info, client.shared_control_port, client.socks_auth
 
     def write_running_client_config(self, client):
         """
-        Unpickle the given client
+        Writes the state of the given client to the state store
         Args:
             client: TorConfig
         """
-        with open(os.path.join(self.CLIENTS_CACHE_DIR, f'client.{client.socks_port}')) as fp:
-            pickle.dump(client, fp)
+        self.state_store.save(client)
+        self._saved_[os.path.basename(client.config_file_path)] = self._state_of_(client)
 
     def write_running_clients_configs(self):
         """
-        Writes the running clients from clients to the client pickled files
+        Writes the state of the clients that changed since it was loaded or last written, in a single transaction.
+        Rows of unchanged clients are left alone, so runs that overlap don't overwrite each other's pids with the
+        stale state they loaded at startup.
         """
-        for client in self.clients:
-            with open(os.path.join(self.CLIENTS_CACHE_DIR, f'client.{client.socks_port}'), 'wb') as fp:
-                pickle.dump(client, fp)
+        unchanged = (None, None, None, None)
+        changed = [client for client in self.clients if client.config_file_path is not None and
+                   self._state_of_(client) != self._saved_.get(os.path.basename(client.config_file_path), unchanged)]
+        if not changed:
+            return
+
+        self.state_store.save_all(changed, replace=False)
+        for client in changed:
+            self._saved_[os.path.basename(client.config_file_path)] = self._state_of_(client)
 
-    def renew_connection(self, **kwargs):
+    def renew_connection(self, probe=True, **kwargs):
         """
-        Restarts connection using stem.control.Controller
+        Renews the matching clients through renew_scheduler and waits until tor applied their NEWNYM,
+        clients which are not running are started instead
+
+        Args:
+            probe: bool:
+                fetch the new ip_info of the renewed clients
+
+        Keyword Args:
+            port: int
+            country: str
         """
-        for client in self.clients:
+        futures = list()
+        for client in self.clients.find(**kwargs):
             if client.pid is not None:
-                if 'port' in kwargs:
-                    if client.socks_port == kwargs['port']:
-                        client.renew_ip()
-                if 'country' in kwargs:
-                    if kwargs['country'] in client.exit_nodes:
-                        client.renew_ip()
+                futures.append(self.renew_scheduler.request(client, probe=probe))
             else:
                 self.start_connection(port=client.socks_port)
 
-    def renew_all_connections(self):
-        for client in self.clients:
-            if client.pid is not None:
-                client.renew_ip()
+        wait(futures)
+        for client in self.clients.find(**kwargs):
+            self.clients.reindex(client)
+
+    def acquire(self, country=None, port=None, timeout=None):
+        """
+        Leases a running client exclusively until the lease is released, which renews it, see LeasePool.
+
+        Args:
+            country: str: country code or name the client exits in
+            port: int: socks or control port of the client
+            timeout: float: seconds to wait for a free client, forever if None
+
+        Returns:
+            Lease: context manager with the client's socks_port, proxy url and a pooled session
+
+        Raises:
+            TimeoutError: if no matching client was free within timeout
+        """
+        return self.lease_pool.acquire(country=country, port=port, timeout=timeout)
+
+    async def acquire_async(self, country=None, port=None, timeout=None):
+        """
+        acquire for asyncio, waits without blocking the event loop
+
+        Returns:
+            Lease: async context manager
+        """
+        return await self.lease_pool.acquire_async(country=country, port=port, timeout=timeout)
+
+    def renew_all_connections(self, probe=True, unique=False, retries=3):
+        """
+        Renews every running client through renew_scheduler, which sends each NEWNYM as soon as tor accepts it.
+
+        Args:
+            probe: bool:
+                probe the new ip_info of the whole fleet concurrently afterwards
+            unique: bool:
+                re-roll clients until every client has its own exit ip which was not used recently, see
+                ensure_unique_exits
+            retries: int:
+                re-rolls each client gets when unique
+
+        Returns:
+            dict: socks port -> Exception, for the clients whose renew failed
+        """
+        running = [client for client in self.clients if client.pid is not None]
+        self._remember_exit_ips_(running)
+        futures = {self.renew_scheduler.request(client): client for client in running}
+        wait(futures)
+
+        failed = dict()
+        for future, client in futures.items():
+            if future.exception() is not None:
+                failed[client.socks_port] = future.exception()
+            self.clients.reindex(client)
+
+        if probe or unique:
+            self.probe_running_clients(missing_only=True)
+        if unique:
+            self.ensure_unique_exits(retries=retries)
+
+        return failed
+
+    def _remember_exit_ips_(self, clients):
+        now = time.time()
+        for client in clients:
+            if client.ip_info is not None and client.ip_info.get('ip'):
+                self.recent_exit_ips[client.ip_info['ip']] = now
+
+        for ip, seen in list(self.recent_exit_ips.items()):
+            if now - seen > self.RECENT_EXIT_TTL:
+                del self.recent_exit_ips[ip]
+
+    def ensure_unique_exits(self, retries=3):
+        """
+        Re-rolls running clients whose exit ip is shared with another client or was used recently (before the last
+        renew), until every client has a distinct fresh exit or ran out of retries.
+        The ip_info the clients already have is used, only re-rolled clients are probed again.
+
+        Args:
+            retries: int:
+                re-rolls each client gets
+
+        Returns:
+            dict: keys: 'clients' (running clients with ip_info), 'distinct' (distinct exit ips among them),
+                  'rerolled' (NEWNYMs sent)
+        """
+        running = [client for client in self.clients if client.pid is not None]
+        missing = [client for client in running if client.ip_info is None]
+        if missing:
+            self.probe_running_clients(refresh=False, missing_only=True)
+
+        # ips in use before this round of renews, the current exits of the fleet are not in it yet
+        recent = set(self.recent_exit_ips)
+        attempts = {id(client): 0 for client in running}
+        rerolled = 0
+
+        while True:
+            owners = dict()  # exit ip -> first client using it
+            colliding = list()
+            for client in running:
+                ip = client.ip_info.get('ip') if client.ip_info is not None else None
+                if ip is None:
+                    continue
+                if ip in owners or ip in recent:
+                    if attempts[id(client)] < retries:
+                        colliding.append(client)
+                else:
+                    owners[ip] = client
+
+            if not colliding:
+                break
+
+            futures = list()
+            for client in colliding:
+                attempts[id(client)] += 1
+                futures.append(self.renew_scheduler.request(client, probe=True))
+            wait(futures)
+            rerolled += len(futures)
+
+        for client in running:
+            self.clients.reindex(client)
+
+        ips = [client.ip_info['ip'] for client in running if client.ip_info is not None and client.ip_info.get('ip')]
+        summary = {'clients': len(ips), 'distinct': len(set(ips)), 'rerolled': rerolled}
+        logger.info(f"unique exits: {summary['distinct']} distinct ips over {summary['clients']} clients "
+                    f"after {rerolled} re-rolls")
+        return summary
 
     def kill_tor_connection(self, **kwargs):
         """
@@ -181,25 +399,24 @@ class TManager:
                 Keyword Args:
                     pid: finds the client with the same pid
                     port: finds the client with the same socks port
+                    country: finds every client with the country in its exit nodes
 
         """
-        for client in self.clients:
-            if client.connection is not None:
-                if 'pid' in kwargs:
-                    if client.pid == kwargs['pid']:
-                        client.kill_connection()
-                        self.write_running_client_config(client)
-                        del client
-                        break
-
-                elif 'port' in kwargs:
-                    if client.socks_port == kwargs['port']:
-                        client.kill_connection()
-                        self.write_running_client_config(client)
-                        del client
-                        break
-                else:
-                    raise OSError("you have to specify pid or port")
+        if 'pid' in kwargs:
+            clients = [self.clients.by_pid(kwargs['pid'])]
+        elif 'port' in kwargs:
+            clients = [self.clients.by_port(kwargs['port'])]
+        elif 'country' in kwargs:
+            # the system tor service is shared with the rest of the host, like in kill_all_connections it keeps running
+            clients = [client for client in self.clients.by_country(kwargs['country']) if client.connection != -1]
+        else:
+            raise OSError("you have to specify pid, port or country")
+
+        for client in clients:
+            if client is not None and client.connection is not None:
+                client.kill_connection()
+                self.clients.reindex(client)
+                self.write_running_client_config(client)
 
     def get_ip_info(self, **kwargs):
         """
@@ -211,37 +428,166 @@ class TManager:
         Returns:
             ip_info of client
         """
-        for client in self.clients:
-            if 'port' in kwargs:
-                if client.socks_port == kwargs['port']:
-                    return client.ip_info
-            if 'country' in kwargs:
-                if kwargs['country'] in client.exit_nodes:
-                    return client.ip_info
+        clients = self.clients.find(**kwargs)
+        if clients:
+            client = clients[0]
+            if client.ip_info is None and client.pid is not None:
+                client.get_tor_ip_dict()
+            return client.ip_info
+
+    def seed_sources(self):
+        """
+        Refreshes DIR_CACHE_DIR, if set, from the running clients.
+
+        Returns:
+            list of directories a new client's directory cache can be seeded from, freshest picked at seeding
+        """
+        sources = [client.data_directory for client in self.clients
+                   if client.pid is not None and client.data_directory is not None]
+
+        if self.DIR_CACHE_DIR is not None:
+            update_shared_cache(self.DIR_CACHE_DIR, sources)
+            sources.append(self.DIR_CACHE_DIR)
+
+        return sources
 
-    def start_connection(self, **kwargs):
+    def start_connection(self, warm_start=False, timeout=BOOTSTRAP_TIMEOUT, **kwargs):
         """
         Starts connection
         Args:
+            warm_start: bool:
+                seed the client's directory cache from a running client or DIR_CACHE_DIR before launching
+            timeout: int:
+                seconds each client is given to bootstrap before it is killed and the launch fails, no timeout if None
             **kwargs:
                 port: int
                 country: str
 
         """
-        for client in self.clients:
-            if 'port' in kwargs:
-                if client.socks_port == kwargs['port']:
-                    client.create_connection_from_config()
-            if 'country' in kwargs:
-                if kwargs['country'] in client.exit_nodes:
-                    client.create_connection_from_config()
+        seed_from = self.seed_sources() if warm_start else None
+        for client in self.clients.find(**kwargs):
+            client.create_connection_from_config(timeout=timeout, seed_from=seed_from)
+            self.clients.reindex(client)
+
+    def start_all_connections(self, max_workers=1, timeout=BOOTSTRAP_TIMEOUT, warm_start=False, on_progress=None):
+        """
+        Start connections for all configs which are not started from tor config path.
+        Clients are launched without blocking (see TorConfig.launch), at most max_workers bootstrapping at a time,
+        and the started ones are probed together at the end.
+
+        Args:
+            max_workers: int:
+                number of clients bootstrapping concurrently, 1 launches them one after another.
+            timeout: int:
+                seconds each client is given to bootstrap before it is killed and reported as failed, no timeout if
+                None.
+            warm_start: bool:
+                seed each client's directory cache from a running client or DIR_CACHE_DIR before launching
+            on_progress: callable(client, percent, summary):
+                called with every bootstrap step of every client, from the launches' reader threads
+
+        Returns:
+            dict: keys: 'started' (list of socks ports), 'failed' (dict of socks port to error message)
+        """
+        pending = deque(self._pending_clients_())
+        summary = {'started': list(), 'failed': dict()}
+        if not pending:
+            return summary
+
+        seed_from = self.seed_sources() if warm_start else None
+
+        def failed(client, error):
+            summary['failed'][client.socks_port] = str(error)
+            logger.error(f"starting client {client.socks_port} from "
+                         f"{os.path.basename(client.config_file_path)} failed: {error}")
+
+        launches = dict()  # future of the launch -> client
+        while pending or launches:
+            while pending and len(launches) < max(1, int(max_workers)):
+                client = pending.popleft()
+                progress = functools.partial(on_progress, client) if on_progress is not None else None
+                try:
+                    launches[client.launch(timeout=timeout, seed_from=seed_from, on_progress=progress).future] = client
+                except Exception as e:
+                    failed(client, e)
+
+            if not launches:
+                break
+
+            done, _ = wait(launches, return_when=FIRST_COMPLETED)
+            for future in done:
+                client = launches.pop(future)
+                if future.cancelled():
+                    failed(client, "launch cancelled")
+                elif future.exception() is not None:
+                    failed(client, future.exception())
+                else:
+                    summary['started'].append(client.socks_port)
+                self.clients.reindex(client)
+
+        if summary['started']:
+            self.probe_running_clients(refresh=False, missing_only=True)
+        return summary
+
+    def start_shared_connections(self, max_workers=1, timeout=BOOTSTRAP_TIMEOUT, warm_start=False):
+        """
+        Starts the configs which are not started yet with one tor process per distinct ExitNodes, each process
+        serving the SocksPorts of all configs with those ExitNodes, see TorConfig.create_shared_connection.
+        The process runs from the config with the lowest socks port of its group, with that config's ControlPort and
+        DataDirectory.
 
-    def start_all_connections(self):
+        Args:
+            max_workers, timeout, warm_start: see start_all_connections
+
+        Returns:
+            dict: keys: 'started' (list of socks ports), 'failed' (dict of socks port to error message)
+        """
+        groups = dict()  # exit nodes -> clients
+        for client in self._pending_clients_():
+            groups.setdefault(tuple(sorted(client.exit_nodes or ())), list()).append(client)
+        groups = [sorted(group, key=lambda each: each.socks_port) for group in groups.values()]
+
+        summary = {'started': list(), 'failed': dict()}
+        if not groups:
+            return summary
+
+        seed_from = self.seed_sources() if warm_start else None
+
+        def launch(group):
+            if len(group) == 1:
+                group[0].create_connection_from_config(timeout=timeout, seed_from=seed_from)
+            else:
+                group[0].create_shared_connection(group, timeout=timeout, seed_from=seed_from)
+
+        with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+            futures = {executor.submit(launch, group): group for group in groups}
+
+            for future in as_completed(futures):
+                group = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    for client in group:
+                        summary['failed'][client.socks_port] = str(e)
+                    logger.error(f"starting shared tor process for clients "
+                                 f"{[client.socks_port for client in group]} failed: {e}")
+                else:
+                    summary['started'].extend(client.socks_port for client in group)
+                finally:
+                    for client in group:
+                        self.clients.reindex(client)
+
+        self.probe_running_clients(refresh=True, timeout=timeout or PROBE_TIMEOUT, missing_only=True)
+        return summary
+
+    def _pending_clients_(self):
         """
-        Start connections for all configs which are not started from tor config path
+        Returns:
+            list of clients with a torrc of their own which are not running
         """
+        pending = list()
         for client in self.clients:
-            if client.config_file_path == '/etc/tor/torrc':
+            if client.config_file_path == os.path.join(self.CONFIGS_DIR, 'torrc'):
                 # client.renew_ip()
                 pass
             else:
@@ -251,13 +597,35 @@ class TManager:
                     # client.renew_ip()
                     pass
                 else:
-                    client.create_connection_from_config()
+                    pending.append(client)
+
+        return pending
+
+    def output_start_summary(self, summary):
+        """
+        print the outcome of start_all_connections with prettyTable
+        """
+        table = PrettyTable()
+        table.field_names = ["port", "status", "error"]
+        table.align['port'] = 'r'
+        table.align['status'] = 'l'
+        table.align['error'] = 'l'
+
+        for port in sorted(summary['started']):
+            table.add_row((port, 'started', ''))
+        for port, error in sorted(summary['failed'].items()):
+            table.add_row((port, 'failed', error))
+
+        print(f"tor clients startup: {len(summary['started'])} started, {len(summary['failed'])} failed")
+        print(table)
 
     def kill_all_connections(self):
         """
-        kills all running processes
+        kills all running processes, except the system tor service of the main torrc
         """
         for client in self.clients:
+            if client.connection == -1:
+                continue
             self.kill_tor_connection(port=f'{client.socks_port}')
 
     def output_configs(self):
@@ -302,10 +670,77 @@ class TManager:
         print("tor configs table")
         print(table)
 
-    def output_running_clients(self):
+    def probe_running_clients(self, refresh=True, timeout=PROBE_TIMEOUT, missing_only=False, verify=False):
+        """
+        Resolves ip_info of all running clients through their control ports concurrently and stores it on each
+        client, the clients that can't be resolved locally within timeout are probed over their socks ports
+        concurrently.
+
+        Args:
+            refresh: bool:
+                ignore ip_info cached by get_port_ip
+            timeout: int:
+                seconds each client may take
+            missing_only: bool:
+                only probe clients which have no ip_info yet
+            verify: bool:
+                probe every client over its socks port, see TorConfig.get_tor_ip_dict
+
+        Returns:
+            dict: socks port -> Exception, for the clients whose probe failed
+        """
+        running = {client.socks_port: client for client in self.clients
+                   if client.pid is not None and client.socks_port is not None
+                   and not (missing_only and client.ip_info is not None)}
+
+        if not verify and running:
+            executor = ThreadPoolExecutor(max_workers=len(running))
+            try:
+                futures = {executor.submit(client.get_exit_info): port for port, client in running.items()}
+                # a wedged control port must not stall the others, its client is probed over socks instead
+                done, not_done = wait(futures, timeout=timeout)
+
+                for future in done:
+                    port = futures[future]
+                    try:
+                        running[port].ip_info = future.result()
+                    except Exception as e:
+                        logger.debug(f"resolving exit of client {port} locally failed: {e}")
+                    else:
+                        del running[port]
+                for future in not_done:
+                    future.cancel()
+                    logger.debug(f"resolving exit of client {futures[future]} locally timed out")
+            finally:
+                executor.shutdown(wait=False)
+
+        auths = {port: client.socks_auth for port, client in running.items() if client.socks_auth is not None}
+
+        failed = dict()
+        for port, ip_info in get_ports_ip(running.keys(), refresh=refresh, timeout=timeout, auths=auths).items():
+            if isinstance(ip_info, Exception):
+                failed[port] = ip_info
+                logger.error(f"probing ip of client {port} failed: {ip_info}")
+            else:
+                running[port].ip_info = ip_info
+
+        return failed
+
+    def output_running_clients(self, refresh=False, timeout=PROBE_TIMEOUT, verify=False):
         """
         print the contents of running processes with prettyTable
+
+        Args:
+            refresh: bool:
+                probe the ip_info of all running clients concurrently before printing, otherwise only the
+                clients without ip_info are probed
+            timeout: int:
+                seconds each client may take when probing
+            verify: bool:
+                probe over the socks ports instead of resolving exits through the control ports
         """
+        self.probe_running_clients(refresh=refresh, timeout=timeout, missing_only=not refresh, verify=verify)
+
         table = PrettyTable()
         table.field_names = ["pid", "port", "ip", "country", "region", "city"]
         table.align['pid'] = 'r'
@@ -320,15 +755,56 @@ class TManager:
                 table.add_row(
                     (client.pid,
                      client.socks_port,
-                     client.ip_info['ip'],
-                     client.ip_info["country"],
-                     client.ip_info['region'],
-                     client.ip_info['city'])
+                     client.ip_info.get('ip'),
+                     client.ip_info.get("country"),
+                     client.ip_info.get('region'),
+                     client.ip_info.get('city'))
                 )
 
         print("tor running clients table")
         print(table)
 
+    def _torrc_numbers_(self):
+        return {int(torrc[len('torrc.'):]) for torrc in os.listdir(self.CONFIGS_DIR)
+                if torrc.startswith('torrc.') and torrc[len('torrc.'):].isdecimal()}
+
+    def _taken_ports_(self):
+        taken = set()
+        for client in self.clients:
+            taken.update(port for port in (client.socks_port, client.control_port) if port is not None)
+        return taken
+
+    def _write_torrc_(self, number, port, data_directory, countries=None):
+        """
+        Atomically writes CONFIGS_DIR/torrc.<number>, so tor or a concurrent read_configs never sees half a file.
+
+        Returns:
+            path of the written torrc
+        """
+        file_data = f'SocksPort {port}\n'
+        file_data += f'ControlPort {port + 1}\n'
+        file_data += f'DataDirectory {data_directory}\n'
+
+        if countries:
+            codes = list()
+            for country in countries:
+                code = country_code(country)
+                if code is None:
+                    raise ValueError(f"'{country}' is not a tor country")
+                if code not in codes:
+                    codes.append(code)
+            file_data += 'ExitNodes %s\n' % ','.join("{%s}" % code for code in codes)
+
+        path = os.path.join(self.CONFIGS_DIR, f'torrc.{number}')
+        temp_path = os.path.join(self.CONFIGS_DIR, f'.torrc.{number}.tmp')
+        with open(temp_path, 'w') as fp:
+            fp.write(file_data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, path)
+
+        return path
+
     def create_torrc_config(self, **kwargs):
         """
         Create a new torrc config file in CONFIGS_DIR
@@ -336,42 +812,66 @@ class TManager:
             port: int
             data-directory: str
             countries: list
+
+        Returns:
+            the new client, False if no port was given
         """
-        max_num = 0
-        for torrc in os.listdir(self.CONFIGS_DIR):
-            # exclude non-torrc files
-            if 'torrc.' not in torrc:
-                continue
+        if 'port' not in kwargs:
+            return False
+        port = int(kwargs['port'])
 
-            # torrc custom files
-            max_num = max(max_num, int(torrc[torrc.find('.') + 1:]))
+        busy = {port, port + 1} & (self._taken_ports_() | listening_ports())
+        if busy:
+            raise OSError(f"ports {sorted(busy)} are already used by a config or a listening socket")
 
-        file_data = str()
-        if 'port' in kwargs:
-            file_data += f'SocksPort {kwargs["port"]}\n'
-            file_data += f'ControlPort {kwargs["port"] + 1}\n'
-        else:
-            return False
+        number = max(self._torrc_numbers_(), default=0) + 1
 
         if 'data-directory' in kwargs:
-            file_data += f'DataDirectory {os.path.abspath(kwargs["data-directory"])}\n'
+            data_directory = os.path.abspath(kwargs['data-directory'])
         else:
-            path = os.path.join('/var/lib', f'tor{int(max_num + 1)}')
-            os.mkdir(path)
-            file_data += f'DataDirectory {path}'
+            data_directory = os.path.join('/var/lib', f'tor{number}')
+        os.makedirs(data_directory, mode=0o700, exist_ok=True)
 
-        if 'countries' in kwargs:
-            exit_nodes = str()
-            for country in kwargs['countries']:
-                if country not in exit_nodes.split()[0]:
-                    exit_nodes += ', '
+        client = TorConfig(self._write_torrc_(number, port, data_directory, kwargs.get('countries')))
+        self.clients.append(client)
+        return client
 
-                exit_nodes += "{%s}" % country
+    def provision_torrc_configs(self, count, countries=None, start_port=9060, data_directories_dir='/var/lib'):
+        """
+        Creates count torrc configs in one pass, spreading them round-robin over countries. Port pairs are
+        allocated free of both the loaded configs and the kernel's listening sockets.
 
-            file_data += f'ExitNodes {exit_nodes}\n'
+        Args:
+            count: int: number of configs
+            countries: list: one country per config, in turn; no ExitNodes if empty
+            start_port: int: lowest socks port to allocate
+            data_directories_dir: str: where the tor<number> data directories are created
 
-        with open(os.path.join(self.CONFIGS_DIR, f'torrc.{max_num + 1}'), 'w') as fp:
-            fp.write(file_data)
+        Returns:
+            list of the new clients
+        """
+        countries = list(countries or list())
+        for country in countries:
+            if country_code(country) is None:
+                raise ValueError(f"'{country}' is not a tor country")
+
+        pairs = allocate_port_pairs(count, self._taken_ports_(), start=start_port)
+        first_number = max(self._torrc_numbers_(), default=0) + 1
+
+        created = list()
+        for index, (port, _) in enumerate(pairs):
+            number = first_number + index
+            data_directory = os.path.join(data_directories_dir, f'tor{number}')
+            os.makedirs(data_directory, mode=0o700, exist_ok=True)
+
+            country = [countries[index % len(countries)]] if countries else None
+            client = TorConfig(self._write_torrc_(number, port, data_directory, country))
+            self.clients.append(client)
+            created.append(client)
+
+        logger.info(f"provisioned {len(created)} torrc configs, socks ports {pairs[0][0]}-{pairs[-1][0]}"
+                    if created else "provisioned no torrc configs")
+        return created
 
     def delete_torrc_config(self, **kwargs):
         """
@@ -381,15 +881,12 @@ class TManager:
             data-directory: str
             countries: list
         """
-        for client in self.clients:
-            if 'port' in kwargs:
-                if kwargs['port'] == client.socks_port:
-                    os.remove(client.config_file_path)
-                    del client
-                    break
-            if 'country' in kwargs:
-                if kwargs['country'] in client.exit_nodes:
-                    os.remove(client.config_file_path)
-                    os.remove(os.path.join(self.CLIENTS_CACHE_DIR, f'client.{client.socks_port}'))
-                    del client
-                    break
+        clients = self.clients.find(**kwargs)
+        if not clients:
+            return
+
+        client = clients[0]
+        os.remove(client.config_file_path)
+        self.state_store.delete(client.config_file_path)
+        self._saved_.pop(os.path.basename(client.config_file_path), None)
+        self.clients.remove(client)
@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from TorLaunch import BOOTSTRAP_TIMEOUT
+
+SOCKET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clients_cache_dir", "tmanager.sock")
+
+
+def client_record(client):
+    """
+    Returns:
+        dict: the json serializable fields of client the daemon answers with
+    """
+    return {
+        'file_name': os.path.basename(client.config_file_path) if client.config_file_path else None,
+        'socks_port': client.socks_port,
+        'control_port': client.control_port,
+        'exit_nodes': client.exit_nodes,
+        'pid': client.pid,
+        'ip_info': client.ip_info,
+        'proxy': client.proxy_url() if client.socks_port is not None else None,
+    }
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = {'ok': True, 'result': self.server.daemon.handle(request)}
+            except Exception as e:
+                response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TManagerDaemon:
+    """
+    Keeps a TManager, its pooled controllers and ip caches in memory and serves it over a unix socket.
+
+    Each request and response is one line of json. A request looks like {"command": "renew", "port": 9060}, the
+    response like {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+
+    Commands:
+        start: port or country, every config without a connection if neither is given, with shared one tor
+            process per distinct ExitNodes; each client is given timeout seconds to bootstrap, BOOTSTRAP_TIMEOUT if
+            not given
+        stop: port, pid or country, every client if none of them is given
+        renew: port or country, the whole fleet if neither is given, with unique until the exits are distinct
+        status: port or country, records of the matching clients, probing the ones without ip_info
+        list: records of all clients, with probe the running ones without ip_info (all with refresh) are probed,
+            through their control ports unless verify
+        reload: re-reads CONFIGS_DIR after torrc files were created or deleted
+        shutdown: stops the daemon
+
+    With supervise, running clients are watched by a HealthSupervisor, which is synced after every command
+    that changes the fleet. With rank_interval, an ExitRanker narrows the ExitNodes of per-country clients to their
+    countries' fastest exits every rank_interval seconds, and after every command that changes the fleet. With
+    metrics_port, timing histograms and per client bandwidth counters are served for prometheus on that port. With
+    registry_path, the fleet is published to a FleetRegistry there after every command and every publish_interval
+    seconds, for processes that pick proxies without asking the daemon.
+    """
+
+    def __init__(self, tmanager=None, socket_path=SOCKET_PATH, supervise=False, rank_interval=None,
+                 metrics_port=None, registry_path=None, publish_interval=5):
+        if tmanager is None:
+            from TManager import TManager
+            tmanager = TManager()
+
+        self.tmanager = tmanager
+        self.socket_path = socket_path
+
+        self._lock_ = threading.RLock()  # serializes commands that change the fleet
+        self._server_ = None
+
+        self.supervisor = None
+        if supervise:
+            from HealthSupervisor import HealthSupervisor
+            self.supervisor = HealthSupervisor(self.tmanager)
+
+        self.ranker = None
+        if rank_interval:
+            from ExitRanker import ExitRanker
+            self.ranker = ExitRanker(self.tmanager, interval=rank_interval)
+
+        self.metrics_server = None
+        self.bandwidth_monitor = None
+        if metrics_port:
+            from BandwidthMonitor import BandwidthMonitor
+            from Metrics import MetricsServer
+            self.metrics_server = MetricsServer(port=metrics_port)
+            self.bandwidth_monitor = BandwidthMonitor(self.tmanager)
+
+        self.registry = None
+        self.publish_interval = publish_interval
+        self._stopped_ = threading.Event()
+        if registry_path:
+            from FleetRegistry import FleetRegistry
+            self.registry = FleetRegistry(registry_path)
+
+    @staticmethod
+    def _selector_(request, keys):
+        return {key: request[key] for key in keys if request.get(key) not in (None, False)}
+
+    def handle(self, request):
+        """
+        Runs a single request against the managed TManager.
+
+        Returns:
+            the json serializable result of the command
+        """
+        command = request.get('command')
+        tm = self.tmanager
+
+        if command == 'list':
+            if request.get('probe') or request.get('refresh'):
+                refresh = bool(request.get('refresh'))
+                tm.probe_running_clients(refresh=refresh, missing_only=not refresh,
+                                         verify=bool(request.get('verify')))
+            return [client_record(client) for client in tm.clients]
+
+        if command == 'status':
+            selector = self._selector_(request, ('port', 'country'))
+            if not selector:
+                return [client_record(client) for client in tm.clients]
+            tm.get_ip_info(**selector)
+            return [client_record(client) for client in tm.clients.find(**selector)]
+
+        if command == 'shutdown':
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return None
+
+        with self._lock_:
+            if command == 'start':
+                selector = self._selector_(request, ('port', 'country'))
+                warm_start = bool(request.get('warm_start'))
+                # a launch that never bootstraps must not hold _lock_ forever
+                timeout = request.get('timeout') or BOOTSTRAP_TIMEOUT
+                if selector:
+                    tm.start_connection(warm_start=warm_start, timeout=timeout, **selector)
+                    result = [client_record(client) for client in tm.clients.find(**selector)]
+                else:
+                    start = tm.start_shared_connections if request.get('shared') else tm.start_all_connections
+                    result = start(max_workers=request.get('max_workers', 1), timeout=timeout, warm_start=warm_start)
+
+            elif command == 'stop':
+                selector = self._selector_(request, ('port', 'pid', 'country'))
+                if selector:
+                    tm.kill_tor_connection(**selector)
+                elif set(request) - {'command'}:
+                    # a selector that matches nothing must not stop the whole fleet
+                    raise ValueError(f"stop selects clients by port, pid or country, got {request}")
+                else:
+                    tm.kill_all_connections()
+                result = None
+
+            elif command == 'renew':
+                selector = self._selector_(request, ('port', 'country'))
+                if selector:
+                    tm.renew_connection(**selector)
+                    result = [client_record(client) for client in tm.clients.find(**selector)]
+                elif request.get('unique'):
+                    tm.renew_all_connections(probe=False)
+                    result = {'unique': tm.ensure_unique_exits(retries=request.get('retries', 3)),
+                              'clients': [client_record(client) for client in tm.clients if client.pid is not None]}
+                else:
+                    tm.renew_all_connections()
+                    result = [client_record(client) for client in tm.clients if client.pid is not None]
+
+            elif command == 'reload':
+                tm.read_configs()
+                for client in tm.clients:
+                    if client.config_file_path is not None and not os.path.isfile(client.config_file_path):
+                        tm.clients.remove(client)
+                result = len(tm.clients)
+
+            else:
+                raise ValueError(f"unknown command {command}")
+
+            tm.write_running_clients_configs()
+            if self.supervisor is not None:
+                self.supervisor.sync()
+            if self.ranker is not None:
+                self.ranker.apply()
+            if self.bandwidth_monitor is not None:
+                self.bandwidth_monitor.sync()
+            if self.registry is not None:
+                self.registry.publish(tm.clients)
+            return result
+
+    def _publish_(self):
+        # renews, restarts and probes change the fleet between commands too
+        while not self._stopped_.wait(self.publish_interval):
+            try:
+                self.registry.publish(self.tmanager.clients)
+            except Exception as e:
+                logging.getLogger(__name__).error(f"publishing the fleet registry failed: {e}")
+
+    def serve_forever(self):
+        """
+        Binds socket_path and serves requests until shutdown is called.
+        """
+        if os.path.exists(self.socket_path):
+            if daemon_running(self.socket_path):
+                raise OSError(f"a daemon is already listening on {self.socket_path}")
+            os.remove(self.socket_path)
+
+        self._server_ = _Server(self.socket_path, _RequestHandler)
+        self._server_.daemon = self
+        os.chmod(self.socket_path, 0o600)
+        logging.getLogger(__name__).info(f"serving {len(self.tmanager)} clients on {self.socket_path}")
+
+        if self.supervisor is not None:
+            self.supervisor.sync()
+        if self.ranker is not None:
+            self.ranker.start()
+        if self.metrics_server is not None:
+            threading.Thread(target=self.metrics_server.serve_forever, daemon=True).start()
+            self.bandwidth_monitor.sync()
+        if self.registry is not None:
+            self._stopped_.clear()
+            self.registry.publish(self.tmanager.clients)
+            threading.Thread(target=self._publish_, daemon=True).start()
+
+        try:
+            self._server_.serve_forever()
+        finally:
+            if self.supervisor is not None:
+                self.supervisor.stop()
+            if self.ranker is not None:
+                self.ranker.stop()
+            if self.metrics_server is not None:
+                self.metrics_server.shutdown()
+                self.bandwidth_monitor.stop()
+            if self.registry is not None:
+                self._stopped_.set()
+                self.registry.close()
+            self._server_.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            with self._lock_:
+                self.tmanager.write_running_clients_configs()
+
+    def shutdown(self):
+        if self._server_ is not None:
+            self._server_.shutdown()
+
+
+def send_command(command, socket_path=SOCKET_PATH, socket_timeout=None, **kwargs):
+    """
+    Sends a command to a running daemon.
+
+    Args:
+        command: str: see TManagerDaemon
+        socket_path: str: socket the daemon listens on
+        socket_timeout: float: seconds to wait for the daemon's answer, forever if None
+        **kwargs: the arguments of the command, e.g. port or timeout
+
+    Returns:
+        result of the command
+
+    Raises:
+        OSError: if no daemon listens on socket_path
+        RuntimeError: if the daemon failed to run the command
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(socket_timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(dict(kwargs, command=command)).encode() + b'\n')
+
+        with sock.makefile('rb') as fp:
+            line = fp.readline()
+
+    if not line:
+        raise ConnectionResetError("daemon closed the connection without answering")
+
+    response = json.loads(line)
+    if not response['ok']:
+        raise RuntimeError(response['error'])
+
+    return response['result']
+
+
+def daemon_running(socket_path=SOCKET_PATH):
+    if not os.path.exists(socket_path):
+        return False
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+
+    return True
@@ -1,22 +1,42 @@
-import getpass
-import json
 import logging
 import os
-import threading
+import secrets
 import time
 
-from stem import process, Signal
-from stem.control import Controller
-from stem.util import conf
+from stem import Signal
 
-from get_port_ip import get_port_ip
+from ControllerPool import controller_pool
+from Metrics import BOOTSTRAP_SECONDS, NEWNYM_IP_SECONDS, PROBE_SECONDS, metrics
+from TorLaunch import BOOTSTRAP_TIMEOUT, TorLaunch
+from dir_cache import seed_data_directory
+from exit_geo import get_exit_info
+from tor_countries import parse_exit_nodes
+from torrc_cache import MAIN_TORRC, load_torrc
+from get_port_ip import get_port_ip, invalidate_port_ip
+from log_queue import attach_file_handler
+
+LOG_FILE = "TorConfig.log"
+
+logging.getLogger(__name__).setLevel(logging.INFO)
+
+
+def new_socks_auth():
+    """
+    Returns:
+        tuple: random (username, password) for a client of a shared tor process
+    """
+    return secrets.token_hex(8), secrets.token_hex(8)
 
 
 class TorConfig:
     """
+    Lean record of a tor client: slots instead of an instance dict, a logger shared by every client, and torrc
+    options read on demand from torrc_cache instead of a copy per client. Pickling writes STATE_FIELDS only.
+
     Attributes:
         config_dict:dict:
-            output of stem.util.conf.get_config().load()
+            torrc options of config_file_path, parsed once by torrc_cache.load_torrc and returned as a fresh copy on
+            every access, unless options were assigned to it
 
         config_file_path:str:
             path of torrc config file
@@ -28,7 +48,7 @@ class TorConfig:
             torrc socks port
 
         exit_nodes:list:
-            torrc exit nodes
+            torrc exit nodes, country codes without braces, fingerprints and address ranges as written
 
         hashed_control_password:str:
             torrc HashedControlPassword
@@ -37,32 +57,76 @@ class TorConfig:
             torrc data directory
 
         ip_info:dict:
-            keys: 'ip', 'country', 'region', 'city'
+            keys: 'ip', 'country', 'region', 'city'; for a client of a shared process, the exit of streams sent with
+            its socks_auth
 
         connection:subprocess.Popen:
             tor connection object
 
         password:str:
-            original unhashed torrc password (which will be prompted to acquire)
+            original unhashed torrc password, only needed if it differs from the one shared by controller_pool
 
         pid:
             pid of connection
+
+        shared_group:list:
+            clients sharing one tor process with this one (the same list object for all of them), see
+            create_shared_connection
+
+        shared_control_port:int:
+            ControlPort of the shared tor process
+
+        socks_auth:tuple:
+            (username, password) isolating this client's streams inside a shared process, rotated instead of NEWNYM.
+            Clients of a shared process have to be used with it, see proxy_url: streams without credentials are
+            still isolated per SocksPort, but keep their circuit, as renewing the client only rotates socks_auth
+
+        newnym_time:float:
+            time of the last NEWNYM, circuits built before it no longer tell the exit
+
+        launch_handle:TorLaunch:
+            the last launch, connection and pid are only set once it bootstrapped
     """
 
+    __slots__ = ('_config_file_path_', '_config_dict_', '_control_port_', '_socks_port_', '_exit_nodes_',
+                 '_hashed_control_password_', '_data_directory_', 'ip_info', 'pid', 'connection', 'password',
+                 'shared_group', 'shared_control_port', 'socks_auth', 'newnym_time', 'launch_handle')
+
+    # written by __getstate__, runtime handles (connection, shared_group, launch_handle) are not
+    STATE_FIELDS = ('config_file_path', 'control_port', 'socks_port', 'exit_nodes', 'hashed_control_password',
+                    'data_directory', 'ip_info', 'pid', 'password', 'shared_control_port', 'socks_auth',
+                    'newnym_time')
+
+    _logger_ = logging.getLogger(__name__)
+
+    # isolation flags of every SocksPort of a shared process, each socks_auth gets one exit for all destinations
+    SHARED_SOCKS_ISOLATION = 'IsolateSOCKSAuth'
+
+    # tor executable, e.g. fake_tor.py to run without tor
+    TOR_CMD = os.environ.get('TOR_CMD', 'tor')
+
     def __init__(self, config_file_path=None):
         """
         Args:
             config_file_path: str:
                 if provided, config_dict will be loaded.
         """
+        self._clear_()
         self.config_file_path = config_file_path  # str
 
-        self.config_dict = None  # dict casted from conf.Config object
-        self.control_port = None  # int
-        self.socks_port = None  # int
-        self.exit_nodes = None  # list
-        self.hashed_control_password = None  # str
-        self.data_directory = None  # str
+        if self.config_file_path:
+            self.load_conf_dict()
+
+        attach_file_handler(self._logger_, LOG_FILE)
+
+    def _clear_(self):
+        self._config_file_path_ = None  # str
+        self._config_dict_ = None  # dict, only set when options were assigned instead of read from the torrc
+        self._control_port_ = None  # int
+        self._socks_port_ = None  # int
+        self._exit_nodes_ = None  # list
+        self._hashed_control_password_ = None  # str
+        self._data_directory_ = None  # str
 
         self.ip_info = None  # dict
         self.pid = None  # int
@@ -70,19 +134,11 @@ class TorConfig:
 
         self.password = None  # str
 
-        if self.config_file_path:
-            self.load_conf_dict()
-
-        if os.path.basename(self.config_file_path) == 'torrc':
-            self.get_tor_ip_dict()
-
-        # set up logging
-        self._logger_ = logging.getLogger(__name__)
-        self._logger_.setLevel(logging.INFO)
-
-        file_handler = logging.FileHandler(filename="TorConfig.log")
-        file_handler.setLevel(logging.INFO)
-        self._logger_.addHandler(file_handler)
+        self.shared_group = None  # list
+        self.shared_control_port = None  # int
+        self.socks_auth = None  # tuple
+        self.newnym_time = None  # float
+        self.launch_handle = None  # TorLaunch
 
     def __str__(self):
         return f"{os.path.basename(self.config_file_path)} {self.socks_port} {self.exit_nodes}" + \
@@ -110,6 +166,18 @@ class TorConfig:
         else:
             raise NotADirectoryError("config path is not a directory")
 
+    @property
+    def config_dict(self):
+        if self._config_dict_ is not None:
+            return self._config_dict_
+        if self.config_file_path is None:
+            return None
+        return load_torrc(self.config_file_path)
+
+    @config_dict.setter
+    def config_dict(self, options):
+        self._config_dict_ = options
+
     @property
     def control_port(self):
         return self._control_port_
@@ -187,15 +255,8 @@ class TorConfig:
         if ens is None:
             self._exit_nodes_ = ens
 
-        elif isinstance(ens, list):
-            with open("tor-countries.json", 'r') as fp:
-                tor_ens = json.load(fp)
-
-            for en in ens:
-                if en.strip('{}') not in tor_ens.keys():
-                    raise ValueError(f"tor config exit node '{en}' not in tor predefined countries")
-            else:
-                self._exit_nodes_ = list(map(lambda x: x.strip("{}"), ens))
+        elif isinstance(ens, (list, str)):
+            self._exit_nodes_ = parse_exit_nodes(ens)
 
         else:
             raise ValueError(f"exit_nodes cannot be of type {type(ens)}")
@@ -224,46 +285,74 @@ class TorConfig:
             raise ValueError(f"hashed_control_password cannot be of type {type(psw)}")
 
     def __getstate__(self):
-        attrs = [attr for attr in dir(self) if attr[0] != '_' and attr[-1] != '_']
-
-        args = {key: getattr(self, key) for key in attrs}
-
-        del args["connection"]
-        return args
+        return {field: getattr(self, field) for field in self.STATE_FIELDS}
 
     def __setstate__(self, state):
-        # set up logging
-        self._logger_ = logging.getLogger(__name__)
-        self._logger_.setLevel(logging.INFO)
-
-        file_handler = logging.FileHandler(filename="TorConfig.log")
-        file_handler.setLevel(logging.INFO)
-        self._logger_.addHandler(file_handler)
+        attach_file_handler(self._logger_, LOG_FILE)
 
-        self.exit_nodes = None
-        self.hashed_control_password = None
-
-        self.ip_info = None
-        self.pid = None
-        self.connection = None
-
-        self.password = None
-
-        for key, value in state.items():
-            setattr(self, key, value)
-
-        if os.path.basename(self.config_file_path) == 'torrc':
-            self.get_tor_ip_dict()
+        self._clear_()
+        # older pickles hold every public attribute, including config_dict and bound methods
+        for field in self.STATE_FIELDS:
+            if field in state:
+                setattr(self, field, state[field])
 
     def custom_init(self, kwargs: dict):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def process_alive(self):
+        """
+        Returns:
+            bool: whether the tor process of this client is still running
+        """
+        if self.connection is not None and self.connection != -1:
+            return self.connection.poll() is None
+
+        if self.pid is None or self.pid == -1:
+            return False
+
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
     def kill_connection(self):
         """
         If connection was not None, it'll kill the subprocess.Popen object.
         Else if pid was not None, it'll use kill signal to kill the tor process.
+        A client of a shared process only has its SocksPort removed, unless it is the last one using the process.
         """
+        invalidate_port_ip(self.socks_port)
+
+        if self.launching():
+            self.launch_handle.cancel()
+
+        if self.shared_group is not None:
+            group = self.shared_group
+            if self in group:
+                group.remove(self)
+            control_port = self.shared_control_port
+            self.shared_group = None
+            self.shared_control_port = None
+            self.socks_auth = None
+
+            if group:
+                controller_pool.get(control_port, self.password).set_options({
+                    'SocksPort': [f'{client.socks_port} {self.SHARED_SOCKS_ISOLATION}' for client in group]
+                })
+                self.connection = None
+                self.pid = None
+                self.ip_info = None
+                self._logger_.info(f"removed config[{self.config_file_path}] from shared tor process")
+                return
+
+            controller_pool.close(control_port)
+        elif self.control_port is not None:
+            controller_pool.close(self.control_port)
+
         if self.connection is not None:
             self.connection.kill()
             self.connection = None
@@ -277,88 +366,242 @@ class TorConfig:
                 self.ip_info = None
                 self._logger_.info(f"successfully killed config[{self.config_file_path}] connection")
 
-    def create_connection_from_config(self):
+    def launching(self):
+        """
+        Returns:
+            bool: tor is bootstrapping for this client
+        """
+        return self.launch_handle is not None and not self.launch_handle.future.done()
+
+    def launch(self, timeout=BOOTSTRAP_TIMEOUT, seed_from=None, on_progress=None, config=None):
+        """
+        Launches tor in the background and returns right away, connection and pid are set once it bootstrapped.
+        Launching a client that is already launching returns the running launch.
+
+        Args:
+            timeout: int:
+                seconds after which the launch is aborted and the tor process killed, no timeout if None.
+            seed_from: list:
+                data directories to seed data_directory's directory cache from before launching, see
+                dir_cache.seed_data_directory
+            on_progress: callable(percent, summary):
+                called with every bootstrap step, from the launch's reader thread
+            config: dict:
+                torrc options to launch with instead of config_dict
+
+        Returns:
+            TorLaunch: cancel() aborts the launch, wait() blocks until it finished
+
+        Raises:
+            OSError: if tor can't be executed
+        """
+        if self.launching():
+            if on_progress is not None:
+                self.launch_handle.add_progress_callback(on_progress)
+            return self.launch_handle
+
+        if seed_from and self.data_directory:
+            seed_data_directory(self.data_directory, seed_from)
+
+        start_time = time.time()
+        self._logger_.info("creating connection from config")
+
+        def log_progress(percent, summary):
+            self._logger_.info(f"config[{self.config_file_path}] Bootstrapped {percent}%: {summary}")
+
+        def on_ready(connection):
+            self.connection = connection
+            self.pid = connection.pid
+            metrics.observe(BOOTSTRAP_SECONDS, time.time() - start_time, port=self.socks_port)
+            self._logger_.info(f"successfully created connection[pid={connection.pid}] "
+                               f"after {int(time.time() - start_time)} seconds")
+
+        invalidate_port_ip(self.socks_port)
+        self.launch_handle = TorLaunch(config if config is not None else self.config_dict, tor_cmd=self.TOR_CMD,
+                                       timeout=timeout, on_progress=log_progress, on_ready=on_ready)
+        if on_progress is not None:
+            self.launch_handle.add_progress_callback(on_progress)
+        return self.launch_handle.start()
+
+    def create_connection_from_config(self, timeout=BOOTSTRAP_TIMEOUT, seed_from=None):
         """
-        Sets a timer for 60 seconds and if connection wasn't created successfully by then, it'll raise an Exception.
+        Launches tor with config_dict and blocks until it bootstrapped, see launch.
+        Failures, including the timeout, are raised to the caller.
         Calls get_tor_ip_dict to get the new ip_info
+
+        Args:
+            timeout: int:
+                seconds after which the launch is aborted and the tor process killed, no timeout if None.
+            seed_from: list:
+                data directories to seed data_directory's directory cache from before launching, see
+                dir_cache.seed_data_directory
         """
-        if self.connection is not None:
-            start_time = time.time()
-            self._logger_.info("creating connection from config")
-
-            def check_time(st):
-                while True:
-                    time.sleep(2)
-                    self._logger_.info(
-                        f"{int(time.time() - st)} seconds has elapsed, still trying to create the connection.")
-                    if self.connection is None:
-                        if time.time() - st > 60:
-                            raise Exception("something went wrong. probably openconnect is conneted...")
-                    else:
-                        self._logger_.info(f"successfully created connection[pid={self.connection.pid}] "
-                                           f"after {int(time.time() - st)} seconds")
-                        return
-
-            threading.Thread(target=check_time, args=(start_time,)).start()
-            self.connection = process.launch_tor_with_config(config=self.config_dict)
-            self.pid = self.connection.pid
+        if self.connection is None:
+            self.launch(timeout=timeout, seed_from=seed_from).wait()
             self.get_tor_ip_dict()
 
-    def load_conf_dict(self):
+    def create_shared_connection(self, clients, timeout=BOOTSTRAP_TIMEOUT, seed_from=None):
         """
-        Loads configuration from config_file_path to config_dict
+        Launches one tor process from this client's config serving the SocksPorts of all of clients, which should
+        share this client's ExitNodes. Each port is isolated from the others, and every client gets its own
+        socks_auth so IsolateSOCKSAuth keeps its circuits apart; renewing a client rotates its socks_auth, since a
+        NEWNYM would renew every port of the process.
+
+        Args:
+            clients: list of TorConfig, including this one
+            timeout, seed_from: see create_connection_from_config
         """
-        config_object = conf.get_config('config_handler')
-        config_object.load(self.config_file_path)
+        if self not in clients:
+            clients = [self] + list(clients)
+
+        config = dict(self.config_dict)
+        config['SocksPort'] = [f'{client.socks_port} {self.SHARED_SOCKS_ISOLATION}' for client in clients]
+        self.launch(timeout=timeout, seed_from=seed_from, config=config).wait()
+
+        group = list(clients)
+        for client in group:
+            client.connection = self.connection
+            client.pid = self.pid
+            client.shared_group = group
+            client.shared_control_port = self.control_port
+            client.socks_auth = new_socks_auth()
+            client.ip_info = None
+            invalidate_port_ip(client.socks_port)
+
+        self._logger_.info(f"shared tor process[pid={self.pid}] serves socks ports "
+                           f"{[client.socks_port for client in group]}")
 
-        self.config_dict = dict(config_object)
+    def load_conf_dict(self):
+        """
+        Loads configuration from config_file_path to config_dict, files unchanged on disk are not parsed again
+        """
+        self._config_dict_ = None
 
-        for key in config_object.keys():
+        for key, value in load_torrc(self.config_file_path).items():
             if 'ControlPort' in key:
-                self.control_port = config_object[key]
+                self.control_port = value
             if 'SocksPort' in key:
-                self.socks_port = config_object[key]
+                self.socks_port = value
             if 'ExitNodes' in key:
-                self.exit_nodes = config_object[key]
+                self.exit_nodes = value
             if 'DataDirectory' in key:
-                self.data_directory = config_object[key]
+                self.data_directory = value
             if 'HashedControlPassword' in key:
-                self.hashed_control_password = config_object[key]
-            elif not self.hashed_control_password:
-                main_torrc_config_object = conf.get_config('main_handler')
-                main_torrc_config_object.load("/etc/tor/torrc")
-                self.hashed_control_password = main_torrc_config_object["HashedControlPassword"]
+                self.hashed_control_password = value
 
             # TODO: complete this list
 
-        config_object.clear()
+        # custom torrc files inherit the password of the main torrc next to them
+        main_torrc = os.path.join(os.path.dirname(self.config_file_path), 'torrc')
+        if not os.path.isfile(main_torrc):
+            main_torrc = MAIN_TORRC
+        if not self.hashed_control_password and os.path.isfile(main_torrc):
+            self.hashed_control_password = load_torrc(main_torrc).get("HashedControlPassword")
 
-    def renew_ip(self):
+    def proxy_url(self, host='localhost'):
         """
-        Calls torrc connection restart signal NEWNYM using stem
+        Returns:
+            str: socks5h url of this client, with its socks_auth for a client of a shared process, which its
+            streams have to use to get its identity
         """
-        if not self.password:
-            self.password = getpass.unix_getpass(prompt=f"tor config file {self.config_file_path}\npassword:")
+        credentials = f'{self.socks_auth[0]}:{self.socks_auth[1]}@' if self.socks_auth else ''
+        return f'socks5h://{credentials}{host}:{self.socks_port}'
 
-        try:
-            with Controller.from_port(port=self.control_port) as controller:
-                controller.authenticate(password=self.password)
-                controller.signal(Signal.NEWNYM)
+    def newnym_wait(self):
+        """
+        Returns:
+            float: seconds until tor accepts the next NEWNYM of this client, 0 if it would be applied right away
+        """
+        if self.shared_group is not None:
+            return 0.0
 
-            if self.connection is not None and self.connection != -1:
-                self.pid = self.connection.pid
-            self.get_tor_ip_dict()
-            self._logger_.info(f"successfully renew-ed config[{self.config_file_path}] connection[pid={self.pid}]\n"
-                               f"new ip:{self.ip_info['country'].lower()}:{self.ip_info['ip']}:{self.socks_port}")
+        return controller_pool.get(self.control_port, self.password).get_newnym_wait()
+
+    def send_newnym(self):
+        """
+        Sends NEWNYM through the pooled controller of control_port and drops the ip_info it made stale.
+        Unlike renew_ip, failures are raised.
+        A client of a shared process rotates its socks_auth instead, which only renews its own circuits: the new
+        identity is only used by streams sent with the new socks_auth, i.e. through the new proxy_url.
+        """
+        if self.shared_group is not None:
+            self.socks_auth = new_socks_auth()
+            self.newnym_time = time.time()
+            invalidate_port_ip(self.socks_port)
+            self.ip_info = None
+            return
+
+        controller_pool.signal(self.control_port, Signal.NEWNYM, password=self.password)
+        self.newnym_time = time.time()
+        invalidate_port_ip(self.socks_port)
+        self.ip_info = None
+
+        if self.connection is not None and self.connection != -1:
+            self.pid = self.connection.pid
+
+    def renew_ip(self, probe=True):
+        """
+        Calls torrc connection restart signal NEWNYM through the pooled controller of control_port
+
+        Args:
+            probe: bool:
+                fetch the new ip_info right away, bulk renews probe the whole fleet afterwards instead
+        """
+        try:
+            self.send_newnym()
+            if probe:
+                self.get_tor_ip_dict()
+                metrics.observe(NEWNYM_IP_SECONDS, time.time() - self.newnym_time, port=self.socks_port)
+                # exit_geo leaves country None for exits tor has no country of
+                ip_info = self.ip_info or dict()
+                self._logger_.info(f"successfully renew-ed config[{self.config_file_path}] connection[pid={self.pid}]\n"
+                                   f"new ip:{(ip_info.get('country') or '??').lower()}:{ip_info.get('ip')}:"
+                                   f"{self.socks_port}")
+            else:
+                self._logger_.info(f"successfully renew-ed config[{self.config_file_path}] connection[pid={self.pid}]")
         except Exception as e:
             self._logger_.error(f"renew-ing connection for config[{self.config_file_path}] faced an Exception:\n"
                                 f"\t{str(e)}")
 
-    def get_tor_ip_dict(self):
+    def get_exit_info(self):
         """
-        Calls file get_port_ip.py using --port and --file arguments and loads its output to ip_info
+        Resolves ip_info locally through the control port, that of the shared tor process for its clients, see
+        exit_geo.get_exit_info.
+
+        Raises:
+            LookupError: if no circuit was built since the last NEWNYM yet
+        """
+        control_port = self.shared_control_port or self.control_port
+        if control_port is None:
+            raise LookupError("client has no control port")
+
+        start_time = time.perf_counter()
+        ip_info = get_exit_info(control_port, self.password,
+                                socks_username=self.socks_auth[0] if self.socks_auth is not None else None,
+                                since=self.newnym_time)
+        metrics.observe(PROBE_SECONDS, time.perf_counter() - start_time, method='control', port=self.socks_port)
+        return ip_info
+
+    def get_tor_ip_dict(self, refresh=False, verify=False):
+        """
+        Loads ip_info, resolved locally through the control port when possible. Otherwise, or with verify, it is
+        probed over socks_port using get_port_ip, which reuses a cached result until it expires or the client sends
+        NEWNYM or restarts.
+
+        Args:
+            refresh: bool:
+                ignore the cached ip_info and probe again
+            verify: bool:
+                ask an ip echo service over socks_port, which also reports org, region and city
         """
-        self.ip_info = get_port_ip(port=self.socks_port)
+        if not verify:
+            try:
+                self.ip_info = self.get_exit_info()
+                return
+            except Exception as e:
+                self._logger_.debug(f"resolving exit of config[{self.config_file_path}] locally failed: {e}")
+
+        self.ip_info = get_port_ip(port=self.socks_port, refresh=refresh, auth=self.socks_auth)
 
 
 if __name__ == "__main__":
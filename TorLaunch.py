@@ -0,0 +1,216 @@
+import logging
+import re
+import shutil
+import subprocess
+import threading
+from concurrent.futures import CancelledError, Future
+
+BOOTSTRAP_TIMEOUT = 90  # seconds, stem's launch_tor_with_config default
+
+
+class TorLaunch:
+    """
+    Handle of a tor process bootstrapping in the background.
+
+    The torrc is passed to tor on stdin, as stem's launch_tor_with_config does, and tor's stdout is read on a
+    thread of its own, so launching never blocks and the timeout works in any thread. The future resolves to the
+    subprocess.Popen once tor reports Bootstrapped 100%, or to the OSError that stopped it; a cancelled or timed
+    out launch kills its process.
+
+    Attributes:
+        config:dict:
+            torrc options, values are str or list of str
+
+        progress:int:
+            last bootstrap percentage reported by tor
+
+        summary:str:
+            last bootstrap phase reported by tor
+
+        process:subprocess.Popen:
+            tor process, None until start
+
+        future:concurrent.futures.Future:
+            resolves when bootstrapping finished
+    """
+
+    BOOTSTRAP_LINE = re.compile(r'Bootstrapped ([0-9]+)%(?: \([^)]*\))?:? *(.*)$')
+    PROBLEM_LINE = re.compile(r'\[(warn|err)\] (.*)$')
+
+    def __init__(self, config, tor_cmd='tor', timeout=None, on_progress=None, on_ready=None):
+        """
+        Args:
+            config: dict: torrc options
+            tor_cmd: str: tor executable
+            timeout: int: seconds tor is given to bootstrap
+            on_progress: callable(percent, summary): called with every bootstrap step, from the reader thread
+            on_ready: callable(process): called once bootstrapped, before the future resolves
+        """
+        self.config = config
+        self.tor_cmd = tor_cmd
+        self.timeout = timeout
+        self.progress = 0
+        self.summary = None
+        self.process = None
+        self.future = Future()
+
+        self._lock_ = threading.Lock()
+        self._callbacks_ = [on_progress] if on_progress is not None else list()
+        self._on_ready_ = on_ready
+        self._timer_ = None
+        self._last_problem_ = "tor exited while bootstrapping"
+        self._logger_ = logging.getLogger(__name__)
+
+    def add_progress_callback(self, callback):
+        """
+        Args:
+            callback: callable(percent, summary)
+        """
+        self._callbacks_.append(callback)
+
+    def torrc(self):
+        """
+        Returns:
+            str: the config as torrc lines, logging NOTICE to stdout so bootstrapping can be followed
+        """
+        config = dict(self.config)
+        logs = [config['Log']] if isinstance(config.get('Log'), str) else list(config.get('Log', ()))
+        if not any(log in ('DEBUG stdout', 'INFO stdout', 'NOTICE stdout') for log in logs):
+            logs.append('NOTICE stdout')
+        config['Log'] = logs
+
+        lines = list()
+        for key, values in config.items():
+            for value in [values] if isinstance(values, str) else values:
+                lines.append(f'{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        """
+        Spawns tor and returns right away.
+
+        Returns:
+            self
+
+        Raises:
+            OSError: if tor can't be executed
+        """
+        if shutil.which(self.tor_cmd) is None:
+            raise OSError(f"'{self.tor_cmd}' isn't available on your system. Maybe it's not in your PATH?")
+
+        self.process = subprocess.Popen([self.tor_cmd, '-f', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        try:
+            self.process.stdin.write(self.torrc().encode())
+            self.process.stdin.close()
+        except OSError:
+            self._kill_()
+            raise
+
+        if self.timeout is not None:
+            self._timer_ = threading.Timer(self.timeout, self._fail_,
+                                           (OSError(f"reached a {self.timeout} second timeout without success"),))
+            self._timer_.daemon = True
+            self._timer_.start()
+
+        threading.Thread(target=self._read_, name=f'tor-launch-{self.process.pid}', daemon=True).start()
+        return self
+
+    def _read_(self):
+        stdout = self.process.stdout
+        try:
+            for raw_line in stdout:
+                line = raw_line.decode('utf-8', 'replace').strip()
+
+                problem = self.PROBLEM_LINE.search(line)
+                if problem and 'see warnings above' not in problem.group(2):
+                    self._last_problem_ = problem.group(2).split(': ')[-1].strip()
+
+                bootstrap = self.BOOTSTRAP_LINE.search(line)
+                if bootstrap is None:
+                    continue
+
+                self.progress, self.summary = int(bootstrap.group(1)), bootstrap.group(2)
+                for callback in list(self._callbacks_):
+                    try:
+                        callback(self.progress, self.summary)
+                    except Exception as e:
+                        self._logger_.error(f"bootstrap progress callback failed: {e}")
+
+                if self.progress >= 100:
+                    self._succeed_()
+                    return
+        except (OSError, ValueError):
+            # stdout was closed by cancel or the timeout
+            pass
+        finally:
+            stdout.close()
+
+        self._fail_(OSError(f"Process terminated: {self._last_problem_}"))
+
+    def _succeed_(self):
+        with self._lock_:
+            if self.future.done():
+                return
+            if self._timer_ is not None:
+                self._timer_.cancel()
+
+            if self._on_ready_ is not None:
+                try:
+                    self._on_ready_(self.process)
+                except Exception as e:
+                    self._kill_()
+                    self.future.set_exception(e)
+                    return
+            self.future.set_result(self.process)
+
+    def _fail_(self, exception):
+        with self._lock_:
+            if self.future.done():
+                return
+            if self._timer_ is not None:
+                self._timer_.cancel()
+            self._kill_()
+            if isinstance(exception, CancelledError):
+                self.future.cancel()
+            else:
+                self.future.set_exception(exception)
+
+    def _kill_(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def cancel(self):
+        """
+        Kills tor if it is still bootstrapping.
+
+        Returns:
+            bool: whether the launch was cancelled, False if it already finished
+        """
+        self._fail_(CancelledError())
+        return self.future.cancelled()
+
+    def ready(self):
+        """
+        Returns:
+            bool: tor bootstrapped
+        """
+        return self.future.done() and not self.future.cancelled() and self.future.exception() is None
+
+    def wait(self, timeout=None):
+        """
+        Blocks until bootstrapping finished.
+
+        Args:
+            timeout: float: seconds to wait, the launch goes on if they pass
+
+        Returns:
+            subprocess.Popen
+
+        Raises:
+            OSError: if tor failed to bootstrap
+            concurrent.futures.CancelledError: if the launch was cancelled
+            concurrent.futures.TimeoutError: if timeout passed first
+        """
+        return self.future.result(timeout)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Benchmarks TManager at fleet scale against fake_tor, offline and without touching /etc/tor.
+
+For every size a temporary configs directory gets a main torrc (served by an in-process FakeTor, like the system
+tor service) and size provisioned torrc files, then these are timed:
+    read_configs        cold parse of every torrc with the memory it allocated, and the cached re-read
+    startup             start_all_connections, or start_shared_connections above --process-limit clients
+    probe-all           probe_running_clients through the control ports, and verified over the socks ports
+    renew-all           renew_all_connections with probing
+    save/load state     write_running_clients_configs and load_clients_cache
+
+Usage:
+    python benchmark.py --sizes 10 100 1000 --parallel 16
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from prettytable import PrettyTable
+
+import fake_tor
+from ClientRegistry import ClientRegistry
+from ControllerPool import controller_pool
+from TManager import TManager
+from TorConfig import TorConfig
+from port_allocator import allocate_port_pairs
+from torrc_cache import invalidate_torrc
+
+COUNTRIES = ('us', 'de', 'nl', 'fr')
+
+
+def timed(function, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start_time, result
+
+
+def benchmark(size, process_limit=100, parallel=16, start_port=20000):
+    """
+    Returns:
+        list of (step, seconds, note)
+    """
+    root = tempfile.mkdtemp(prefix='tmanager-benchmark-')
+    configs_dir = os.path.join(root, 'tor')
+    os.makedirs(configs_dir)
+
+    (socks_port, control_port), = allocate_port_pairs(1, start=start_port)
+    with open(os.path.join(configs_dir, 'torrc'), 'w') as fp:
+        fp.write(f'SocksPort {socks_port}\nControlPort {control_port}\n')
+    system_tor = fake_tor.FakeTor(fake_tor.parse_torrc(f'SocksPort {socks_port}\nControlPort {control_port}\n'),
+                                  echo_address=fake_tor.echo_address()).start()
+
+    results = list()
+    tm = TManager(configs_dir=configs_dir, clients_cache_dir=os.path.join(root, 'cache'))
+    try:
+        tm.provision_torrc_configs(size, countries=COUNTRIES, start_port=control_port + 1,
+                                   data_directories_dir=os.path.join(root, 'data'))
+
+        tm.clients = ClientRegistry()
+        invalidate_torrc()
+        tracemalloc.start()
+        seconds, _ = timed(tm.read_configs)
+        allocated, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append(('read_configs', seconds, f'cold, {allocated / size / 1024:.1f} KiB per client'))
+        seconds, _ = timed(tm.read_configs)
+        results.append(('read_configs', seconds, 'cached'))
+
+        if size <= process_limit:
+            seconds, summary = timed(tm.start_all_connections, max_workers=parallel)
+            note = f"{len(summary['started'])} processes, {len(summary['failed'])} failed"
+        else:
+            seconds, summary = timed(tm.start_shared_connections, max_workers=parallel)
+            note = f"shared, {len(summary['started'])} clients, {len(summary['failed'])} failed"
+        results.append(('startup', seconds, note))
+
+        seconds, failed = timed(tm.probe_running_clients, refresh=True)
+        results.append(('probe-all', seconds, f"control port, {len(failed)} failed"))
+        seconds, failed = timed(tm.probe_running_clients, refresh=True, verify=True)
+        results.append(('probe-all', seconds, f"socks and ip echo, {len(failed)} failed"))
+
+        seconds, failed = timed(tm.renew_all_connections, probe=True)
+        results.append(('renew-all', seconds, f"{len(failed)} failed"))
+
+        seconds, _ = timed(tm.write_running_clients_configs)
+        results.append(('save state', seconds, ''))
+        seconds, _ = timed(tm.load_clients_cache)
+        results.append(('load state', seconds, ''))
+    finally:
+        tm.kill_all_connections()
+        controller_pool.close_all()
+        tm.state_store.close()
+        system_tor.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark TManager against fake_tor")
+    parser.add_argument("--sizes", default=[10, 100, 1000], type=int, nargs='+', help='fleet sizes to benchmark.')
+    parser.add_argument("--process-limit", default=100, type=int,
+                        help='larger fleets are started as shared tor processes.')
+    parser.add_argument("--parallel", default=16, type=int, help='clients bootstrapping concurrently.')
+    parser.add_argument("--bootstrap-delay", default=0.2, type=float, help='seconds each fake tor bootstraps.')
+    args = parser.parse_args()
+
+    echo = fake_tor.IpEchoServer().start()
+    os.environ[fake_tor.ECHO_ENV] = '%s:%d' % echo.address
+    os.environ[fake_tor.BOOTSTRAP_DELAY_ENV] = str(args.bootstrap_delay)
+    TorConfig.TOR_CMD = os.path.abspath(fake_tor.__file__)
+    controller_pool.interactive = False
+
+    table = PrettyTable()
+    table.field_names = ["clients", "step", "seconds", "per client (ms)", "note"]
+    for field in table.field_names:
+        table.align[field] = 'r' if field != 'note' and field != 'step' else 'l'
+
+    try:
+        for size in args.sizes:
+            for step, seconds, note in benchmark(size, args.process_limit, args.parallel):
+                table.add_row((size, step, f'{seconds:.3f}', f'{seconds / size * 1000:.2f}', note))
+    finally:
+        echo.shutdown()
+
+    print(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import logging
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+
+CONSENSUS_FILE = 'cached-microdesc-consensus'
+
+# files tor rewrites through a rename, so hardlinking them between data directories is safe
+LINKABLE_FILES = ('cached-certs', CONSENSUS_FILE, 'cached-microdescs')
+
+# tor appends to this journal in place, so it is always copied
+COPIED_FILES = ('cached-microdescs.new',)
+
+
+def consensus_valid_until(data_directory):
+    """
+    Returns:
+        float: the valid-until time of the microdesc consensus in data_directory as a timestamp, None if there is
+        no readable consensus
+    """
+    path = os.path.join(data_directory, CONSENSUS_FILE)
+    try:
+        with open(path, 'r', errors='replace') as fp:
+            for _ in range(32):  # the header is short, never read the whole document
+                line = fp.readline()
+                if not line:
+                    break
+                if line.startswith('valid-until '):
+                    valid_until = datetime.strptime(line.split(' ', 1)[1].strip(), '%Y-%m-%d %H:%M:%S')
+                    return valid_until.replace(tzinfo=timezone.utc).timestamp()
+    except (OSError, ValueError):
+        return None
+
+    return None
+
+
+def fresh_source(directories):
+    """
+    Returns:
+        the directory among directories with the consensus valid for the longest, None if none of them is valid
+    """
+    best, best_valid_until = None, time.time()
+    for directory in directories:
+        if not directory or not os.path.isdir(directory):
+            continue
+        valid_until = consensus_valid_until(directory)
+        if valid_until is not None and valid_until > best_valid_until:
+            best, best_valid_until = directory, valid_until
+
+    return best
+
+
+def _link_or_copy(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # other filesystem or links not permitted
+        shutil.copy2(source, destination)
+
+
+def seed_data_directory(data_directory, sources):
+    """
+    Copies or hardlinks the directory cache of the freshest of sources into data_directory, so a new client
+    bootstraps from it instead of downloading the consensus and microdescriptors.
+    Nothing is done if data_directory already has a valid consensus or none of sources has one.
+
+    Args:
+        data_directory: str: DataDirectory of the client about to be launched
+        sources: iterable of str: data directories of healthy clients or a shared cache directory
+
+    Returns:
+        the source directory used, None if nothing was seeded
+    """
+    if (consensus_valid_until(data_directory) or 0) > time.time():
+        return None
+
+    source = fresh_source(source for source in sources if os.path.abspath(source) != os.path.abspath(data_directory))
+    if source is None:
+        return None
+
+    os.makedirs(data_directory, mode=0o700, exist_ok=True)
+    for name in LINKABLE_FILES:
+        if os.path.isfile(os.path.join(source, name)):
+            _link_or_copy(os.path.join(source, name), os.path.join(data_directory, name))
+    for name in COPIED_FILES:
+        if os.path.isfile(os.path.join(source, name)):
+            shutil.copy2(os.path.join(source, name), os.path.join(data_directory, name))
+
+    logging.getLogger(__name__).info(f"seeded {data_directory} with the directory cache of {source}")
+    return source
+
+
+def update_shared_cache(cache_directory, sources):
+    """
+    Refreshes cache_directory from the freshest of sources, if that is fresher than what it holds.
+
+    Returns:
+        the source directory used, None if cache_directory was already the freshest
+    """
+    source = fresh_source([cache_directory] + list(sources))
+    if source is None or os.path.abspath(source) == os.path.abspath(cache_directory):
+        return None
+
+    os.makedirs(cache_directory, mode=0o700, exist_ok=True)
+    for name in LINKABLE_FILES + COPIED_FILES:
+        if os.path.isfile(os.path.join(source, name)):
+            # replaced through a rename, clients seeded with links to the previous files keep them intact
+            temp_path = os.path.join(cache_directory, f'.{name}.tmp')
+            shutil.copy2(os.path.join(source, name), temp_path)
+            os.replace(temp_path, os.path.join(cache_directory, name))
+
+    return source
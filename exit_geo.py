@@ -0,0 +1,85 @@
+from datetime import timezone
+
+from stem import CircBuildFlag, CircPurpose, CircStatus
+
+from ControllerPool import controller_pool
+
+
+def _created(circuit):
+    if circuit.created is None:
+        return 0.0
+    return circuit.created.replace(tzinfo=timezone.utc).timestamp()
+
+
+def current_exit(controller, socks_username=None, since=None):
+    """
+    Finds the circuit new streams of a client are most likely attached to: the newest built general purpose
+    circuit, which for clients of a shared tor process has to carry their socks username.
+
+    Args:
+        controller: stem.control.Controller: authenticated controller of the client
+        socks_username: str: only consider circuits of this socks username
+        since: float: only consider circuits created after this time, e.g. the last NEWNYM
+
+    Returns:
+        stem.response.events.CircuitEvent
+
+    Raises:
+        LookupError: if there is no such circuit yet, tor only builds one when a stream needs it
+    """
+    circuits = [
+        circuit for circuit in controller.get_circuits()
+        if circuit.status == CircStatus.BUILT and circuit.purpose == CircPurpose.GENERAL and circuit.path
+        and CircBuildFlag.IS_INTERNAL not in (circuit.build_flags or ())
+        and CircBuildFlag.ONEHOP_TUNNEL not in (circuit.build_flags or ())
+        and (socks_username is None or circuit.socks_username == socks_username)
+        and (since is None or _created(circuit) >= since)
+    ]
+    if not circuits:
+        raise LookupError("no built exit circuit")
+
+    return max(circuits, key=lambda circuit: (_created(circuit), int(circuit.id)))
+
+
+def get_exit_info(control_port, password=None, socks_username=None, since=None):
+    """
+    Resolves the exit of a client locally through its control port instead of asking an ip echo service: the exit
+    relay of current_exit is looked up in the consensus and its country in tor's geoip database
+    (GETINFO ip-to-country).
+
+    The relay's consensus address is reported, which differs from the ip servers see for the few exits with a
+    separate outbound address; get_port_ip verifies over the socks port.
+
+    Args:
+        control_port: int
+        password: str: control password, never prompted for
+        socks_username, since: see current_exit
+
+    Returns:
+        dict: keys: 'ip', 'org', 'city', 'country', 'region' as get_port_ip, plus 'fingerprint' and 'nickname'.
+        org, city and region are not known locally and are None
+
+    Raises:
+        LookupError: if the exit is not known yet
+        stem.ControllerError, stem.connection.AuthenticationFailure: if the control port is unusable
+    """
+    controller = controller_pool.get(control_port, password, interactive=False)
+    fingerprint, nickname = current_exit(controller, socks_username, since).path[-1]
+
+    router = controller.get_network_status(fingerprint, None)
+    if router is None:
+        raise LookupError(f"exit relay {fingerprint} is not in the consensus")
+
+    country = controller.get_info(f'ip-to-country/{router.address}', None)
+    if country in (None, '', '??'):
+        country = None
+
+    return {
+        'ip': router.address,
+        'org': None,
+        'city': None,
+        'country': country.upper() if country else None,
+        'region': None,
+        'fingerprint': fingerprint,
+        'nickname': nickname or router.nickname,
+    }
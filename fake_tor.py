@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the tor binary, so TManager can be exercised and benchmarked offline.
+
+Run as tor (TorConfig.TOR_CMD or the TOR_CMD environment variable pointing at this file), it reads the torrc from
+-f (- for stdin), prints Bootstrapped lines like tor and serves:
+    - a control port speaking enough of the tor control protocol for stem: PROTOCOLINFO, AUTHENTICATE (any
+      credentials), SIGNAL NEWNYM, GETINFO (circuit-status, ns/id/*, ns/all, ip-to-country/*, ...), GETCONF,
+      SETCONF and BW, CIRC and STATUS_CLIENT events,
+    - a socks5 endpoint per SocksPort with IsolateSOCKSAuth like isolation, whose fake exits answer every
+      connection as an ip echo service, or forward it to the IpEchoServer named by FAKE_TOR_ECHO (host:port).
+
+Relays are a fixed fake consensus spread over a few countries, ExitNodes restricts the exits to its countries and
+fingerprints. FAKE_TOR_BOOTSTRAP_DELAY sets the seconds bootstrapping takes.
+"""
+import base64
+import datetime
+import hashlib
+import json
+import os
+import re
+import select
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+ECHO_ENV = 'FAKE_TOR_ECHO'
+BOOTSTRAP_DELAY_ENV = 'FAKE_TOR_BOOTSTRAP_DELAY'
+VERSION = '0.4.8.12'
+
+COUNTRIES = ('us', 'de', 'nl', 'fr', 'gb', 'se', 'ch', 'ca')
+EXITS_PER_COUNTRY = 12
+RELAY_FLAGS = 'Fast Guard Running Stable Valid'
+EXIT_FLAGS = 'Exit Fast Running Stable Valid'
+CIRCUITS_KEPT = 8  # circuits kept per socks username, older ones are closed
+
+BOOTSTRAP_STEPS = ((0, 'starting', 'Starting'), (5, 'conn', 'Connecting to a relay'),
+                   (25, 'loading_status', 'Loading networkstatus consensus'),
+                   (50, 'loading_descriptors', 'Loading relay descriptors'),
+                   (75, 'enough_dirinfo', 'Loaded enough directory info to build circuits'),
+                   (90, 'ap_handshake_done', 'Handshake finished with a relay to build circuits'),
+                   (100, 'done', 'Done'))
+
+
+class Relay:
+    __slots__ = ('fingerprint', 'nickname', 'address', 'country', 'bandwidth', 'exit')
+
+    def __init__(self, index, country, exit):
+        self.fingerprint = hashlib.sha1(f'fake-relay-{index}'.encode()).hexdigest().upper()
+        self.nickname = f'fake{"exit" if exit else "relay"}{index}'
+        self.address = f'10.{COUNTRIES.index(country) + 1}.{index // 250}.{index % 250 + 1}'
+        self.country = country
+        self.bandwidth = (index * 7919) % 20000 + 100
+        self.exit = exit
+
+    def status_entry(self):
+        """
+        Returns:
+            str: the relay as a v3 router status entry
+        """
+        identity = base64.b64encode(bytes.fromhex(self.fingerprint)).decode().rstrip('=')
+        digest = base64.b64encode(hashlib.sha1(self.nickname.encode()).digest()).decode().rstrip('=')
+        return (f"r {self.nickname} {identity} {digest} 2026-01-01 00:00:00 {self.address} 9001 0\n"
+                f"s {EXIT_FLAGS if self.exit else RELAY_FLAGS}\n"
+                f"w Bandwidth={self.bandwidth}\n")
+
+
+def _fake_relays():
+    relays = list()
+    for country in COUNTRIES:
+        for _ in range(EXITS_PER_COUNTRY):
+            relays.append(Relay(len(relays), country, exit=True))
+        relays.append(Relay(len(relays), country, exit=False))
+    return relays
+
+
+RELAYS = _fake_relays()
+RELAYS_BY_FINGERPRINT = {relay.fingerprint: relay for relay in RELAYS}
+RELAYS_BY_ADDRESS = {relay.address: relay for relay in RELAYS}
+
+
+def parse_torrc(text):
+    """
+    Returns:
+        dict: option -> list of values
+    """
+    config = dict()
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line:
+            key, _, value = line.partition(' ')
+            config.setdefault(key, list()).append(value.strip())
+    return config
+
+
+def echo_response(request, ip, country):
+    """
+    Answers an http request like ipinfo.io, or like ip-api.com for paths under /json/.
+
+    Returns:
+        bytes: the http response
+    """
+    request_line = request.split(b'\r\n', 1)[0].decode(errors='replace').split()
+    path = request_line[1] if len(request_line) > 1 else '/'
+    country = (country or '??').upper()
+
+    if path.startswith('/json/'):
+        data = {'status': 'success', 'query': ip, 'countryCode': country, 'regionName': 'Fake Region',
+                'city': 'Fake City', 'org': 'AS0 Fake Exit'}
+    else:
+        data = {'ip': ip, 'country': country, 'region': 'Fake Region', 'city': 'Fake City', 'org': 'AS0 Fake Exit'}
+
+    body = json.dumps(data).encode()
+    return (b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+
+
+def _read_request(sock):
+    data = b''
+    while b'\r\n\r\n' not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("peer closed the connection")
+        data += chunk
+    return data
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _EchoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data = _read_request(self.request)
+        ip, country = self.client_address[0], None
+        if data.startswith(b'FAKE-EXIT '):
+            prefix, _, data = data.partition(b'\r\n')
+            _, ip, country = prefix.decode().split(' ')
+        if b'\r\n\r\n' not in data:
+            data += _read_request(self.request)
+        self.request.sendall(echo_response(data, ip, country))
+
+
+class IpEchoServer:
+    """
+    Local http service answering like ipinfo.io with the ip of the fake exit a connection came from.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server_ = _Server((host, port), _EchoHandler)
+        self.address = self._server_.server_address
+
+    def start(self):
+        threading.Thread(target=self._server_.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        self._server_.shutdown()
+        self._server_.server_close()
+
+
+class Circuit:
+    __slots__ = ('id', 'path', 'username', 'password', 'created', 'dirty')
+
+    def __init__(self, circuit_id, path, username=None, password=None):
+        self.id = circuit_id
+        self.path = path
+        self.username = username
+        self.password = password
+        self.created = datetime.datetime.utcnow()
+        self.dirty = False
+
+    @property
+    def exit(self):
+        return self.path[-1]
+
+    def status_line(self):
+        path = ','.join(f'${relay.fingerprint}~{relay.nickname}' for relay in self.path)
+        line = f"{self.id} BUILT {path} BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL " \
+               f"TIME_CREATED={self.created.strftime('%Y-%m-%dT%H:%M:%S.%f')}"
+        if self.username is not None:
+            line += f' SOCKS_USERNAME="{self.username}" SOCKS_PASSWORD="{self.password or ""}"'
+        return line
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.events = set()
+        self.write_lock = threading.Lock()
+
+    def send(self, *lines):
+        with self.write_lock:
+            self.wfile.write(''.join(f'{line}\r\n' for line in lines).encode())
+            self.wfile.flush()
+
+    def handle(self):
+        tor = self.server.tor
+        tor.controllers.add(self)
+        try:
+            for raw_line in self.rfile:
+                line = raw_line.decode(errors='replace').strip()
+                if not line:
+                    continue
+                command, _, arguments = line.partition(' ')
+                if command.upper() == 'QUIT':
+                    self.send('250 closing connection')
+                    return
+                self.send(*tor.control_command(self, command.upper(), arguments))
+        except (OSError, ValueError):
+            pass
+        finally:
+            tor.controllers.discard(self)
+
+
+class _SocksHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            self.server.tor.socks_connection(self.request, self.server.server_address[1])
+        except (OSError, ValueError):
+            pass
+
+
+class FakeTor:
+    """
+    A fake tor process: control port, socks ports and circuits over the fake consensus, in this process.
+
+    Attributes:
+        config:dict:
+            torrc options, option -> list of values
+    """
+
+    SETCONF_ARGUMENT = re.compile(r'(\S+?)(?:=("(?:[^"\\]|\\.)*"|\S*))?(?:\s+|$)')
+
+    def __init__(self, config, echo_address=None):
+        self.config = config
+        self.echo_address = echo_address
+        self.controllers = set()
+        self.circuits = list()
+        self.read_bytes = 0
+        self.written_bytes = 0
+
+        self._lock_ = threading.Lock()
+        self._next_circuit_id_ = 1
+        self._socks_servers_ = dict()  # port -> server
+        self._control_server_ = None
+        self._stopped_ = threading.Event()
+        self._exits_ = self._eligible_exits_()
+
+    @staticmethod
+    def _port_(value):
+        port = str(value).split()[0]
+        return int(port.rsplit(':', 1)[-1]) if port.rsplit(':', 1)[-1].isdigit() else None
+
+    def _eligible_exits_(self):
+        exits = [relay for relay in RELAYS if relay.exit]
+        nodes = [node.strip() for value in self.config.get('ExitNodes', ()) for node in value.split(',')
+                 if node.strip()]
+        if not nodes:
+            return exits
+
+        countries = {node.strip('{}').lower() for node in nodes if node.startswith('{')}
+        fingerprints = {node.lstrip('$').split('~')[0].split('=')[0].upper() for node in nodes
+                        if node.startswith('$')}
+        eligible = [relay for relay in exits if relay.country in countries or relay.fingerprint in fingerprints]
+        return eligible or exits
+
+    def _build_circuit_(self, username=None, password=None):
+        guard, middle = [relay for relay in RELAYS if not relay.exit][:2]
+        with self._lock_:
+            exit_relay = self._exits_[(self._next_circuit_id_ * 7) % len(self._exits_)]
+            circuit = Circuit(str(self._next_circuit_id_), (guard, middle, exit_relay), username, password)
+            self._next_circuit_id_ += 1
+
+            self.circuits.append(circuit)
+            same_user = [each for each in self.circuits if each.username == username]
+            for each in same_user[:-CIRCUITS_KEPT]:
+                self.circuits.remove(each)
+
+        self.emit('CIRC', f"650 CIRC {circuit.status_line()}")
+        return circuit
+
+    def circuit_for(self, username=None, password=None):
+        with self._lock_:
+            for circuit in reversed(self.circuits):
+                if circuit.username == username and not circuit.dirty:
+                    return circuit
+        return self._build_circuit_(username, password)
+
+    def newnym(self):
+        with self._lock_:
+            for circuit in self.circuits:
+                circuit.dirty = True
+
+        # tor builds a fresh preemptive circuit shortly after
+        timer = threading.Timer(0.05, self._build_circuit_)
+        timer.daemon = True
+        timer.start()
+
+    def emit(self, event, line):
+        for controller in list(self.controllers):
+            if event in controller.events:
+                try:
+                    controller.send(line)
+                except OSError:
+                    self.controllers.discard(controller)
+
+    def getinfo(self, key):
+        if key == 'version':
+            return f'{VERSION} (git-fake)'
+        if key == 'process/pid':
+            return str(os.getpid())
+        if key == 'circuit-status':
+            with self._lock_:
+                return '\n'.join(circuit.status_line() for circuit in self.circuits)
+        if key == 'status/circuit-established':
+            return '1'
+        if key == 'traffic/read':
+            return str(self.read_bytes)
+        if key == 'traffic/written':
+            return str(self.written_bytes)
+        if key == 'net/listeners/socks':
+            return ' '.join(f'"127.0.0.1:{port}"' for port in self._socks_servers_)
+        if key == 'ns/all':
+            return ''.join(relay.status_entry() for relay in RELAYS).rstrip('\n')
+        if key.startswith('ns/id/'):
+            relay = RELAYS_BY_FINGERPRINT.get(key[len('ns/id/'):].lstrip('$').upper())
+            if relay is None:
+                raise KeyError(key)
+            return relay.status_entry().rstrip('\n')
+        if key.startswith('ip-to-country/'):
+            relay = RELAYS_BY_ADDRESS.get(key[len('ip-to-country/'):])
+            return relay.country if relay is not None else '??'
+        raise KeyError(key)
+
+    def control_command(self, controller, command, arguments):
+        """
+        Returns:
+            list of reply lines
+        """
+        if command == 'PROTOCOLINFO':
+            return ['250-PROTOCOLINFO 1', '250-AUTH METHODS=NULL,HASHEDPASSWORD', f'250-VERSION Tor="{VERSION}"',
+                    '250 OK']
+        if command in ('AUTHENTICATE', 'TAKEOWNERSHIP', 'RESETCONF', 'SAVECONF', 'DROPGUARDS'):
+            return ['250 OK']
+        if command == 'SETEVENTS':
+            controller.events = set(arguments.upper().split()) - {'EXTENDED'}
+            return ['250 OK']
+        if command == 'SIGNAL':
+            if arguments.strip().upper() == 'NEWNYM':
+                self.newnym()
+            return ['250 OK']
+        if command == 'GETINFO':
+            reply = list()
+            for key in arguments.split():
+                try:
+                    value = self.getinfo(key)
+                except KeyError:
+                    return [f'552 Unrecognized key "{key}"']
+                if '\n' in value or key.startswith('ns/') or key == 'circuit-status':
+                    reply.append(f'250+{key}=')
+                    reply.extend(value.split('\n') if value else [])
+                    reply.append('.')
+                else:
+                    reply.append(f'250-{key}={value}')
+            return reply + ['250 OK']
+        if command == 'GETCONF':
+            keys = arguments.split()
+            reply = list()
+            for key in keys:
+                values = self.config.get(key) or [None]
+                reply.extend(f'{key}={value}' if value is not None else key for value in values)
+            return [f'250-{line}' for line in reply[:-1]] + [f'250 {reply[-1]}'] if reply else ['250 OK']
+        if command == 'SETCONF':
+            self.setconf(arguments)
+            return ['250 OK']
+        return [f'510 Unrecognized command "{command}"']
+
+    def setconf(self, arguments):
+        options = dict()
+        for match in self.SETCONF_ARGUMENT.finditer(arguments):
+            if not match.group(1):
+                continue
+            value = match.group(2) or ''
+            if value.startswith('"'):
+                value = value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+            options.setdefault(match.group(1), list()).append(value)
+
+        for key, values in options.items():
+            self.config[key] = [value for value in values if value]
+            if key == 'ExitNodes':
+                self._exits_ = self._eligible_exits_()
+            elif key == 'SocksPort':
+                self._serve_socks_ports_()
+
+    def _serve_socks_ports_(self):
+        wanted = {self._port_(value) for value in self.config.get('SocksPort', ())} - {None, 0}
+        for port in set(self._socks_servers_) - wanted:
+            server = self._socks_servers_.pop(port)
+            server.shutdown()
+            server.server_close()
+        for port in wanted - set(self._socks_servers_):
+            server = _Server(('127.0.0.1', port), _SocksHandler)
+            server.tor = self
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self._socks_servers_[port] = server
+
+    def socks_connection(self, client, port):
+        version, nmethods = _recv_exactly(client, 2)
+        methods = _recv_exactly(client, nmethods)
+        username = password = None
+        if 2 in methods:
+            client.sendall(b'\x05\x02')
+            _, ulen = _recv_exactly(client, 2)
+            username = _recv_exactly(client, ulen).decode(errors='replace')
+            password = _recv_exactly(client, _recv_exactly(client, 1)[0]).decode(errors='replace')
+            client.sendall(b'\x01\x00')
+        else:
+            client.sendall(b'\x05\x00')
+
+        _, cmd, _, atyp = _recv_exactly(client, 4)
+        if atyp == 1:
+            _recv_exactly(client, 4)
+        elif atyp == 4:
+            _recv_exactly(client, 16)
+        else:
+            _recv_exactly(client, _recv_exactly(client, 1)[0])
+        _recv_exactly(client, 2)
+
+        circuit = self.circuit_for(username, password)
+        client.sendall(b'\x05\x00\x00\x01' + b'\x00' * 6)
+
+        exit_relay = circuit.exit
+        if self.echo_address is None:
+            request = _read_request(client)
+            response = echo_response(request, exit_relay.address, exit_relay.country)
+            client.sendall(response)
+            self.read_bytes += len(response)
+            self.written_bytes += len(request)
+            return
+
+        with socket.create_connection(self.echo_address) as upstream:
+            upstream.sendall(f'FAKE-EXIT {exit_relay.address} {exit_relay.country}\r\n'.encode())
+            sockets = (client, upstream)
+            while True:
+                readable, _, _ = select.select(sockets, (), ())
+                for sock in readable:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    (upstream if sock is client else client).sendall(data)
+                    if sock is client:
+                        self.written_bytes += len(data)
+                    else:
+                        self.read_bytes += len(data)
+
+    def _report_bandwidth_(self):
+        last_read, last_written = self.read_bytes, self.written_bytes
+        while not self._stopped_.wait(1):
+            read, written = self.read_bytes, self.written_bytes
+            self.emit('BW', f'650 BW {read - last_read} {written - last_written}')
+            last_read, last_written = read, written
+
+    def start(self, log=None, bootstrap_delay=0.0):
+        """
+        Opens the control and socks ports and bootstraps.
+
+        Args:
+            log: callable(str): gets tor's notice lines, e.g. print for stdout
+            bootstrap_delay: float: seconds bootstrapping takes
+
+        Returns:
+            self
+        """
+        def notice(level, message):
+            if log is not None:
+                log(f"{time.strftime('%b %d %H:%M:%S')}.000 [{level}] {message}")
+
+        try:
+            control_port = self._port_(self.config.get('ControlPort', ['0'])[0])
+            if control_port:
+                self._control_server_ = _Server(('127.0.0.1', control_port), _ControlHandler)
+                self._control_server_.tor = self
+                threading.Thread(target=self._control_server_.serve_forever, daemon=True).start()
+            self._serve_socks_ports_()
+        except OSError as e:
+            notice('warn', f"Could not bind to 127.0.0.1: {e.strerror}")
+            notice('err', "Failed to bind one of the listener ports.")
+            self.stop()
+            raise
+
+        for percent, tag, summary in BOOTSTRAP_STEPS:
+            if percent == 90:
+                self._build_circuit_()
+            notice('notice', f"Bootstrapped {percent}% ({tag}): {summary}")
+            if percent < 100:
+                time.sleep(bootstrap_delay / (len(BOOTSTRAP_STEPS) - 1))
+
+        self.emit('STATUS_CLIENT', '650 STATUS_CLIENT NOTICE CIRCUIT_ESTABLISHED')
+        threading.Thread(target=self._report_bandwidth_, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped_.set()
+        for server in list(self._socks_servers_.values()) + [self._control_server_]:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        self._socks_servers_.clear()
+
+    def wait(self):
+        self._stopped_.wait()
+
+
+def echo_address():
+    value = os.environ.get(ECHO_ENV)
+    if not value:
+        return None
+    host, _, port = value.rpartition(':')
+    return host, int(port)
+
+
+def main(argv):
+    if '--version' in argv:
+        print(f"Tor version {VERSION}.")
+        return 0
+
+    text = ''
+    if '-f' in argv:
+        path = argv[argv.index('-f') + 1]
+        if path == '-':
+            text = sys.stdin.read()
+        else:
+            with open(path, 'r') as fp:
+                text = fp.read()
+
+    def log(line):
+        try:
+            print(line, flush=True)
+        except (BrokenPipeError, ValueError):
+            # the launcher stops reading once bootstrapped
+            pass
+
+    tor = FakeTor(parse_torrc(text), echo_address=echo_address())
+    try:
+        tor.start(log=log, bootstrap_delay=float(os.environ.get(BOOTSTRAP_DELAY_ENV, 0.2)))
+    except OSError:
+        return 1
+
+    tor.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,33 +1,161 @@
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import requests
 
+from Metrics import PROBE_SECONDS, metrics
+
+IP_INFO_TTL = 300  # seconds a fetched ip_info stays valid for a port
+PROBE_TIMEOUT = 15  # seconds a single probe may take
+
+# ip-api.com field names mapped to the ipinfo.io ones used in ip_info
+ALT_URL_HEADERS = {'query': 'ip', 'org': 'org', 'city': 'city', 'countryCode': 'country', 'regionName': 'region'}
+
+_lock = threading.Lock()
+_sessions = dict()  # port -> requests.Session kept alive between probes
+_ip_info_cache = dict()  # port -> (fetch time, metadata)
+
+
+def get_port_session(port, auth=None):
+    """
+    Returns:
+        requests.Session: the session pooled for port, proxied through its socks port with auth, if given, until
+        invalidate_port_ip drops it
+    """
+    with _lock:
+        session = _sessions.get(port)
+        if session is None:
+            session = requests.session()
+            if port is not None:
+                credentials = f'{auth[0]}:{auth[1]}@' if auth else ''
+                session.proxies = dict()
+                session.proxies['http'], session.proxies['https'] = (f'socks5h://{credentials}localhost:{port}',) * 2
+            _sessions[port] = session
+
+    return session
+
+
+def invalidate_port_ip(port=None):
+    """
+    Drops the cached ip_info and the pooled session of port, so the next probe goes over a fresh circuit.
+    Has to be called after the client on port sent NEWNYM, changed its socks auth or was restarted, since
+    kept-alive connections would otherwise keep using the old circuit.
+    """
+    with _lock:
+        _ip_info_cache.pop(port, None)
+        session = _sessions.pop(port, None)
+
+    if session is not None:
+        session.close()
+
 
 def get_port_ip(**kargs):
+    """
+    Keyword Args:
+        port: int: socks port to probe through, direct connection if not given
+        ttl: int: seconds a cached result is reused, defaults to IP_INFO_TTL
+        refresh: bool: ignore the cached result
+        timeout: int: seconds each request may take, defaults to PROBE_TIMEOUT
+        auth: tuple: socks (username, password) of port, for clients of a shared tor process
+
+    Returns:
+        dict: keys: 'ip', 'org', 'city', 'country', 'region'
+    """
     url = 'http://ipinfo.io/json'
     alt_url = 'http://ip-api.com/json/'
-    session = requests.session()
 
-    if 'port' in kargs:
-        session.proxies = dict()
-	session.proxies['http'], session.proxies['https'] = (f'socks5h://localhost:{kargs["port"]}',) * 2
+    port = int(kargs['port']) if kargs.get('port') is not None else None
+    ttl = kargs.get('ttl', IP_INFO_TTL)
+    timeout = kargs.get('timeout', PROBE_TIMEOUT)
+
+    if not kargs.get('refresh', False):
+        with _lock:
+            cached = _ip_info_cache.get(port)
+        if cached is not None and time.time() - cached[0] < ttl:
+            return dict(cached[1])
 
-    response = session.get(url)
-    if response.status_code != 200:
-        response = session.get(alt_url)
+    session = get_port_session(port, kargs.get('auth'))
+    start_time = time.perf_counter()
+
+    try:
+        response = session.get(url, timeout=timeout)
+    except requests.RequestException:
+        response = None
+
+    if response is not None and response.status_code == 200:
+        data = json.loads(response.text)
+
+        # take out needed headers
+        metadata = {}
+        metadata_headers = 'ip-org-city-country-region'.split('-')
+        for k, v in data.items():
+            if k in metadata_headers:
+                metadata[k] = v
+    else:
+        try:
+            response = session.get(alt_url, timeout=timeout)
+        except requests.RequestException as e:
+            raise ConnectionRefusedError(f"couldn't get ip from servers: {e}")
         if response.status_code != 200:
             raise ConnectionRefusedError("couldn't get ip from servers")
 
-    data = json.loads(response.text)
+        data = json.loads(response.text)
+        metadata = {header: data[key] for key, header in ALT_URL_HEADERS.items() if key in data}
+
+    metrics.observe(PROBE_SECONDS, time.perf_counter() - start_time, method='http',
+                    port=port if port is not None else 'direct')
+    with _lock:
+        _ip_info_cache[port] = (time.time(), metadata)
+
+    return dict(metadata)
+
+
+def get_ports_ip(ports, **kargs):
+    """
+    Probes the exit ip of every port concurrently, so probing a fleet takes about as long as its slowest client.
+
+    Args:
+        ports: iterable of socks ports
+
+    Keyword Args:
+        timeout: int: seconds each port may take, defaults to PROBE_TIMEOUT
+        max_workers: int: number of concurrent probes, defaults to one per port
+        auths: dict: port -> socks (username, password), for clients of a shared tor process
+        refresh, ttl: passed to get_port_ip
+
+    Returns:
+        dict: port -> ip_info, or the Exception the probe of that port raised
+    """
+    ports = list(dict.fromkeys(ports))
+    if not ports:
+        return dict()
+
+    timeout = kargs.pop('timeout', PROBE_TIMEOUT)
+    max_workers = kargs.pop('max_workers', None) or len(ports)
+    auths = kargs.pop('auths', None) or dict()
+
+    results = dict()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {executor.submit(get_port_ip, port=port, timeout=timeout, auth=auths.get(port), **kargs): port
+                   for port in ports}
+        # the fallback url may be tried after a timed out first request
+        done, not_done = wait(futures, timeout=timeout * 2 * -(-len(ports) // max_workers))
 
-    # take out needed headers
-    metadata = {}
-    metadata_headers = 'ip-org-city-country-region'.split('-')
-    for k, v in data.items():
-        if k in metadata_headers:
-            metadata[k] = v
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
+        for future in not_done:
+            future.cancel()
+            results[futures[future]] = TimeoutError(f"probing port {futures[future]} timed out")
+    finally:
+        executor.shutdown(wait=False)
 
-    return metadata
+    return results
 
     # older method of getting ip using PySocks
     # import socks
@@ -0,0 +1,52 @@
+import atexit
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+_lock = threading.Lock()
+_listeners = dict()  # logger name -> QueueListener writing its records
+
+
+def attach_file_handler(logger, filename, level=logging.INFO):
+    """
+    Makes logger write to filename through a queue: the logging call only enqueues the record and a listener thread
+    does the file I/O, so threads logging from hot paths never block on the disk.
+    Attaching is done once per logger, no matter how often it is called. The logger stops propagating, so handlers
+    of the root logger, like the stderr one logging.warning installs, don't write its records synchronously.
+
+    Args:
+        logger: logging.Logger
+        filename: str: log file, opened in append mode
+        level: int: lowest level written to the file
+    """
+    with _lock:
+        if logger.name in _listeners:
+            return
+
+        records = queue.SimpleQueue()
+        file_handler = logging.FileHandler(filename=filename)
+        file_handler.setLevel(level)
+
+        listener = QueueListener(records, file_handler, respect_handler_level=True)
+        listener.start()
+        logger.addHandler(QueueHandler(records))
+        logger.propagate = False
+        _listeners[logger.name] = listener
+
+
+def stop_listeners():
+    """
+    Writes out the queued records and stops every listener, registered to run at exit.
+    """
+    with _lock:
+        listeners = list(_listeners.values())
+        _listeners.clear()
+
+    for listener in listeners:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+atexit.register(stop_listeners)
@@ -0,0 +1,54 @@
+import os
+
+PROC_NET_TCP = ('/proc/net/tcp', '/proc/net/tcp6')
+TCP_LISTEN = '0A'
+
+
+def listening_ports():
+    """
+    Reads the tcp ports the kernel has listening sockets on from /proc/net/tcp and /proc/net/tcp6.
+
+    Returns:
+        set of int, empty where /proc is not available
+    """
+    ports = set()
+    for path in PROC_NET_TCP:
+        if not os.path.isfile(path):
+            continue
+
+        with open(path, 'r') as fp:
+            next(fp, None)  # header
+            for line in fp:
+                fields = line.split()
+                if len(fields) > 3 and fields[3] == TCP_LISTEN:
+                    ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+
+    return ports
+
+
+def allocate_port_pairs(count, taken=(), start=9060, end=65534):
+    """
+    Allocates count (SocksPort, ControlPort) pairs, the control port being the socks port + 1 as in every torrc
+    this tool writes. Socks ports are even, so a pair never straddles another one.
+
+    Args:
+        count: int: number of pairs
+        taken: iterable of int: ports already used by configs, listening sockets are added to them
+        start: int: lowest socks port
+        end: int: highest control port
+
+    Raises:
+        OSError: if the range has fewer than count free pairs
+    """
+    taken = set(taken) | listening_ports()
+
+    pairs = list()
+    port = start + start % 2
+    while len(pairs) < count:
+        if port + 1 > end:
+            raise OSError(f"only {len(pairs)} free port pairs between {start} and {end}, {count} needed")
+        if port not in taken and port + 1 not in taken:
+            pairs.append((port, port + 1))
+        port += 2
+
+    return pairs
@@ -0,0 +1,655 @@
+"""
+Behaviour tests of TManager against fake_tor, offline and without touching /etc/tor.
+
+Run with: python -m pytest -q test_tmanager.py
+"""
+import asyncio
+import logging
+import os
+import pickle
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import wait
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import fake_tor
+import torrc_cache
+from ClientRegistry import ClientRegistry
+from ControllerPool import controller_pool
+from FleetRegistry import FleetReader, FleetRegistry
+from HealthSupervisor import HealthSupervisor
+from SocksBalancer import SocksBalancer
+from TManager import TManager
+from TManagerDaemon import TManagerDaemon, send_command
+from TorConfig import TorConfig
+from TorLaunch import TorLaunch
+from port_allocator import allocate_port_pairs
+from tor_countries import country_code, parse_exit_node, parse_exit_nodes
+
+
+class Records(logging.Handler):
+    """
+    Keeps the records logged to it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.records = list()
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class Fleet:
+    """
+    A temporary configs directory with a main torrc served by an in-process FakeTor and provisioned clients.
+    """
+
+    def __init__(self, root, countries):
+        self.root = str(root)
+        self.configs_dir = os.path.join(self.root, 'tor')
+        os.makedirs(self.configs_dir)
+        self.managers = list()
+
+        (socks_port, control_port), = allocate_port_pairs(1, start=24000)
+        main_torrc = f'SocksPort {socks_port}\nControlPort {control_port}\n'
+        with open(os.path.join(self.configs_dir, 'torrc'), 'w') as fp:
+            fp.write(main_torrc)
+        self.system_tor = fake_tor.FakeTor(fake_tor.parse_torrc(main_torrc),
+                                           echo_address=fake_tor.echo_address()).start()
+
+        self.manager().provision_torrc_configs(len(countries), countries=countries, start_port=control_port + 1,
+                                               data_directories_dir=os.path.join(self.root, 'data'))
+
+    def manager(self):
+        """
+        Returns:
+            TManager: a new manager of the fleet, as a separate run of tor_manager.py would build it
+        """
+        tm = TManager(configs_dir=self.configs_dir, clients_cache_dir=os.path.join(self.root, 'cache'))
+        self.managers.append(tm)
+        return tm
+
+    def custom_clients(self, tm):
+        return [client for client in tm.clients if client.pid != -1]
+
+    def close(self):
+        for tm in self.managers:
+            tm.kill_all_connections()
+        controller_pool.close_all()
+        for tm in self.managers:
+            tm.state_store.close()
+        self.system_tor.stop()
+
+
+@pytest.fixture
+def fleet(tmp_path, monkeypatch):
+    echo = fake_tor.IpEchoServer().start()
+    monkeypatch.setenv(fake_tor.ECHO_ENV, '%s:%d' % echo.address)
+    monkeypatch.setenv(fake_tor.BOOTSTRAP_DELAY_ENV, '0.05')
+    monkeypatch.setattr(TorConfig, 'TOR_CMD', os.path.abspath(fake_tor.__file__))
+    monkeypatch.setattr(controller_pool, 'interactive', False)
+
+    fleets = list()
+
+    def make(countries=('us', 'de', 'us')):
+        fleets.append(Fleet(tmp_path / f'fleet{len(fleets)}', countries))
+        return fleets[-1]
+
+    yield make
+
+    for created in fleets:
+        created.close()
+    echo.shutdown()
+
+
+def test_start_probe_and_renew(fleet):
+    tm = fleet().manager()
+    summary = tm.start_all_connections(max_workers=3, timeout=30)
+    assert not summary['failed']
+    assert len(summary['started']) == 3
+
+    for client in tm.clients:
+        if client.pid == -1:
+            continue
+        assert client.ip_info['country'].lower() in client.exit_nodes
+
+    assert not tm.renew_all_connections(probe=True)
+    for client in tm.clients:
+        if client.pid != -1:
+            assert client.newnym_time is not None
+            assert client.ip_info is not None
+
+
+def test_renew_requests_return_right_away_and_run_concurrently(fleet, monkeypatch):
+    tm = fleet().manager()
+    tm.start_all_connections(max_workers=3, timeout=30)
+    clients = [client for client in tm.clients if client.pid != -1]
+
+    probe = TorConfig.get_tor_ip_dict
+    threads = set()
+    requested = threading.Event()
+    together = threading.Barrier(len(clients), timeout=5)
+
+    def held_probe(client, *args, **kwargs):
+        threads.add(threading.current_thread().name)
+        # raises BrokenBarrierError unless every probe runs at the same time
+        together.wait()
+        requested.wait(5)
+        return probe(client, *args, **kwargs)
+
+    monkeypatch.setattr(TorConfig, 'get_tor_ip_dict', held_probe)
+
+    futures = [tm.renew_scheduler.request(client, probe=True) for client in clients]
+    # every request returned while the probes are held
+    assert not any(future.done() for future in futures)
+    requested.set()
+
+    wait(futures, timeout=10)
+    assert all(future.exception() is None for future in futures)
+    assert threading.current_thread().name not in threads
+
+
+def test_shared_clients_resolve_exits_through_the_shared_control_port(fleet):
+    tm = fleet().manager()
+    summary = tm.start_shared_connections(max_workers=2, timeout=30)
+    assert not summary['failed']
+
+    shared = [client for client in tm.clients if client.shared_group is not None and len(client.shared_group) > 1]
+    assert len(shared) == 2
+    for client in shared:
+        ip_info = client.get_exit_info()
+        assert ip_info['country'].lower() == 'us'
+
+
+def test_control_port_lookups_run_concurrently_and_a_wedged_one_falls_back_to_socks(fleet, monkeypatch):
+    tm = fleet().manager()
+    tm.start_all_connections(max_workers=3, timeout=30)
+    # the system tor service is probed too
+    clients = [client for client in tm.clients if client.pid is not None]
+    wedged = next(client for client in clients if client.pid != -1)
+    others = [client for client in clients if client is not wedged]
+
+    lookup = TorConfig.get_exit_info
+    together = threading.Barrier(len(others), timeout=5)
+    unwedge = threading.Event()
+
+    def get_exit_info(client):
+        if client is wedged:
+            unwedge.wait()
+        else:
+            # raises BrokenBarrierError unless the other lookups run at the same time
+            together.wait()
+        return lookup(client)
+
+    monkeypatch.setattr(TorConfig, 'get_exit_info', get_exit_info)
+    try:
+        failed = tm.probe_running_clients(timeout=2)
+    finally:
+        unwedge.set()
+
+    assert not failed
+    # only the socks probe asks the ip echo service, which knows the org
+    assert wedged.ip_info['org'] is not None
+    assert all(client.ip_info['org'] is None for client in others)
+
+
+def test_renewing_onto_an_exit_of_unknown_country_succeeds(fleet, monkeypatch):
+    tm = fleet(countries=('us',)).manager()
+    tm.start_all_connections(timeout=30)
+    client = next(client for client in tm.clients if client.pid not in (None, -1))
+
+    # exit_geo.get_exit_info leaves country None for exits tor has no country of
+    monkeypatch.setattr(TorConfig, 'get_exit_info', lambda self: {'ip': '10.9.9.9', 'country': None})
+    records = Records()
+    logging.getLogger('TorConfig').addHandler(records)
+    try:
+        client.renew_ip(probe=True)
+    finally:
+        logging.getLogger('TorConfig').removeHandler(records)
+
+    assert client.ip_info['ip'] == '10.9.9.9'
+    assert not [record for record in records.records if record.levelno >= logging.ERROR]
+    assert any('new ip:??:10.9.9.9' in record.getMessage() for record in records.records)
+
+
+def test_shared_clients_renew_the_identity_of_their_proxy_url(fleet):
+    tm = fleet().manager()
+    tm.start_shared_connections(max_workers=2, timeout=30)
+    client = next(client for client in tm.clients if client.shared_group is not None)
+
+    proxy = client.proxy_url()
+    assert proxy.startswith(f'socks5h://{client.socks_auth[0]}:{client.socks_auth[1]}@')
+
+    client.renew_ip(probe=True)
+    assert client.proxy_url() != proxy
+    answer = requests.get('http://ipinfo.io/json', proxies={'http': client.proxy_url()}, timeout=10).json()
+    assert answer['ip'] == client.ip_info['ip']
+
+
+def test_overlapping_runs_keep_each_others_pids(fleet):
+    created = fleet(countries=('us',))
+    late = created.manager()
+    early = created.manager()
+
+    client = created.custom_clients(early)[0]
+    early.start_connection(port=client.socks_port)
+    early.write_running_clients_configs()
+
+    # a run which loaded the store before the client was started exits afterwards
+    late.write_running_clients_configs()
+
+    state = early.state_store.load()
+    assert state[os.path.basename(client.config_file_path)]['pid'] == client.pid
+    assert created.custom_clients(created.manager())[0].pid == client.pid
+
+
+def test_daemon_serves_commands_and_stops_only_the_selected_clients(fleet, tmp_path):
+    tm = fleet().manager()
+    tm.start_all_connections(max_workers=3, timeout=30)
+
+    socket_path = str(tmp_path / 'd.sock')
+    daemon = TManagerDaemon(tm, socket_path=socket_path)
+    threading.Thread(target=daemon.serve_forever, daemon=True).start()
+    try:
+        for _ in range(100):
+            if daemon._server_ is not None and os.path.exists(socket_path):
+                break
+            time.sleep(0.01)
+
+        status = send_command('status', socket_path=socket_path, country='de', socket_timeout=10)
+        assert [record['exit_nodes'] for record in status] == [['de']]
+        assert status[0]['ip_info']['country'] == 'DE'
+
+        send_command('stop', socket_path=socket_path, country='de', socket_timeout=10)
+        with pytest.raises(RuntimeError, match='ValueError'):
+            send_command('stop', socket_path=socket_path, port=0, socket_timeout=10)
+
+        running = {record['exit_nodes'][0]: record['pid'] for record in send_command('list', socket_path=socket_path)
+                   if record['exit_nodes']}
+        assert running['de'] is None
+        assert all(client.pid is not None for client in tm.clients.by_country('us'))
+
+        us = tm.clients.by_country('us')[0]
+        renewed, = send_command('renew', socket_path=socket_path, port=us.socks_port, socket_timeout=30)
+        assert renewed['pid'] == us.pid and renewed['ip_info']['country'] == 'US'
+        assert us.newnym_time is not None
+
+        started = send_command('start', socket_path=socket_path, country='de', timeout=30, socket_timeout=60)
+        assert started[0]['pid'] is not None
+        assert send_command('reload', socket_path=socket_path) == len(tm.clients)
+        with pytest.raises(RuntimeError, match='unknown command'):
+            send_command('restart', socket_path=socket_path, socket_timeout=10)
+    finally:
+        daemon.shutdown()
+
+
+def test_tor_config_logs_only_through_its_queue(fleet):
+    tm = fleet(countries=('us',)).manager()
+    # installs the default stderr handler of the root logger, as a root level logging call in TManager used to
+    logging.warning("the root logger gets its default stderr handler")
+
+    root, queued = Records(), Records()
+    logging.getLogger().addHandler(root)
+    logging.getLogger('TorConfig').addHandler(queued)
+    try:
+        tm.start_all_connections(timeout=30)
+    finally:
+        logging.getLogger().removeHandler(root)
+        logging.getLogger('TorConfig').removeHandler(queued)
+
+    assert any('Bootstrapped 100%' in record.getMessage() for record in queued.records)
+    assert not [record for record in root.records if record.name == 'TorConfig']
+
+
+def test_leases_are_exclusive_and_renewed_without_blocking_the_loop(fleet, monkeypatch):
+    tm = fleet(countries=('us',)).manager()
+    tm.start_all_connections(timeout=30)
+
+    send_newnym = TorConfig.send_newnym
+    released = threading.Event()
+    held = list()
+
+    def held_newnym(client):
+        # times out if the release waited for this NEWNYM on the event loop
+        held.append(released.wait(5))
+        return send_newnym(client)
+
+    monkeypatch.setattr(TorConfig, 'send_newnym', held_newnym)
+
+    async def lease_twice():
+        lease = await tm.acquire_async(country='us', timeout=5)
+        with pytest.raises(TimeoutError):
+            await tm.acquire_async(country='us', timeout=0.2)
+
+        async with lease:
+            pass
+        released.set()
+
+        async with await tm.acquire_async(country='us', timeout=5) as again:
+            return lease.socks_port, again.socks_port
+
+    first, second = asyncio.run(lease_twice())
+    assert first == second
+    assert held == [True]
+
+
+def test_the_system_tor_service_is_never_leased(fleet):
+    tm = fleet(countries=('us',)).manager()
+    tm.start_all_connections(timeout=30)
+    system = next(client for client in tm.clients if client.pid == -1)
+
+    with tm.acquire(timeout=5) as lease:
+        assert lease.client is not system
+        with pytest.raises(TimeoutError):
+            tm.acquire(timeout=0.2)
+        with pytest.raises(TimeoutError):
+            tm.acquire(port=system.socks_port, timeout=0.2)
+
+
+def test_balancer_relays_through_the_fleet(fleet):
+    tm = fleet().manager()
+    tm.start_shared_connections(max_workers=2, timeout=30)
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    balancer = SocksBalancer(tm, port=port)
+    threading.Thread(target=balancer.serve_forever, daemon=True).start()
+    try:
+        for _ in range(50):
+            if balancer._server_ is not None:
+                break
+            time.sleep(0.01)
+
+        proxies = {'http': f'socks5h://de:x@127.0.0.1:{port}'}
+        answers = [requests.get('http://ipinfo.io/json', proxies=proxies, timeout=10).json() for _ in range(3)]
+        assert all(answer['country'] == 'DE' for answer in answers), answers
+    finally:
+        balancer.shutdown()
+
+
+def test_balancer_releases_a_backend_replying_with_an_unknown_address_type():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+
+        def serve():
+            backend, _ = listener.accept()
+            with backend:
+                backend.recv(3)
+                backend.sendall(b'\x05\x00')
+                backend.recv(10)
+                backend.sendall(b'\x05\x00\x00\x09')
+
+        threading.Thread(target=serve, daemon=True).start()
+        client = SimpleNamespace(pid=1, socks_port=listener.getsockname()[1], socks_auth=None)
+        balancer = SocksBalancer(SimpleNamespace(clients=[client]), retries=0)
+
+        ours, theirs = socket.socketpair()
+        with ours, theirs:
+            ours.sendall(b'\x05\x01\x00' + b'\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x50')
+            balancer.relay(theirs)
+            assert ours.recv(2) == b'\x05\x00'
+            assert ours.recv(10)[1] != 0
+
+    assert [backend.connections for backend in balancer._backends_.values()] == [0]
+
+
+def test_registry_follows_clients_through_restarts_and_new_exit_nodes(fleet):
+    tm = fleet(countries=('us', 'de')).manager()
+    client = tm.clients.by_country('us')[0]
+
+    tm.start_connection(port=client.socks_port)
+    first_pid = client.pid
+    assert tm.clients.by_pid(first_pid) is client
+
+    tm.kill_tor_connection(port=client.socks_port)
+    assert tm.clients.by_pid(first_pid) is None
+    tm.start_connection(port=client.socks_port)
+    assert client.pid != first_pid
+    assert tm.clients.by_pid(client.pid) is client
+
+    client.exit_nodes = ['{de}']
+    tm.clients.reindex(client)
+    assert client not in tm.clients.by_country('us')
+    assert client in tm.clients.by_country('germany')
+    assert tm.clients.find(port=client.control_port) == [client]
+
+
+def test_registry_keeps_insertion_order_and_drops_removed_clients():
+    clients = [SimpleNamespace(socks_port=port, control_port=port + 1, pid=None, config_file_path=f'/x/torrc.{port}',
+                               exit_nodes=['us']) for port in (9060, 9062, 9064)]
+    registry = ClientRegistry(clients)
+    registry.append(clients[0])
+
+    assert list(registry) == clients
+    registry.remove(clients[1])
+    assert list(registry) == [clients[0], clients[2]]
+    assert registry.by_port(9062) is None and registry.by_port(9063) is None
+    # re-appending only reindexed clients[0], which moved it to the end of its country
+    assert registry.by_country('us') == [clients[2], clients[0]]
+    assert registry.by_file_name('torrc.9064') is clients[2]
+
+
+def test_exit_nodes_are_parsed_like_tor_does():
+    assert country_code('{US}') == 'us'
+    assert country_code(' Germany ') == 'de'
+    assert country_code('atlantis') is None
+
+    assert parse_exit_nodes('{us}, {DE}') == ['us', 'de']
+    assert parse_exit_node('$' + 'A' * 40 + '~relay') == '$' + 'A' * 40 + '~relay'
+    assert parse_exit_node('10.0.0.0/8') == '10.0.0.0/8'
+    assert parse_exit_node('NL') == 'nl'
+    assert parse_exit_node('somerelay') == 'somerelay'
+    with pytest.raises(ValueError):
+        parse_exit_node('{xx}')
+    with pytest.raises(ValueError):
+        parse_exit_node('not a relay')
+
+
+def test_parsed_torrc_is_reloaded_once_the_file_changed(tmp_path):
+    path = tmp_path / 'torrc.1'
+    path.write_text('SocksPort 9060\nControlPort 9061\n')
+
+    parsed = torrc_cache.load_torrc(str(path))
+    assert parsed['SocksPort'] == ['9060']
+    parsed['SocksPort'].append('9070')
+    assert torrc_cache.load_torrc(str(path))['SocksPort'] == ['9060']
+
+    path.write_text('SocksPort 9062\nControlPort 9063\n')
+    os.utime(path, ns=(0, 1))
+    assert torrc_cache.load_torrc(str(path))['SocksPort'] == ['9062']
+
+    # a rewrite keeping inode, mtime and size is only seen after invalidating
+    path.write_text('SocksPort 9064\nControlPort 9065\n')
+    os.utime(path, ns=(0, 1))
+    assert torrc_cache.load_torrc(str(path))['SocksPort'] == ['9062']
+    torrc_cache.invalidate_torrc(str(path))
+    assert torrc_cache.load_torrc(str(path))['SocksPort'] == ['9064']
+
+
+def test_port_pairs_skip_taken_and_listening_ports():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        listening = listener.getsockname()[1]
+        start = listening - listening % 2
+
+        pairs = allocate_port_pairs(3, taken={start + 2}, start=start)
+        assert listening not in {port for pair in pairs for port in pair}
+        assert (start + 2, start + 3) not in pairs
+        assert all(socks % 2 == 0 and control == socks + 1 for socks, control in pairs)
+
+        with pytest.raises(OSError):
+            allocate_port_pairs(2, taken={start + 2}, start=start, end=start + 3)
+
+
+def test_client_pickles_of_older_versions_are_migrated_into_the_state_store(fleet):
+    created = fleet(countries=('us',))
+    tm = created.manager()
+    client = created.custom_clients(tm)[0]
+
+    sleeper = subprocess.Popen(['sleep', '60'])
+    try:
+        legacy = TorConfig(client.config_file_path)
+        legacy.pid = sleeper.pid
+        legacy.ip_info = {'ip': '10.1.0.1', 'country': 'US'}
+        pickle_path = os.path.join(tm.CLIENTS_CACHE_DIR, 'client.1')
+        with open(pickle_path, 'wb') as fp:
+            pickle.dump(legacy, fp)
+
+        migrated = next(each for each in created.manager().clients if each.config_file_path == client.config_file_path)
+        assert migrated.pid == sleeper.pid
+        assert migrated.ip_info['ip'] == '10.1.0.1'
+        assert not os.path.exists(pickle_path)
+        assert tm.state_store.load()[os.path.basename(client.config_file_path)]['pid'] == sleeper.pid
+    finally:
+        sleeper.kill()
+        sleeper.wait()
+
+
+def launch_config(delay, monkeypatch):
+    monkeypatch.setenv(fake_tor.BOOTSTRAP_DELAY_ENV, str(delay))
+    (socks_port, control_port), = allocate_port_pairs(1, start=25000)
+    return {'SocksPort': str(socks_port), 'ControlPort': str(control_port)}
+
+
+def test_a_launch_that_does_not_bootstrap_in_time_is_killed(monkeypatch):
+    launch = TorLaunch(launch_config(30, monkeypatch), tor_cmd=os.path.abspath(fake_tor.__file__), timeout=0.5)
+    launch.start()
+
+    with pytest.raises(OSError, match='timeout'):
+        launch.wait(10)
+    assert launch.process.poll() is not None
+    assert not launch.ready()
+
+
+def test_a_cancelled_launch_is_killed_and_reports_progress_until_then(monkeypatch):
+    progress = list()
+    launch = TorLaunch(launch_config(30, monkeypatch), tor_cmd=os.path.abspath(fake_tor.__file__),
+                       on_progress=lambda percent, summary: progress.append(percent))
+    launch.start()
+    for _ in range(500):
+        if progress:
+            break
+        time.sleep(0.01)
+
+    assert launch.cancel()
+    assert launch.future.cancelled()
+    assert launch.process.poll() is not None
+    assert progress and progress[-1] < 100
+
+
+class PublishedClient:
+    """
+    The fields FleetRegistry.pack_client reads from a TorConfig.
+    """
+
+    def __init__(self, socks_port, country):
+        self.socks_port = socks_port
+        self.control_port = socks_port + 1
+        self.pid = socks_port
+        self.exit_nodes = [country]
+        self.ip_info = {'ip': f'10.0.{socks_port % 256}.1', 'country': country.upper()}
+        self.socks_auth = None
+
+    def launching(self):
+        return False
+
+    def process_alive(self):
+        return True
+
+
+def test_fleet_readers_only_see_whole_publishes(tmp_path):
+    path = str(tmp_path / 'fleet.mmap')
+    fleets = [[PublishedClient(port, country) for port in range(base, base + 2 * size, 2)]
+              for base, country, size in ((30000, 'us', 3), (31000, 'de', 7))]
+
+    registry = FleetRegistry(path, capacity=4)
+    registry.publish(fleets[0])
+    reader = FleetReader(path)
+    stop = threading.Event()
+
+    def publish():
+        published = 0
+        while not stop.is_set():
+            registry.publish(fleets[published % 2])
+            published += 1
+
+    publisher = threading.Thread(target=publish)
+    publisher.start()
+    try:
+        seen = set()
+        reads = 0
+        deadline = time.monotonic() + 10
+        while (reads < 2000 or len(seen) < 2) and time.monotonic() < deadline:
+            reads += 1
+            records = reader.snapshot()
+            countries = {record['countries'][0] for record in records}
+            # a torn copy mixes both fleets or has the size of one and the records of the other
+            assert countries in ({'us'}, {'de'})
+            assert len(records) == (3 if countries == {'us'} else 7)
+            seen |= countries
+    finally:
+        stop.set()
+        publisher.join()
+
+    # the second fleet outgrew capacity, so the reader followed the registry to the larger file
+    assert registry.capacity == 8
+    assert seen == {'us', 'de'}
+    registry.publish(fleets[1])
+    assert reader.pick('germany')['socks_port'] in range(31000, 31014)
+    reader.close()
+    registry.close()
+
+
+def test_fleet_readers_give_up_on_a_publish_that_never_ends(tmp_path, monkeypatch):
+    path = str(tmp_path / 'fleet.mmap')
+    registry = FleetRegistry(path)
+    registry.publish([PublishedClient(30000, 'us')])
+    reader = FleetReader(path)
+    monkeypatch.setattr(FleetReader, 'RETRIES', 20)
+
+    # a publisher that died between making the sequence odd and even again
+    sequence = registry._sequence_
+    registry._map_[12:20] = (sequence + 1).to_bytes(8, 'little')
+    with pytest.raises(TimeoutError):
+        reader.snapshot()
+
+    registry._map_[12:20] = sequence.to_bytes(8, 'little')
+    assert [record['socks_port'] for record in reader.snapshot()] == [30000]
+    reader.close()
+    registry.close()
+
+
+def test_supervisor_restarts_a_client_whose_tor_process_died(fleet):
+    tm = fleet(countries=('us',)).manager()
+    tm.start_all_connections(timeout=30)
+    client = next(client for client in tm.clients if client.pid not in (None, -1))
+    first_pid = client.pid
+
+    file_name = os.path.basename(client.config_file_path)
+
+    supervisor = HealthSupervisor(tm, base_delay=0.05, launch_timeout=30)
+    supervisor.sync()
+    try:
+        client.connection.kill()
+        # the restart is done once it wrote the new pid
+        for _ in range(1000):
+            if tm.state_store.load().get(file_name, {}).get('pid') not in (None, first_pid):
+                break
+            time.sleep(0.01)
+    finally:
+        supervisor.stop()
+
+    assert client.pid not in (None, first_pid)
+    assert tm.clients.by_pid(client.pid) is client
+    assert tm.clients.by_pid(first_pid) is None
+    assert tm.state_store.load()[file_name]['pid'] == client.pid
+    assert client.process_alive()
@@ -10,6 +10,8 @@ import json
 import re
 import os
 
+from get_port_ip import get_ports_ip
+
 # args: ip, new, port, country
 parser = argparse.ArgumentParser()
 parser.add_argument('--ip', default=False, action='store_true')
@@ -51,27 +53,22 @@ def renew_tor_ip():
             controller.signal(Signal.NEWNYM)
 
 
-def getip(flags):
-    if 'isp' in flags:
-        ip['stem'] = json.loads(os.popen("python3 get_port_ip.py"))
-    if 'tor' in flags:
-        ip['tor'] = json.loads(os.system("torsocks python3 get_port_ip.py"))
-        with open('ip.txt', 'r') as f:
-            ip['tor'] = json.load(f)
-        ip['stem'] = get_current_ip()
-
-
 def getip(port=None):
-    if port:
-        for country, eachPort in ports.items():
-            ip['tor-%s' % country] = json.loads(os.popen("python3 get_port_ip.py --port %s" % eachPort))
-    else:
-        for country, eachPort in ports.items():
-            if port in eachPort:
-                ip['tor-%s' % country] = json.loads(os.popen("python3 get_port_ip.py --port %s" % port))
+    """
+    Probes every selected port in-process and concurrently, the default entry goes out directly.
+    """
+    selected = {country: eachPort for country, eachPort in ports.items() if not port or eachPort in port}
+    results = get_ports_ip(eachPort if eachPort != '0000' else None for eachPort in selected.values())
+
+    for country, eachPort in selected.items():
+        info = results.get(eachPort if eachPort != '0000' else None)
+        if isinstance(info, Exception):
+            print(f'{country}: {info}')
+            info = None
+        ip[country] = info or {'ip': 'N/A', 'city': '', 'country': '', 'region': ''}
 
 
-getip()
+getip(args.port)
 
 x = PrettyTable()
 x.field_names = ["*", "ip", "city", "country", "region"]
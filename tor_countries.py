@@ -0,0 +1,89 @@
+import ipaddress
+import json
+import os
+import re
+from types import MappingProxyType
+
+COUNTRIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tor-countries.json")
+
+
+def _load_countries():
+    with open(COUNTRIES_FILE, 'r') as fp:
+        countries = json.load(fp)
+
+    return {code.lower(): name for code, name in countries.items()}
+
+
+# loaded once per process and shared by every TorConfig
+COUNTRIES = MappingProxyType(_load_countries())  # code -> name
+COUNTRY_CODES = MappingProxyType({name.lower(): code for code, name in COUNTRIES.items()})  # lower name -> code
+
+FINGERPRINT_PATTERN = re.compile(r'^\$?[0-9a-fA-F]{40}([~=][0-9a-zA-Z]{1,19})?$')
+NICKNAME_PATTERN = re.compile(r'^[0-9a-zA-Z]{1,19}$')
+
+
+def country_code(country):
+    """
+    Args:
+        country: str: country code, with or without braces, or country name
+
+    Returns:
+        lower-cased country code, None if country is not a tor country
+    """
+    country = str(country).strip().strip('{}').strip().lower()
+    if country in COUNTRIES:
+        return country
+
+    return COUNTRY_CODES.get(country)
+
+
+def parse_exit_node(node):
+    """
+    Validates a single ExitNodes entry: a {cc} country, a relay fingerprint (optionally with ~nickname or
+    =nickname), an ip address or range, or a relay nickname.
+
+    Returns:
+        lower-cased country code for countries, the stripped entry otherwise
+
+    Raises:
+        ValueError: if node is not a valid ExitNodes entry
+    """
+    node = node.strip()
+
+    if node.startswith('{') and node.endswith('}'):
+        code = country_code(node)
+        if code is None:
+            raise ValueError(f"tor config exit node '{node}' not in tor predefined countries")
+        return code
+
+    if FINGERPRINT_PATTERN.match(node):
+        return node
+
+    try:
+        ipaddress.ip_network(node.strip('[]'), strict=False)
+        return node
+    except ValueError:
+        pass
+
+    # bare country codes have always been accepted here
+    if country_code(node) is not None and len(node) == 2:
+        return node.lower()
+
+    if NICKNAME_PATTERN.match(node):
+        return node
+
+    raise ValueError(f"tor config exit node '{node}' is not a country, fingerprint, address range or nickname")
+
+
+def parse_exit_nodes(value):
+    """
+    Args:
+        value: str or list of str: ExitNodes values, each may be a comma separated list
+
+    Returns:
+        list of validated entries, see parse_exit_node
+    """
+    if isinstance(value, str):
+        value = [value]
+
+    return [parse_exit_node(node) for line in value for node in line.split(',') if node.strip()]
@@ -1,7 +1,13 @@
 import argparse
+import getpass
 import logging
+import os
+import threading
 
-from TManager import TManager
+from prettytable import PrettyTable
+
+from TManagerDaemon import daemon_running, send_command
+from TorLaunch import BOOTSTRAP_TIMEOUT
 
 logger = logging.Logger("TManager_arg_parser")
 io_handler = logging.StreamHandler()
@@ -16,15 +22,65 @@ parser.add_argument("--stop-client", default=False, help='stop tor client based
 
 parser.add_argument("--show-configs", default=False, action="store_true")
 parser.add_argument("--show-running-clients", default=False, action="store_true")
+parser.add_argument("--refresh-ips", default=False, action="store_true",
+                    help='probe the ip of every running client concurrently before showing them.')
+parser.add_argument("--verify-ips", default=False, action="store_true",
+                    help='probe ips over the socks ports through an ip echo service instead of resolving exits '
+                         'through the control ports.')
 parser.add_argument("--stop-running-clients", default=False, action="store_true")
 parser.add_argument("--start-all-clients", default=False, action="store_true")
+parser.add_argument("--parallel", default=1, type=int,
+                    help='number of clients launched concurrently by --start-all-clients.')
+parser.add_argument("--shared", default=False, action="store_true",
+                    help='--start-all-clients runs one tor process per distinct ExitNodes serving all their '
+                         'SocksPorts. Their clients have to be used with the socks credentials of the proxy url '
+                         '--show-ip prints: renewing one only rotates those, streams without them keep their circuit.')
+parser.add_argument("--progress", default=False, action="store_true",
+                    help='print the bootstrap progress of every client started by --start-all-clients.')
+parser.add_argument("--warm-start", default=False, action="store_true",
+                    help='seed new clients with the directory cache of a running client or --dir-cache.')
+parser.add_argument("--dir-cache", default=None,
+                    help='shared directory cache kept fresh from running clients and used by --warm-start.')
+parser.add_argument("--timeout", default=None, type=int,
+                    help=f'seconds each client is given to bootstrap ({BOOTSTRAP_TIMEOUT} by default) or to probe its '
+                         'ip before it is reported as failed.')
 
 parser.add_argument("--renew-ip", default=False, action="store_true",
                     help='if not specified, it will renew all clients.')
+parser.add_argument("--unique-ips", default=False, action="store_true",
+                    help='when renewing all clients, re-roll clients until their exit ips are distinct and fresh.')
 parser.add_argument("--show-ip", default=False, action="store_true")
 
 parser.add_argument("--create-new-torrc-config", default=False, action="store_true")
 parser.add_argument("--delete-torrc-config", default=False, action="store_true")
+parser.add_argument("--provision", default=None, type=int,
+                    help='create this many torrc configs at once, on free ports starting at --port.')
+parser.add_argument("--countries", default=None,
+                    help='comma separated countries the --provision configs are spread over.')
+
+parser.add_argument("--daemon", default=False, action="store_true",
+                    help='keep the fleet in memory and serve the other commands over a unix socket.')
+parser.add_argument("--supervise", default=False, action="store_true",
+                    help='with --daemon, restart dead or stuck clients based on their controller events.')
+parser.add_argument("--metrics-port", default=None, type=int,
+                    help='with --daemon, serve timing histograms and bandwidth counters for prometheus on '
+                         'http://127.0.0.1:PORT/metrics.')
+parser.add_argument("--rank-exits", default=None, type=int, metavar="SECONDS",
+                    help='with --daemon, narrow the ExitNodes of per-country clients to the fastest exits of their '
+                         'countries, re-ranked every SECONDS.')
+parser.add_argument("--fleet-registry", default=None, nargs='?', const='default', metavar="PATH",
+                    help='with --daemon, publish the fleet to a memory mapped file other processes read with '
+                         'FleetRegistry.FleetReader, clients_cache_dir/fleet.mmap if PATH is not given.')
+parser.add_argument("--no-daemon", default=False, action="store_true",
+                    help='run the command in this process even if a daemon is running.')
+
+parser.add_argument("--serve-socks", default=None, type=int,
+                    help='serve a socks5 balancer over the running clients on this local port.')
+parser.add_argument("--balance-policy", default='round-robin', choices=('round-robin', 'least-connections', 'latency'),
+                    help='how --serve-socks picks a client for each connection.')
+
+parser.add_argument("--configs-dir", default="/etc/tor",
+                    help='directory of the main torrc and the torrc.<number> files of the clients.')
 
 parser.add_argument("--sudo", default=False, action="store_true")
 parser.add_argument("--tunnel-tor-proxy", default=False, action="store_true")
@@ -38,53 +94,193 @@ if (args.start_client or args.stop_client) and not (args.port or args.country):
     logger.error('for starting or stopping a client you have to specify port or country of client.')
     exit(1)
 if (args.create_new_torrc_config or args.delete_torrc_config) and not args.port:
-    logging.error('for creating or deleting torrc configs you have to specify at least port number.')
+    logger.error('for creating or deleting torrc configs you have to specify at least port number.')
     exit(1)
 if args.show_ip and not (args.port or args.country):
     logger.error('for showing a client ip you have to specify port or country of client.')
     exit(1)
 
-if __name__ == "__main__":
-    tm = TManager()
 
-    temp = dict()
-    if args.port:
-        temp['port'] = args.port if int(args.port) % 2 == 0 else str(int(args.port) + 1)
-    if args.country:
-        temp['country'] = args.country
+def print_progress(client, percent, summary):
+    print(f"{client.socks_port}: bootstrapped {percent}% {summary}", flush=True)
+
+
+def print_ip(temp, proxy, ip):
+    # clients of a shared tor process only have their ip with their socks credentials, so those are shown
+    if proxy is not None and '@' in proxy:
+        print(f'{proxy} {ip}')
+    else:
+        print(f'127.0.0.1:{temp.__str__().strip("{}")} {ip}')
+
+
+def print_running_clients(records):
+    table = PrettyTable()
+    table.field_names = ["pid", "port", "ip", "country", "region", "city"]
+    for field in table.field_names:
+        table.align[field] = 'r' if field in ('pid', 'port', 'ip') else 'l'
 
+    for record in records:
+        if record['ip_info'] is not None:
+            ip_info = record['ip_info']
+            table.add_row((record['pid'], record['socks_port'], ip_info.get('ip'), ip_info.get('country'),
+                           ip_info.get('region'), ip_info.get('city')))
+
+    print("tor running clients table")
+    print(table)
+
+
+def run_daemon():
+    from ControllerPool import controller_pool
+    from TManager import TManager
+    from TManagerDaemon import TManagerDaemon
+
+    # requests are served from worker threads, so the password can only be asked for now
+    if not controller_pool.password and os.isatty(0):
+        controller_pool.password = getpass.getpass("tor control password (empty for cookie authentication):") or None
+    controller_pool.interactive = False
+
+    registry_path = args.fleet_registry
+    if registry_path == 'default':
+        from FleetRegistry import REGISTRY_PATH
+        registry_path = REGISTRY_PATH
+
+    daemon = TManagerDaemon(TManager(configs_dir=args.configs_dir), supervise=args.supervise,
+                            rank_interval=args.rank_exits, metrics_port=args.metrics_port,
+                            registry_path=registry_path)
+    if args.dir_cache:
+        daemon.tmanager.DIR_CACHE_DIR = os.path.abspath(args.dir_cache)
+    if args.serve_socks:
+        from SocksBalancer import SocksBalancer
+
+        balancer = SocksBalancer(daemon.tmanager, port=args.serve_socks, policy=args.balance_policy)
+        threading.Thread(target=balancer.serve_forever, daemon=True).start()
+
+    daemon.serve_forever()
+
+
+def run_through_daemon(temp):
+    """
+    Runs the fleet commands against the running daemon instead of building a TManager.
+    """
     if args.start_client:
-        tm.start_connection(**temp)
+        send_command('start', timeout=args.timeout, warm_start=args.warm_start, **temp)
+    elif args.stop_client:
+        send_command('stop', **temp)
+    elif args.start_all_clients:
+        summary = send_command('start', max_workers=args.parallel, timeout=args.timeout, warm_start=args.warm_start,
+                               shared=args.shared)
+        print(f"tor clients startup: {len(summary['started'])} started, {len(summary['failed'])} failed")
+        for port, error in summary['failed'].items():
+            print(f"{port}: {error}")
+    elif args.stop_running_clients:
+        send_command('stop')
+
+    if args.renew_ip:
+        if args.unique_ips and not temp:
+            summary = send_command('renew', unique=True)['unique']
+            print(f"{summary['distinct']} distinct exit ips over {summary['clients']} clients")
+        else:
+            send_command('renew', **temp)
+
+    if args.show_ip:
+        records = send_command('status', **temp)
+        info = records[0]['ip_info'] if records else None
+        ip = info['ip'] if info is not None else 'nan'
+        print_ip(temp, records[0]['proxy'] if records else None, ip)
+
+    if args.show_running_clients:
+        print_running_clients(send_command('list', probe=True, refresh=args.refresh_ips, verify=args.verify_ips))
+
+
+def run_locally(temp):
+    from TManager import TManager
+
+    tm = TManager(configs_dir=args.configs_dir)
+    launch_timeout = args.timeout if args.timeout is not None else BOOTSTRAP_TIMEOUT
+    if args.dir_cache:
+        tm.DIR_CACHE_DIR = os.path.abspath(args.dir_cache)
+
+    if args.start_client:
+        tm.start_connection(warm_start=args.warm_start, timeout=launch_timeout, **temp)
     elif args.stop_client:
         tm.kill_tor_connection(**temp)
     elif args.start_all_clients:
-        tm.load_clients_cache()
         tm.read_configs()
-        tm.start_all_connections()
+        tm.load_clients_cache()
+        if args.shared:
+            summary = tm.start_shared_connections(max_workers=args.parallel, timeout=launch_timeout,
+                                                  warm_start=args.warm_start)
+        else:
+            summary = tm.start_all_connections(max_workers=args.parallel, timeout=launch_timeout,
+                                               warm_start=args.warm_start,
+                                               on_progress=print_progress if args.progress else None)
+        tm.output_start_summary(summary)
     elif args.stop_running_clients:
         tm.kill_all_connections()
 
     if args.renew_ip:
         if args.port or args.country:
             tm.renew_connection(**temp)
+        elif args.unique_ips:
+            tm.renew_all_connections(probe=False)
+            summary = tm.ensure_unique_exits()
+            print(f"{summary['distinct']} distinct exit ips over {summary['clients']} clients")
         else:
             tm.renew_all_connections()
 
     if args.show_ip:
         info = tm.get_ip_info(**temp)
         ip = info['ip'] if info is not None else 'nan'
-        print(f'127.0.0.1:{temp.__str__().strip("{}")} {ip}')
+        clients = tm.clients.find(**temp)
+        print_ip(temp, clients[0].proxy_url() if clients else None, ip)
 
     if args.create_new_torrc_config:
+        if args.countries:
+            temp['countries'] = args.countries.split(',')
         tm.create_torrc_config(**temp)
 
     if args.delete_torrc_config:
         tm.delete_torrc_config(**temp)
 
+    if args.provision:
+        created = tm.provision_torrc_configs(
+            args.provision, countries=args.countries.split(',') if args.countries else None,
+            start_port=int(temp['port']) if 'port' in temp else 9060
+        )
+        print(f"created {len(created)} torrc configs")
+
     if args.show_running_clients:
-        tm.output_running_clients()
+        if args.timeout is not None:
+            tm.output_running_clients(refresh=args.refresh_ips, timeout=args.timeout, verify=args.verify_ips)
+        else:
+            tm.output_running_clients(refresh=args.refresh_ips, verify=args.verify_ips)
 
     if args.show_configs:
         tm.output_configs()
 
     tm.write_running_clients_configs()
+
+    if args.serve_socks:
+        from SocksBalancer import SocksBalancer
+
+        SocksBalancer(tm, port=args.serve_socks, policy=args.balance_policy).serve_forever()
+
+
+if __name__ == "__main__":
+    temp = dict()
+    if args.port:
+        temp['port'] = args.port if int(args.port) % 2 == 0 else str(int(args.port) + 1)
+    if args.country:
+        temp['country'] = args.country
+
+    if args.daemon:
+        run_daemon()
+    elif not args.no_daemon and daemon_running() and \
+            not (args.show_configs or args.create_new_torrc_config or args.delete_torrc_config or args.provision or
+                 args.serve_socks):
+        run_through_daemon(temp)
+    else:
+        run_locally(temp)
+
+        if (args.create_new_torrc_config or args.delete_torrc_config or args.provision) and daemon_running():
+            send_command('reload')
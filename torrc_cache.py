@@ -0,0 +1,54 @@
+import os
+import threading
+
+from stem.util import conf
+
+from Metrics import CONFIG_LOAD_SECONDS, metrics
+
+MAIN_TORRC = "/etc/tor/torrc"
+
+_lock = threading.Lock()
+_parsed = dict()  # absolute path -> (stat key, parsed options)
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def load_torrc(path):
+    """
+    Parses the torrc at path with stem.util.conf, reusing the previous result while the file's inode, mtime and
+    size are unchanged.
+
+    Returns:
+        dict: option -> list of values, a copy callers are free to change
+    """
+    path = os.path.abspath(path)
+    key = _stat_key(path)
+
+    with _lock:
+        cached = _parsed.get(path)
+    if cached is not None and cached[0] == key:
+        return {option: list(values) for option, values in cached[1].items()}
+
+    with metrics.timer(CONFIG_LOAD_SECONDS, stage='parse'):
+        config_object = conf.Config()
+        config_object.load(path)
+        options = {option: list(config_object[option]) for option in config_object.keys()}
+
+    with _lock:
+        _parsed[path] = (key, options)
+
+    return {option: list(values) for option, values in options.items()}
+
+
+def invalidate_torrc(path=None):
+    """
+    Forgets the parsed torrc at path, or every parsed torrc if path is None.
+    """
+    with _lock:
+        if path is None:
+            _parsed.clear()
+        else:
+            _parsed.pop(os.path.abspath(path), None)